@@ -21,49 +21,614 @@
 
 from __future__ import print_function
 
-import argparse
-import ast
 import boto3
 import botocore
+import botocore.config
+import concurrent.futures
 import configparser
+import datetime
+import functools
+import hashlib
+import io
 import json
 import logging
 import os
+import random
+import re
 import time
 import sys
-import urllib
-
-from botocore.vendored import requests
+import threading
+import urllib.parse
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Per Lambda container caches, see read_config(), assume_role() and get_client().
+_bootstrapper_config = None
+_client_config = None
+_session = None
+_cache_lock = threading.Lock()
+_credential_cache = {}
+_credential_locks = {}
+_credential_owner = {}
+_client_cache = {}
+_create_account_governor = None
+_retry_settings = None
+_retry_deadline = None
+_retry_local = threading.local()
+_rate_limit_settings = None
+_rate_limit_lock = threading.Lock()
+_rate_limiters = {}
+_metadata_cache = None
+_provider_templates = None
+_organization_tree = None
+_account_inventory = None
+_hub_role_grants = {}
+# Structured logging and AWS API metrics, see log_event() and api_metrics_summary().
+_log_context = threading.local()
+_metrics_lock = threading.Lock()
+_api_metrics = {}
+_step_metrics = {}
+_run_start = time.time()
+# Checkpointing from within a running provisioning step, see save_step_progress().
+_step_progress = threading.local()
+_response_pool = None
+
+def read_config():
+    # Function to return the parsed "bootstrapper.ini" configuration, read from disk once per Lambda container.
+    global _bootstrapper_config
+    if _bootstrapper_config is None:
+        config = configparser.ConfigParser()
+        config.read('bootstrapper.ini')
+        _bootstrapper_config = config
+    return _bootstrapper_config
+
+def client_config():
+    # Function to return the shared botocore Config used for every boto3 client created by get_client().
+    #   Pool size and timeouts are read from the [Performance] section of bootstrapper.ini.
+    global _client_config
+    if _client_config is None:
+        config = read_config()
+        _client_config = botocore.config.Config(
+            max_pool_connections=config.getint('Performance', 'client_max_pool_connections', fallback=50),
+            connect_timeout=config.getint('Performance', 'client_connect_timeout', fallback=10),
+            read_timeout=config.getint('Performance', 'client_read_timeout', fallback=60),
+            # Retries are made by call_with_retry(), botocore's own retries are turned off so they do not multiply.
+            retries={'max_attempts': 0}
+        )
+    return _client_config
+
+# Error classification used by call_with_retry().  Error codes not listed are permanent and fail straight away.
+THROTTLING_ERRORS = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'EC2ThrottledException', 'BandwidthLimitExceeded',
+    'PriorRequestNotComplete', 'ProvisionedThroughputExceededException'
+])
+TRANSIENT_ERRORS = frozenset([
+    'InternalError', 'InternalFailure', 'InternalServerError', 'ServiceUnavailable', 'ServiceUnavailableException',
+    'ServiceFailure', 'ServiceFailureException', 'RequestTimeout', 'RequestTimeoutException', 'OperationAborted',
+    'ConcurrentModificationException', 'IDPCommunicationError'
+])
+# Errors that only mean an entity created moments ago has not propagated yet for the given (service, operation).
+#   They are retried for at most the retry_consistency_window setting, after that they are treated as permanent.
+#   AssumeRole AccessDenied is not listed, it is a real permission error except straight after an account is created,
+#   which the readiness probe of step_create_account() waits out.
+CONSISTENCY_ERRORS = {
+    ('iam', 'CreateRole'): frozenset(['MalformedPolicyDocument']),
+    ('iam', 'UpdateAssumeRolePolicy'): frozenset(['MalformedPolicyDocument']),
+    ('iam', 'PutRolePolicy'): frozenset(['NoSuchEntity']),
+    ('iam', 'AttachRolePolicy'): frozenset(['NoSuchEntity']),
+    ('iam', 'AddRoleToInstanceProfile'): frozenset(['NoSuchEntity']),
+    ('s3', 'PutBucketPolicy'): frozenset(['MalformedPolicy']),
+    ('ec2', 'DeleteVpc'): frozenset(['DependencyViolation']),
+    ('ec2', 'DeleteInternetGateway'): frozenset(['DependencyViolation']),
+    ('ec2', 'DeleteSubnet'): frozenset(['DependencyViolation']),
+    ('ec2', 'DeleteSecurityGroup'): frozenset(['DependencyViolation']),
+    ('ec2', 'DeleteRouteTable'): frozenset(['DependencyViolation']),
+    ('ec2', 'DeleteNetworkAcl'): frozenset(['DependencyViolation'])
+}
+
+def classify_error(service,operation,error_code,message=''):
+    # Function to classify an AWS error code for the retry policy.
+    # Returns 'throttle', 'transient', 'consistency' or 'permanent'.
+    if error_code in THROTTLING_ERRORS:
+        return 'throttle'
+    if error_code in TRANSIENT_ERRORS:
+        return 'transient'
+    if error_code in CONSISTENCY_ERRORS.get((service, operation), ()):
+        # IAM reports a not yet visible principal as a malformed policy, any other malformed policy is a real error.
+        if error_code.startswith('Malformed') and 'principal' not in (message or '').lower():
+            return 'permanent'
+        return 'consistency'
+    return 'permanent'
+
+def retry_settings():
+    # Function returning the retry policy settings from the [Retry] section of bootstrapper.ini.
+    global _retry_settings
+    if _retry_settings is None:
+        config = read_config()
+        _retry_settings = {
+            'max_attempts': config.getint('Retry', 'retry_max_attempts', fallback=10),
+            'base_delay': config.getfloat('Retry', 'retry_base_delay', fallback=0.5),
+            'max_delay': config.getfloat('Retry', 'retry_max_delay', fallback=20),
+            'consistency_window': config.getint('Retry', 'retry_consistency_window', fallback=180),
+            'readiness_timeout': config.getint('Retry', 'readiness_timeout', fallback=300),
+            'readiness_max_delay': config.getfloat('Retry', 'readiness_max_delay', fallback=8)
+        }
+    return _retry_settings
+
+def set_retry_deadline(context,margin=30):
+    # Function to bound all retries by the time the Lambda has left, call at the start of every handler.
+    #   Retries stop once their next wait would end within margin seconds of the Lambda timeout.  No bound applies without a context.
+    global _retry_deadline
+    if context is None:
+        _retry_deadline = None
+    else:
+        _retry_deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - margin
+
+def call_with_retry(service,operation,call,limiter=None):
+    # Function every AWS call is made through (see RetryingClientMixin) applying the shared retry policy.
+    #   Throttling and transient errors are retried, eventual consistency errors are retried within the consistency window,
+    #   and permanent errors (AccessDenied, MalformedPolicyDocument, EntityAlreadyExists, ...) are raised immediately.
+    #   Waits use decorrelated jitter backoff and retries stop when the attempt limit or the Lambda deadline would be passed.
+    # Parameters:
+    #   service:   The boto3 service name, used for classification and logging.
+    #   operation: The API operation name, eg 'CreateRole'.
+    #   call:      Function making the call with no arguments.
+    #   limiter:   Optional TokenBucket each attempt waits on, told of throttling so it can slow down, see rate_limiter().
+    settings = retry_settings()
+    start = time.time()
+    delay = settings['base_delay']
+    attempt = 1
+    while True:
+        if limiter is not None:
+            waited = limiter.acquire()
+            if waited > 0:
+                record_rate_wait(service,operation,waited)
+        try:
+            response = call()
+            if limiter is not None:
+                limiter.succeeded()
+            return response
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code', '')
+            kind = classify_error(service,operation,error_code,e.response.get('Error', {}).get('Message', ''))
+            error = e
+        except (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) as e:
+            kind = 'transient'
+            error = e
+        if kind == 'throttle' and limiter is not None:
+            limiter.throttled()
+        if kind == 'permanent':
+            raise error
+        # Readiness probes poll on their own short interval rather than waiting out the consistency window here.
+        if kind == 'consistency' and getattr(_retry_local, 'probing', False):
+            raise error
+        if kind == 'consistency' and time.time() - start >= settings['consistency_window']:
+            raise error
+        if attempt >= settings['max_attempts']:
+            raise error
+        delay = min(settings['max_delay'], random.uniform(settings['base_delay'], delay * 3))
+        if _retry_deadline is not None and time.time() + delay > _retry_deadline:
+            log_event('api_retry_abandoned', service=service, operation=operation, kind=kind, attempt=attempt, reason='lambda deadline', error=str(error))
+            raise error
+        log_event('api_retry', service=service, operation=operation, kind=kind, attempt=attempt, delay=round(delay,2), error=str(error))
+        record_api_retry(service,operation,kind)
+        record_sleep(delay)
+        time.sleep(delay)
+        attempt += 1
+
+def wait_until_ready(description,probe,timeout=None,initial_delay=1):
+    # Function to poll a cheap read call until a newly created resource can be used, rather than sleeping for its worst
+    #   case propagation time.  Probes back off from initial_delay up to the readiness_max_delay setting with jitter, and
+    #   the time propagation took is logged.  When the resource is still not ready at the timeout the caller carries on and
+    #   the shared retry policy covers the call that follows.
+    # Parameters:
+    #   description: What is being waited for, used in logging.
+    #   probe:       Function with no arguments which raises a ClientError (or returns False) until the resource is ready.
+    #   timeout:     Seconds to keep probing, the readiness_timeout setting is used if omitted.
+    # Returns a tuple of (ready, seconds taken).
+    settings = retry_settings()
+    if timeout is None:
+        timeout = settings['readiness_timeout']
+    start = time.time()
+    deadline = start + timeout
+    if _retry_deadline is not None:
+        deadline = min(deadline, _retry_deadline)
+    delay = initial_delay
+    probes = 0
+    while True:
+        probes += 1
+        _retry_local.probing = True
+        try:
+            ready = probe() is not False
+            error = None
+        except botocore.exceptions.ClientError as e:
+            ready = False
+            error = e
+        finally:
+            _retry_local.probing = False
+        elapsed = round(time.time() - start,2)
+        if ready:
+            log_event('ready', resource=description, ready=True, elapsed=elapsed, probes=probes)
+            return (True,elapsed)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            log_event('ready', resource=description, ready=False, elapsed=elapsed, probes=probes, error=str(error))
+            return (False,elapsed)
+        pause = min(remaining,delay / 2 + random.uniform(0,delay / 2))
+        record_sleep(pause)
+        time.sleep(pause)
+        delay = min(settings['readiness_max_delay'],delay * 2)
+
+class TokenBucket(object):
+    # Client side rate limit of one AWS API (a service, or one of its operations) in one account and region.  Requests
+    #   take a token, tokens are added at the current rate up to a burst of one second's worth.  The rate adapts to the
+    #   throttling seen: it is halved (down to the rate_limit_floor setting) each time AWS throttles a request, and grows
+    #   back towards the configured rate by a twentieth of it with each request that is not throttled, so concurrent
+    #   provisioning settles just under the account's real limit.  Safe to share between threads.
+    def __init__(self, rate, floor):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.floor = min(float(floor), self.max_rate)
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Take a token, waiting for one if needed.  Returns the seconds waited.
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.floor, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+def rate_limit_settings():
+    # Function returning the [RateLimit] section of bootstrapper.ini: the floor adaptive rates are not cut below, and the
+    #   requests per second allowed for each "service" or "service.Operation" listed.  APIs not listed are not limited.
+    global _rate_limit_settings
+    if _rate_limit_settings is None:
+        config = read_config()
+        limits = {}
+        if config.has_section('RateLimit'):
+            for (name, value) in config.items('RateLimit'):
+                if name != 'rate_limit_floor' and value.strip():
+                    limits[name.lower()] = float(value)
+        _rate_limit_settings = { 'floor': config.getfloat('RateLimit', 'rate_limit_floor', fallback=0.2), 'limits': limits }
+    return _rate_limit_settings
+
+def rate_limiter(scope,service,operation):
+    # Function returning the shared TokenBucket limiting an API call, or None when the API is not rate limited.
+    #   An operation listed on its own has a bucket of its own, other operations of a listed service share the service's bucket.
+    # Parameters:
+    #   scope:     The (account, region) the call is made in, AWS applies its limits per account and region.
+    #   service:   The boto3 service name.
+    #   operation: The API operation name, eg 'CreateRole'.
+    settings = rate_limit_settings()
+    name = (service + '.' + operation).lower()
+    if name not in settings['limits']:
+        name = service.lower()
+        if name not in settings['limits']:
+            return None
+    key = (scope, name)
+    with _rate_limit_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = TokenBucket(settings['limits'][name], settings['floor'])
+        return _rate_limiters[key]
+
+class RetryingClientMixin(object):
+    # Mixed into every boto3 client class built by the shared session, so every API call (including paginator and
+    # waiter calls) made by any client from get_client() goes through call_with_retry() and the API's rate_limiter().
+    def _make_api_call(self, operation_name, api_params):
+        parent = super(RetryingClientMixin, self)._make_api_call
+        service = self.meta.service_model.service_name
+        limiter = rate_limiter((getattr(self, '_rate_limit_account', None), self.meta.region_name), service, operation_name)
+        return call_with_retry(service, operation_name, lambda: parent(operation_name, api_params), limiter)
+
+def _add_client_mixins(base_classes, **kwargs):
+    # botocore creating-client-class event handler adding the shared retry policy to each client class.
+    base_classes.insert(0, RetryingClientMixin)
+
+# Fields whose values are never written to the log, and patterns masked wherever they appear in logged text.
+SECRET_FIELDS = frozenset(['SecretAccessKey', 'SessionToken', 'AccessKeyId', 'aws_secret_access_key', 'aws_session_token', 'Password'])
+SECRET_PATTERNS = [
+    (re.compile(r'\b(AKIA|ASIA)[A-Z0-9]{16}\b'), r'\1****'),
+    (re.compile(r'(https://[^\s?"\']+)\?[^\s"\']*'), r'\1?****')
+]
+
+def redact(value):
+    # Function returning a copy of a value to be logged with credentials, keys and presigned URL signatures masked.
+    if isinstance(value, dict):
+        return dict((key, '****' if key in SECRET_FIELDS else redact(item)) for (key, item) in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        for (pattern, replacement) in SECRET_PATTERNS:
+            value = pattern.sub(replacement, value)
+    return value
+
+def log_event(event, **fields):
+    # Function to write a structured JSON log line, with secrets redacted, to the Lambda CloudWatch log.
+    #   The account and provisioning step being run on the current thread are added when known.
+    # Parameters:
+    #   event:  Short name of what happened, eg 'step_end'.
+    #   fields: Values describing the event.
+    record = {'timestamp': datetime.datetime.utcnow().isoformat() + 'Z', 'event': event}
+    for name in ('account', 'step'):
+        if getattr(_log_context, name, None) is not None:
+            record[name] = getattr(_log_context, name)
+    record.update(fields)
+    print(json.dumps(redact(record), default=str, sort_keys=True))
+
+def reset_api_metrics():
+    # Function to start a new run, clearing the AWS API metrics recorded by the botocore event handlers below and the metadata cache counters.
+    global _run_start
+    with _metrics_lock:
+        _api_metrics.clear()
+        _step_metrics.clear()
+        _run_start = time.time()
+    if _metadata_cache is not None:
+        _metadata_cache.reset_stats()
+
+def _api_metric(service, operation):
+    # Function returning the metrics entry of an API operation, call with _metrics_lock held.
+    key = (service, operation)
+    if key not in _api_metrics:
+        _api_metrics[key] = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'latencies': [], 'rate_waits': 0, 'rate_wait_seconds': 0.0}
+    return _api_metrics[key]
+
+def _step_metric():
+    # Function returning the metrics entry of the account and provisioning step run by the current thread, or None when the
+    #   thread is not running a step, call with _metrics_lock held.
+    account = getattr(_log_context, 'account', None)
+    step = getattr(_log_context, 'step', None)
+    if account is None or step is None:
+        return None
+    key = (account, step)
+    if key not in _step_metrics:
+        _step_metrics[key] = {'api_calls': 0, 'retries': 0, 'sleep_seconds': 0.0}
+    return _step_metrics[key]
+
+def step_metrics(account, step):
+    # Function returning the AWS API calls, retries and seconds slept so far by one account's provisioning step in this run.
+    with _metrics_lock:
+        metric = dict(_step_metrics.get((account, step)) or {'api_calls': 0, 'retries': 0, 'sleep_seconds': 0.0})
+    metric['sleep_seconds'] = round(metric['sleep_seconds'], 2)
+    return metric
+
+def in_log_context(function):
+    # Function returning function wrapped to run with the account and step of the calling thread, for work a step hands to
+    #   a thread pool, so its log lines and the step metrics are attributed to the step.
+    account = getattr(_log_context, 'account', None)
+    step = getattr(_log_context, 'step', None)
+    def run(*args, **kwargs):
+        previous = (getattr(_log_context, 'account', None), getattr(_log_context, 'step', None))
+        (_log_context.account, _log_context.step) = (account, step)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            (_log_context.account, _log_context.step) = previous
+    return run
+
+def record_api_retry(service, operation, kind):
+    # Function to count a retry made by call_with_retry(), kind is the error classification.
+    with _metrics_lock:
+        metric = _api_metric(service, operation)
+        metric['retries'] += 1
+        if kind == 'throttle':
+            metric['throttles'] += 1
+        metric = _step_metric()
+        if metric is not None:
+            metric['retries'] += 1
+
+def record_rate_wait(service, operation, seconds):
+    # Function to count a call held back by its rate_limiter().
+    with _metrics_lock:
+        metric = _api_metric(service, operation)
+        metric['rate_waits'] += 1
+        metric['rate_wait_seconds'] += seconds
+        metric = _step_metric()
+        if metric is not None:
+            metric['sleep_seconds'] += seconds
+
+def record_sleep(seconds):
+    # Function to add the seconds about to be slept (a retry backoff or a poll interval) to the current step's metrics.
+    with _metrics_lock:
+        metric = _step_metric()
+        if metric is not None:
+            metric['sleep_seconds'] += seconds
+
+def _record_call_start(model, context, **kwargs):
+    # botocore before-call event handler, timing each API request (every retry attempt is a request of its own).
+    context['metrics_start'] = time.time()
+    context['metrics_operation'] = (model.service_model.service_name, model.name)
+
+def _record_call_end(context, model=None, parsed=None, exception=None, **kwargs):
+    # botocore after-call and after-call-error event handler recording the request latency and whether it failed.
+    #   after-call-error is not given the operation model, the operation is taken from the request context instead.
+    if 'metrics_start' not in context:
+        return
+    latency = (time.time() - context.pop('metrics_start')) * 1000.0
+    failed = exception is not None or (isinstance(parsed, dict) and 'Error' in parsed)
+    (service, operation) = context.pop('metrics_operation')
+    with _metrics_lock:
+        metric = _api_metric(service, operation)
+        metric['calls'] += 1
+        metric['latencies'].append(latency)
+        if failed:
+            metric['errors'] += 1
+        metric = _step_metric()
+        if metric is not None:
+            metric['api_calls'] += 1
+
+def api_metrics_summary():
+    # Function returning the AWS API metrics of the current run, one dictionary per service and operation with calls, errors,
+    #   retries, throttles, calls held back by the rate limiter and the seconds they waited, and total, average, p95 and max
+    #   latency in milliseconds, busiest operations first.
+    summary = []
+    with _metrics_lock:
+        for ((service, operation), metric) in _api_metrics.items():
+            latencies = sorted(metric['latencies'])
+            count = len(latencies)
+            summary.append({
+                'service': service, 'operation': operation,
+                'calls': metric['calls'], 'errors': metric['errors'], 'retries': metric['retries'], 'throttles': metric['throttles'],
+                'rate_waits': metric['rate_waits'], 'rate_wait_seconds': round(metric['rate_wait_seconds'], 2),
+                'total_ms': round(sum(latencies), 1),
+                'avg_ms': round(sum(latencies) / count, 1) if count else 0,
+                'p95_ms': round(latencies[min(count - 1, int(count * 0.95))], 1) if count else 0,
+                'max_ms': round(latencies[-1], 1) if count else 0
+            })
+    return sorted(summary, key=lambda item: item['total_ms'], reverse=True)
+
+def emf_document(namespace, dimensions, metrics, values):
+    # Function returning a CloudWatch Embedded Metric Format document, which CloudWatch turns into metrics when it is logged.
+    # Parameters:
+    #   dimensions: Dictionary of dimension name to value.
+    #   metrics:    List of (metric name, unit) tuples.
+    #   values:     Dictionary of metric name to value.
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for (name, unit) in metrics]
+            }]
+        }
+    }
+    document.update(dimensions)
+    document.update(values)
+    return document
+
+def emit_run_summary(reports):
+    # Function to finish a run by logging a summary of every account's step timings and the AWS API metrics, followed by
+    #   Embedded Metric Format documents for the run, each provisioning step and each API operation.
+    # Parameters:
+    #   reports: List of account reports, see provision_accounts().
+    config = read_config()
+    elapsed = round(time.time() - _run_start, 2)
+    api = api_metrics_summary()
+    cache = metadata_cache().stats()
+    log_event('run_summary', elapsed=elapsed, api=api, metadata_cache=cache,
+              accounts=[dict((key, report.get(key)) for key in ('accountname', 'status', 'account_id', 'elapsed', 'timings', 'critical_path', 'error')) for report in reports])
+    if not config.getboolean('Logging', 'emit_metrics', fallback=True):
+        return
+    namespace = config.get('Logging', 'metrics_namespace', fallback='AccountBootstrapper')
+    statuses = [report['status'] for report in reports]
+    print(json.dumps(emf_document(namespace, {}, [('RunDuration', 'Seconds'), ('AccountsCompleted', 'Count'), ('AccountsFailed', 'Count'), ('AccountsRejected', 'Count')],
+                                  {'RunDuration': elapsed, 'AccountsCompleted': statuses.count('complete'), 'AccountsFailed': statuses.count('failed'),
+                                   'AccountsRejected': statuses.count('rejected')})))
+    for (key, counters) in sorted(cache.items()):
+        print(json.dumps(emf_document(namespace, {'Cache': key}, [('CacheHits', 'Count'), ('CacheMisses', 'Count')],
+                                      {'CacheHits': counters['hits'] + counters['file_hits'], 'CacheMisses': counters['misses']})))
+    steps = {}
+    for report in reports:
+        for (step, duration) in (report.get('timings') or {}).items():
+            steps.setdefault(step, []).append(duration)
+    for (step, durations) in sorted(steps.items()):
+        print(json.dumps(emf_document(namespace, {'Step': step}, [('StepDuration', 'Seconds')], {'StepDuration': durations[:100]})))
+    for item in api:
+        print(json.dumps(emf_document(namespace, {'Service': item['service'], 'Operation': item['operation']},
+                                      [('Calls', 'Count'), ('Errors', 'Count'), ('Retries', 'Count'), ('Throttles', 'Count'), ('RateLimitWait', 'Seconds'),
+                                       ('LatencyAverage', 'Milliseconds'), ('LatencyP95', 'Milliseconds'), ('LatencyMax', 'Milliseconds')],
+                                      {'Calls': item['calls'], 'Errors': item['errors'], 'Retries': item['retries'], 'Throttles': item['throttles'],
+                                       'RateLimitWait': item['rate_wait_seconds'],
+                                       'LatencyAverage': item['avg_ms'], 'LatencyP95': item['p95_ms'], 'LatencyMax': item['max_ms']})))
+
+def credentials_expiration(credentials):
+    # Function returning the epoch time a temporary credentials object expires, None if it does not say.
+    expiration = credentials.get('Expiration')
+    if expiration is None:
+        return None
+    if isinstance(expiration, datetime.datetime):
+        if expiration.tzinfo is None:
+            expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+        expiration = expiration.timestamp()
+    return float(expiration)
+
+def credentials_expiring(credentials):
+    # Function to report whether a temporary credentials object is expired or close enough to expiry to be refreshed.
+    #   The refresh margin is read from the credential_refresh_margin [Performance] setting (seconds).
+    expiration = credentials_expiration(credentials)
+    if expiration is None:
+        return False
+    margin = read_config().getint('Performance', 'credential_refresh_margin', fallback=300)
+    return time.time() + margin >= expiration
+
+def _evict_expired_credentials():
+    # Function to drop the cached credentials that have expired, with their owner entries and the clients built from them,
+    #   so the caches only grow with the roles in use.  Callers must hold _cache_lock.
+    now = time.time()
+    for (key, credentials) in list(_credential_cache.items()):
+        expiration = credentials_expiration(credentials)
+        if expiration is not None and expiration <= now:
+            del _credential_cache[key]
+            _credential_owner.pop(credentials['AccessKeyId'], None)
+    for (key, (access_key, client, expiration)) in list(_client_cache.items()):
+        if expiration is not None and expiration <= now:
+            del _client_cache[key]
+
 def assume_role(account_id, account_role):
     # Function to return the temporary AWS credentials object for the specified role to assume
     # Function is typically used for gaining access across accounts
+    #   Credentials are cached per account and role for the life of the Lambda container and only re-assumed
+    #   shortly before they expire, so repeated calls for the same account are free.
     # Parameters:
     #   account_id:  The AWS account ID housing the role to assume.
     #   account_role: The account role NAME to assume.  Note: Provide the name and NOT the ARN.
     
-    sts_client = boto3.client('sts')
-    role_arn = 'arn:aws:iam::' + account_id + ':role/' + account_role
-    assuming_role = True
-    while assuming_role is True:
-        try:
-            assuming_role = False
-            assumedRoleObject = sts_client.assume_role(
-                RoleArn=role_arn,
-                RoleSessionName="NewAccountRole"
-            )
-        except botocore.exceptions.ClientError as e:
-            assuming_role = True
-            print(e)
-            print("Retrying...")
-            time.sleep(60)
+    key = (account_id, account_role)
+    with _cache_lock:
+        key_lock = _credential_locks.setdefault(key, threading.Lock())
+    # Only one thread assumes a given role at a time, the others wait and reuse its result.
+    with key_lock:
+        with _cache_lock:
+            credentials = _credential_cache.get(key)
+        if credentials is not None and not credentials_expiring(credentials):
+            return credentials
+
+        sts_client = get_client('sts')
+        role_arn = 'arn:aws:iam::' + account_id + ':role/' + account_role
+        # AccessDenied fails straight away, a new account's role is waited for by the readiness probe in step_create_account().
+        assumedRoleObject = sts_client.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName="NewAccountRole"
+        )
 
-    # From the response that contains the assumed role, return the temporary
-    # credentials that can be used to make subsequent API calls
-    return assumedRoleObject['Credentials']
+        # From the response that contains the assumed role, return the temporary
+        # credentials that can be used to make subsequent API calls
+        credentials = assumedRoleObject['Credentials']
+        with _cache_lock:
+            previous = _credential_cache.get(key)
+            if previous is not None:
+                _credential_owner.pop(previous['AccessKeyId'], None)
+            _credential_cache[key] = credentials
+            _credential_owner[credentials['AccessKeyId']] = key
+            _evict_expired_credentials()
+        return credentials
 
 def attach_policy(rolename,policyarn,credentials):
     # Function to attach a policy to a given role
@@ -72,124 +637,193 @@ def attach_policy(rolename,policyarn,credentials):
     #   account_idpolicyarn:  The policy to attach to the role, specified using the policies AWS ARN value.
     #   rolename: The role NAME to attach the policy to.  Note: Provide the role's name and NOT the ARN value.
 
-    iam_client = boto3.client('iam',aws_access_key_id=credentials['AccessKeyId'],
-                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                  aws_session_token=credentials['SessionToken'])
-    attempt_counter = 1   #Try 3 times, every 30 secs for a maximum of 90 sec. 
-    response="Failure"
-    while attempt_counter <= 3:
-        try:
-            response = iam_client.attach_role_policy(RoleName=rolename,PolicyArn=policyarn)
-            print("Success policy {} to role {} on attempt#{}".format(policyarn,rolename,attempt_counter))
-            print(response)
-            
-        except botocore.exceptions.ClientError as e:    
-            print("Error Occured in attempt #{}, attaching policy to role : {}".format(attempt_counter,e))
-            time.sleep(30)
-        else:
-            attempt_counter = 999
-        attempt_counter += 1
-    return response
+    #   The policy is only attached if it is not attached already.
+    # Returns the list of changes applied, empty if the policy was already attached.
+
+    iam_client = get_client('iam',credentials)
+    (role_arn, changes) = ensure_role(iam_client,{ 'RoleName': rolename, 'ManagedPolicies': [policyarn] })
+    return changes
 
 def bucket_policy(requesttype,account_id,accountrole,bucketname,sid,bucketpolicy):
     # No longer used but provides a means to apply or add to an S3 bucket policy.
     # Design no longer requires this function, but code could be useful in the future.
     credentials = assume_role(account_id, accountrole)
-    s3_client = boto3.client('s3',aws_access_key_id=credentials['AccessKeyId'],
-                    aws_secret_access_key=credentials['SecretAccessKey'],
-                    aws_session_token=credentials['SessionToken'])
+    s3_client = get_client('s3',credentials)
     if (requesttype == "init"):
         # Function call is used for setting the intial bucket policy on bucket creation.
         # Can be used to wipe all policies and reset to a known state.
         # Note SID parameter is unused, and bucket policy must include all AWS S3 policy elements
-        print("--- Applying Initial IaC Bucket Policy ---")
-        attempt_counter = 1   #Try 20 times, every 30 secs for a maximum of 10 min. 
-        while attempt_counter <= 20:
-            try:
-                time.sleep(30)
-                s3response = s3_client.put_bucket_policy(
-                    Bucket=bucketname,
-                    Policy=bucketpolicy
-                )
-            except botocore.exceptions.ClientError as e:
-                print("Error applying policy to Terraform IaC bucket on attempt#{}. Error : {}".format(attempt_counter,e))
-            else:
-                print("Successfully applied policy to Terraform IaC bucket on attempt#{}".format(attempt_counter))
-                return ("success")
-                attempt_counter = 999
-            attempt_counter += 1            
-        return ("error: {}".format(e))
+        wait_until_ready("IaC bucket {}".format(bucketname),lambda: s3_client.get_bucket_location(Bucket=bucketname))
+        try:
+            s3response = s3_client.put_bucket_policy(
+                Bucket=bucketname,
+                Policy=bucketpolicy
+            )
+        except botocore.exceptions.ClientError as e:
+            log_event('bucket_policy', bucket=bucketname, request=requesttype, status='failed', error=str(e))
+            return ("error: {}".format(e))
+        log_event('bucket_policy', bucket=bucketname, request=requesttype, status='applied')
+        return ("success")
     elif (requesttype == "add"):
         # Function call is used for adding additional bucket policy statement blocks to an existing policy
         # for this call bucketpolicy variable is equal to JUST the json statement block element to add in an existing statement list
         # SID Parameter is not used, this should be provided as part of the bucketpolicy json data!  Without it, delete call will not be possible!
-        print("--- Adding to IaC Bucket Policy ---")
         s3policy = s3_client.get_bucket_policy(Bucket=bucketname)
-        print(" existing policy")
-        print(s3policy['Policy'])
-        s3policy = ast.literal_eval(s3policy['Policy'])
+        s3policy = json.loads(s3policy['Policy'])
         s3policy['Statement'].append(json.loads(bucketpolicy))
         s3policy = json.dumps(s3policy)
-        print("New Policy: {}".format(s3policy))
-        print("--- Applying additional IaC Bucket Policy ---")
-        attempt_counter = 1   #Try 20 times, every 30 secs for a maximum of 10 min. 
-        while attempt_counter <= 20:
-            try:
-                s3response = s3_client.put_bucket_policy(
-                    Bucket=bucketname,
-                    Policy=s3policy
-                )
-            except botocore.exceptions.ClientError as e:
-                print("Error applying policy to Terraform IaC bucket on attempt#{}. Error : {}".format(attempt_counter,e))
-                time.sleep(30)
-            else:
-                print("Successfully added policy to Terraform IaC bucket on attempt#{}".format(attempt_counter))
-                return ("success")
-                attempt_counter = 999
-            attempt_counter += 1            
-        return ("error: {}".format(e))
+        try:
+            s3response = s3_client.put_bucket_policy(
+                Bucket=bucketname,
+                Policy=s3policy
+            )
+        except botocore.exceptions.ClientError as e:
+            log_event('bucket_policy', bucket=bucketname, request=requesttype, status='failed', error=str(e))
+            return ("error: {}".format(e))
+        log_event('bucket_policy', bucket=bucketname, request=requesttype, status='applied')
+        return ("success")
 
-def get_client(service):
+def get_client(service,credentials=None,region=None):
     # Function call to standardize boto3 client calls in other areas of code.
-    client = boto3.client(service)
+    #   Clients are cached per account, role, service and region and are safe to share between threads, so each
+    #   connection pool (sized by the shared client_config()) and its TLS sessions are reused for the life of the container.
+    #   A cached client is rebuilt when the credentials passed in have been refreshed by assume_role().
+    #   Clients built from credentials that have expired are dropped when assume_role() next caches credentials.
+    # Parameters:
+    #   service:     The boto3 service name, eg 'iam'.
+    #   credentials: Optional AWS credentials object from assume_role(), the Lambda's own role is used if omitted.
+    #   region:      Optional AWS region name, the Lambda's default region is used if omitted.
+    with _cache_lock:
+        if credentials is None:
+            access_key = None
+            identity = ('self', None)
+        else:
+            access_key = credentials['AccessKeyId']
+            identity = _credential_owner.get(access_key, (access_key, None))
+        key = identity + (service, region)
+        cached = _client_cache.get(key)
+        if cached is not None and cached[0] == access_key:
+            return cached[1]
+        if credentials is None:
+            client = _boto3_session().client(service, region_name=region, config=client_config())
+        else:
+            client = _boto3_session().client(service, region_name=region, config=client_config(),
+                                  aws_access_key_id=credentials['AccessKeyId'],
+                                  aws_secret_access_key=credentials['SecretAccessKey'],
+                                  aws_session_token=credentials['SessionToken'])
+        # The rate limits of rate_limiter() apply per account.
+        client._rate_limit_account = identity[0]
+        _client_cache[key] = (access_key, client, None if credentials is None else credentials_expiration(credentials))
     return client
 
-def create_account(event,accountname,accountemail,accountrole,access_to_billing,scp,root_id):
+def _boto3_session():
+    # Shared boto3 session so service models are loaded once for all cached clients.  Callers must hold _cache_lock.
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+        _session.events.register('creating-client-class', _add_client_mixins)
+        _session.events.register('before-call', _record_call_start)
+        _session.events.register('after-call', _record_call_end)
+        _session.events.register('after-call-error', _record_call_end)
+    return _session
+
+def wait_for_create_account(client,request_id,timeout=600,initial_delay=2,max_delay=20):
+    # Function to poll an AWS Organizations CreateAccount request until it reaches a final state.
+    #   Polls back off exponentially with jitter so fast creations return within seconds while slow ones do not flood
+    #   DescribeCreateAccountStatus and get throttled.  Throttled polls are simply retried on the next interval.
+    # Parameters:
+    #   client:         An AWS organizations boto3 client.
+    #   request_id:     The CreateAccountStatus Id returned by the create_account call.
+    #   timeout:        Seconds to keep polling before giving up.
+    #   initial_delay:  Seconds to wait before the second poll, doubled on each subsequent poll.
+    #   max_delay:      Upper bound in seconds for a single wait between polls.
+    # Returns a tuple of (CreateAccountStatus dictionary, seconds taken).  The State is left IN_PROGRESS if the timeout was reached.
+
+    start = time.time()
+    deadline = start + timeout
+    account_status = {'Id': request_id, 'State': 'IN_PROGRESS'}
+    attempt = 0
+    while True:
+        try:
+            account_status = client.describe_create_account_status(CreateAccountRequestId=request_id)['CreateAccountStatus']
+        except botocore.exceptions.ClientError as e:
+            log_event('account_create_poll_failed', attempt=attempt+1, error=str(e))
+        if account_status['State'] in ('SUCCEEDED','FAILED'):
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        delay = min(max_delay,initial_delay * (2 ** attempt))
+        pause = min(remaining,delay / 2 + random.uniform(0,delay / 2))
+        record_sleep(pause)
+        time.sleep(pause)
+        attempt += 1
+
+    elapsed = round(time.time() - start,2)
+    log_event('account_create_wait', state=account_status['State'], elapsed=elapsed, polls=attempt+1)
+    return (account_status,elapsed)
+
+def create_account(event,accountname,accountemail,accountrole,access_to_billing,scp,root_id,timeout=600,max_poll_delay=20,request_id=None,on_request=None):
     # Function to create a new account in an existing AWS Orgranization.
     # Parameters:
     #   event:        Account creation event type, typically create or destroy.  Only create has been currently coded for.
+    #                 Pass None when not running for cloudformation (batch runs), failures are then only reported by the return value.
     #   accountname:  AWS Account name to give the new account.
     #   accountemail: Email account to register the AWS account, this must be a unique account and cannot be reused.
     #   accountrole:  The name of the role for AWS to provision in the new account that can be used by the master account to gain administrative access.
     #   access_to_billing: A boolean that sets whether it may be possible for a user to view billing information if access granted elsewhere.
     #   scp:          Org Service Control Policy to attach - this functionality has not been coded for yet.
     #   root_id:      Org Account organization tree level - this functionality has not been completely coded for yet.
+    #   timeout:      Seconds to wait for the account creation to complete.
+    #   max_poll_delay: Upper bound in seconds between account creation status polls.
+    #   request_id:   CreateAccountRequestId of an earlier call for this account, the status of that request is polled instead of creating
+    #                 again unless that request failed.
+    #   on_request:   Optional function called with the CreateAccountRequestId before waiting, so it can be checkpointed.
+    # Returns a tuple of (create_account response, new account id).  The account id is None if creation failed, in which case
+    # the cloudformation failure response has already been sent.
        
-    account_id = 'None'
+    account_id = None
     client = get_client('organizations')
     
-    try:
-        print("Trying to create the account with {}".format(accountemail))
-        create_account_response = client.create_account(Email=accountemail, AccountName=accountname,
-                                                        RoleName=accountrole,
-                                                        IamUserAccessToBilling=access_to_billing)
-        time.sleep(40)
-        account_status = client.describe_create_account_status(CreateAccountRequestId=create_account_response['CreateAccountStatus']['Id'])
-        print("Account Creation status: {}".format(account_status['CreateAccountStatus']['State']))
-        if(account_status['CreateAccountStatus']['State'] == 'FAILED'):
-            print("Account Creation Failed. Reason : {}".format(account_status['CreateAccountStatus']['FailureReason']))
-            delete_respond_cloudformation(event, "FAILED", account_status['CreateAccountStatus']['FailureReason'])
+    if request_id is not None:
+        # A request that failed (eg EMAIL_ALREADY_EXISTS) created nothing, it is replaced by a new request with the current parameters.
+        try:
+            previous_status = client.describe_create_account_status(CreateAccountRequestId=request_id)['CreateAccountStatus']
+        except botocore.exceptions.ClientError as e:
+            previous_status = {'State': 'NOT_FOUND'} if e.response['Error']['Code'] == 'CreateAccountStatusNotFoundException' else None
+        if previous_status is not None and previous_status['State'] in ('FAILED', 'NOT_FOUND'):
+            log_event('account_create_replace', request_id=request_id, state=previous_status['State'], reason=previous_status.get('FailureReason'))
+            request_id = None
+    if request_id is not None:
+        # Calling CreateAccount again would start a second account, or fail on the email already in use.
+        log_event('account_create_resume', request_id=request_id)
+        create_account_response = {'CreateAccountStatus': {'Id': request_id, 'State': 'IN_PROGRESS'}}
+    else:
+        try:
+            create_account_response = client.create_account(Email=accountemail, AccountName=accountname,
+                                                            RoleName=accountrole,
+                                                            IamUserAccessToBilling=access_to_billing)
+        except botocore.exceptions.ClientError as e:
+            log_event('account_create_failed', error=str(e))
+            if event is not None:
+                delete_respond_cloudformation(event, "FAILED", "Account Creation Failed. Deleting Lambda Function. {}.".format(e))
+            return(None,account_id)
+        request_id = create_account_response['CreateAccountStatus']['Id']
+        if on_request is not None:
+            on_request(request_id)
 
-    except botocore.exceptions.ClientError as e:
-        print("In the except module. Error : {}".format(e))
-        delete_respond_cloudformation(event, "FAILED", "Account Creation Failed. Deleting Lambda Function." +e+ ".")
-        
-    time.sleep(10)
-    create_account_status_response = client.describe_create_account_status(CreateAccountRequestId=create_account_response.get('CreateAccountStatus').get('Id'))
-    account_id = create_account_status_response.get('CreateAccountStatus').get('AccountId')
-    while(account_id is None ):
-        create_account_status_response = client.describe_create_account_status(CreateAccountRequestId=create_account_response.get('CreateAccountStatus').get('Id'))
-        account_id = create_account_status_response.get('CreateAccountStatus').get('AccountId')
+    (account_status,time_to_ready) = wait_for_create_account(client,request_id,timeout,max_delay=max_poll_delay)
+    if(account_status['State'] == 'SUCCEEDED'):
+        account_id = account_status.get('AccountId')
+        log_event('account_create_status', state='SUCCEEDED', account_id=account_id, elapsed=time_to_ready)
+    elif(account_status['State'] == 'FAILED'):
+        log_event('account_create_status', state='FAILED', reason=account_status.get('FailureReason'), elapsed=time_to_ready)
+        if event is not None:
+            delete_respond_cloudformation(event, "FAILED", account_status.get('FailureReason'))
+    else:
+        log_event('account_create_status', state=account_status['State'], request_id=request_id, elapsed=time_to_ready, error="did not complete within {}s".format(timeout))
+        if event is not None:
+            delete_respond_cloudformation(event, "FAILED", "Account Creation did not complete within {}s. Deleting Lambda Function.".format(timeout))
     #move_response = client.move_account(AccountId=account_id,SourceParentId=root_id,DestinationParentId=organization_unit_id)
     return(create_account_response,account_id)
 
@@ -203,234 +837,455 @@ def create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustp
     #    newrolepolicy:     A string representation of the complete AWS policy to apply to the new IAM role.
     #    newtrustpolicy:    A string representation of the AWS trust policy to assign to the new IAM role.
 
-    iam_client = boto3.client('iam',aws_access_key_id=credentials['AccessKeyId'],
-                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                  aws_session_token=credentials['SessionToken'])
-    print(newrolepolicy)
-    print(newtrustpolicy)
-    
-    attempt_counter = 1   #Try 20 times, every 30 secs for a maximum of 10 min. 
-    while attempt_counter <= 20:
-        try:
-            create_role_response = iam_client.create_role(RoleName=newrole,AssumeRolePolicyDocument=newtrustpolicy,Description=newrole,MaxSessionDuration=3600)
-            print("Success creating new role on attempt#{}".format(attempt_counter))
-            print(create_role_response['Role']['Arn'])
-            
-        except botocore.exceptions.ClientError as e:    
-            print("Error Occured in attempt #{}, creating a role : {}".format(attempt_counter,e))
-            time.sleep(30)
-        else:
-            attempt_counter = 999
-        attempt_counter += 1
-
-    attempt_counter = 1   #Try 20 times, every 30 secs for a maximum of 10 min. 
-    while attempt_counter <= 20:
-        try:
-            update_role_response = iam_client.put_role_policy(RoleName=newrole,PolicyName=newrole,PolicyDocument=newrolepolicy)
-        except botocore.exceptions.ClientError as e:
-            print("Error on attempt# {}, attaching policy to the role : {}".format(attempt_counter,e))
-        else:
-            print("Success on attempt# {}, attaching policy to the role".format(attempt_counter))
-            attempt_counter = 999
-        attempt_counter += 1
+    #   The role's current trust and inline policy are read first and only differences are applied, so re-running against an
+    #   existing account is quick.
+    # Returns the role ARN.
 
-    print("{},{},{}".format(newrole,top_level_account,credentials))
-    return create_role_response['Role']['Arn']
+    iam_client = get_client('iam',credentials)
+    (role_arn, changes) = ensure_role(iam_client,{ 'RoleName': newrole, 'TrustPolicy': newtrustpolicy, 'InlinePolicies': { newrole: newrolepolicy } })
+    return role_arn
 
-def delete_default_vpc(credentials,currentregion):
-    # Function to delete the existing default VPC in a given region within an account.
+def delete_default_vpc(credentials,currentregion,max_workers=4,executor=None,stop=None):
+    # Function to delete the existing default VPC in a given region within an account, with everything in it that would stop it being deleted.
     #   This needs to be called iteratively for each region if its desired to destroy all defualt VPCs and associated security objects.
-    #   Function taken from AWS code sample verbatim, function code is free to distribute with any distribution limitations.
+    #   Use delete_default_vpcs() to sweep many regions concurrently.
+    #   Only the default VPC's own resources are listed, using server side filters.  They are deleted in dependency order, the
+    #   calls of each layer made concurrently: network interfaces, internet gateway detachments, route table associations and
+    #   cross security group rules, then internet gateways, subnets and security groups, then route tables and network ACLs, then the VPC.  A deletion
+    #   refused with DependencyViolation while the previous layer settles is retried by the shared retry policy, see call_with_retry().
+    #   A default VPC with network interfaces in use (eg a running instance) is left in place and reported as an error.
     # Parameters:
     #   credentials:    AWS credential object for the account to destroy default VPCs
     #   currentregion:  The official AWS region name containing the defualt VPC to destroy.
- 
-    ec2_client = boto3.client('ec2',
-                            aws_access_key_id=credentials['AccessKeyId'],
-                            aws_secret_access_key=credentials['SecretAccessKey'],
-                            aws_session_token=credentials['SessionToken'],
-                            region_name=currentregion)
-
-    vpc_response = ec2_client.describe_vpcs()
-    for i in range(0,len(vpc_response['Vpcs'])):
-        if((vpc_response['Vpcs'][i]['InstanceTenancy']) == 'default'):
-            default_vpcid = vpc_response['Vpcs'][0]['VpcId']
-
-    subnet_response = ec2_client.describe_subnets()
-    subnet_delete_response = []
-    default_subnets = []
-    for i in range(0,len(subnet_response['Subnets'])):
-        if(subnet_response['Subnets'][i]['VpcId'] == default_vpcid):
-            default_subnets.append(subnet_response['Subnets'][i]['SubnetId'])
-    for i in range(0,len(default_subnets)):
-        subnet_delete_response.append(ec2_client.delete_subnet(SubnetId=default_subnets[i],DryRun=False))
-    
-    igw_response = ec2_client.describe_internet_gateways()
-    for i in range(0,len(igw_response['InternetGateways'])):
-        for j in range(0,len(igw_response['InternetGateways'][i]['Attachments'])):
-            if(igw_response['InternetGateways'][i]['Attachments'][j]['VpcId'] == default_vpcid):
-                default_igw = igw_response['InternetGateways'][i]['InternetGatewayId']
+    #   max_workers:    Number of calls made concurrently within a layer, when no executor is given.
+    #   executor:       Optional thread pool shared with other regions to make the calls of each layer on, see delete_default_vpcs().
+    #   stop:           Optional threading.Event, once set no further layer is started and ProvisioningError is raised.
+    # Returns None if the region has no default VPC, otherwise a dictionary with the deleted 'VpcIds' and the number of each kind of resource deleted.
 
-    try:
-        detach_default_igw_response = ec2_client.detach_internet_gateway(InternetGatewayId=default_igw,VpcId=default_vpcid,DryRun=False)
-        delete_internet_gateway_response = ec2_client.delete_internet_gateway(InternetGatewayId=default_igw)
-        time.sleep(10)
-        delete_vpc_response = ec2_client.delete_vpc(VpcId=default_vpcid,DryRun=False)
-        print("Deleted Default VPC in {}".format(currentregion))
+    ec2_client = get_client('ec2',credentials,currentregion)
+
+    def describe(operation, key, filters):
+        return [item for page in ec2_client.get_paginator(operation).paginate(Filters=filters) for item in page[key]]
 
+    vpcids = [vpc['VpcId'] for vpc in describe('describe_vpcs', 'Vpcs', [{'Name': 'isDefault', 'Values': ['true']}])]
+    if not vpcids:
+        log_event('default_vpc', region=currentregion, status='none')
+        return None
+
+    deleted = { 'VpcIds': vpcids, 'NetworkInterfaces': 0, 'InternetGateways': 0, 'Subnets': 0, 'SecurityGroups': 0, 'RouteTables': 0, 'NetworkAcls': 0 }
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,int(max_workers)))
+
+    def run_layer(calls):
+        # Make a layer's (kind, call, arguments) calls concurrently, raising the first error once all have finished.
+        if stop is not None and stop.is_set():
+            raise ProvisioningError("Default VPC deletion in {} stopped before completing".format(currentregion))
+        futures = [(kind, executor.submit(in_log_context(call), **kwargs)) for (kind, call, kwargs) in calls]
+        errors = [future.exception() for (kind, future) in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        for (kind, future) in futures:
+            if kind is not None:
+                deleted[kind] += 1
+        return [future.result() for (kind, future) in futures]
+
+    try:
+        for vpcid in vpcids:
+            vpc_filter = [{'Name': 'vpc-id', 'Values': [vpcid]}]
+            (interfaces, gateways, subnets, groups, tables, acls) = run_layer([
+                (None, describe, { 'operation': 'describe_network_interfaces', 'key': 'NetworkInterfaces', 'filters': vpc_filter }),
+                (None, describe, { 'operation': 'describe_internet_gateways', 'key': 'InternetGateways', 'filters': [{'Name': 'attachment.vpc-id', 'Values': [vpcid]}] }),
+                (None, describe, { 'operation': 'describe_subnets', 'key': 'Subnets', 'filters': vpc_filter }),
+                (None, describe, { 'operation': 'describe_security_groups', 'key': 'SecurityGroups', 'filters': vpc_filter }),
+                (None, describe, { 'operation': 'describe_route_tables', 'key': 'RouteTables', 'filters': vpc_filter }),
+                (None, describe, { 'operation': 'describe_network_acls', 'key': 'NetworkAcls', 'filters': vpc_filter })
+            ])
+            in_use = [interface['NetworkInterfaceId'] for interface in interfaces if interface['Status'] != 'available']
+            if in_use:
+                raise ProvisioningError("Default VPC {} in {} has network interfaces in use: {}".format(vpcid,currentregion,", ".join(in_use)))
+            # The default security group, main route table and default network ACL are deleted along with the VPC.
+            groupids = set(group['GroupId'] for group in groups if group['GroupName'] != 'default')
+            layer = [('NetworkInterfaces', ec2_client.delete_network_interface, { 'NetworkInterfaceId': interface['NetworkInterfaceId'] }) for interface in interfaces]
+            layer.extend((None, ec2_client.detach_internet_gateway, { 'InternetGatewayId': gateway['InternetGatewayId'], 'VpcId': vpcid }) for gateway in gateways)
+            layer.extend((None, ec2_client.disassociate_route_table, { 'AssociationId': association['RouteTableAssociationId'] })
+                         for table in tables for association in table.get('Associations', []) if not association.get('Main') and association.get('SubnetId'))
+            for group in groups:
+                # Rules naming a security group about to be deleted would stop it being deleted.
+                for (call, key) in ((ec2_client.revoke_security_group_ingress, 'IpPermissions'), (ec2_client.revoke_security_group_egress, 'IpPermissionsEgress')):
+                    permissions = [permission for permission in group.get(key, []) if any(pair.get('GroupId') in groupids for pair in permission.get('UserIdGroupPairs', []))]
+                    if permissions:
+                        layer.append((None, call, { 'GroupId': group['GroupId'], 'IpPermissions': permissions }))
+            run_layer(layer)
+            layer = [('InternetGateways', ec2_client.delete_internet_gateway, { 'InternetGatewayId': gateway['InternetGatewayId'] }) for gateway in gateways]
+            layer.extend(('Subnets', ec2_client.delete_subnet, { 'SubnetId': subnet['SubnetId'] }) for subnet in subnets)
+            layer.extend(('SecurityGroups', ec2_client.delete_security_group, { 'GroupId': groupid }) for groupid in sorted(groupids))
+            run_layer(layer)
+            layer = [('RouteTables', ec2_client.delete_route_table, { 'RouteTableId': table['RouteTableId'] })
+                     for table in tables if not any(association.get('Main') for association in table.get('Associations', []))]
+            layer.extend(('NetworkAcls', ec2_client.delete_network_acl, { 'NetworkAclId': acl['NetworkAclId'] }) for acl in acls if not acl['IsDefault'])
+            run_layer(layer)
+            ec2_client.delete_vpc(VpcId=vpcid)
+            log_event('default_vpc', region=currentregion, vpc=vpcid, status='deleted')
     except botocore.exceptions.ClientError as e:
-        print(e)
+        log_event('default_vpc', region=currentregion, status='failed', error=str(e))
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
 
-    return delete_vpc_response    
+    return deleted
 
-def get_ou_name_id(root_id,organization_unit_name):
-    # Function checks for the existence of an AWS organization OU group name, creating it if non-existent.
+def delete_default_vpcs(credentials,regions,max_workers=8,region_timeout=120,sweep_timeout=300,layer_workers=4):
+    # Function to delete the default VPC in many regions at once by fanning delete_default_vpc() out over one thread pool.
+    #   At most max_workers regions run at a time, and the calls of their layers share the pool's other layer_workers threads,
+    #   so the number of threads is bounded however many regions are swept.  A region running past region_timeout, or every
+    #   region still running at sweep_timeout, is told to stop and finishes the layer it is in (its calls are bounded by the
+    #   retry deadline), so no worker is left deleting in the background once the sweep returns.  Regions stopped or never
+    #   started are reported as a timeout.
     # Parameters:
-    #   root_id:                The AWS root organization Identifier of the master account.
-    #   organization_unit_name: The name of the org unit to create or retrieve if already in existence.
+    #   credentials:    AWS credential object for the account to destroy default VPCs
+    #   regions:        List of official AWS region names to sweep.
+    #   max_workers:    Number of regions processed concurrently.  A value of 1 gives the historic one-region-at-a-time behaviour.
+    #   region_timeout: Seconds a single region may run before it is stopped.
+    #   sweep_timeout:  Seconds after which every region still running is stopped and no further region is started.
+    #   layer_workers:  Threads shared by the regions for the calls of each deletion layer.
+    # Returns a dictionary keyed by region name of {'status': 'success'|'failed'|'timeout', 'elapsed': seconds, 'error': message or None}
 
-    ou_client = get_client('organizations')
-    list_of_OU_ids = []
-    list_of_OU_names = []
-    ou_name_to_id = {}
+    results = {}
+    started = {}
+    stops = {}
+    stopped = set()
+    queued = list(regions)
+    running = {}
+    sweep_start = time.time()
+    sweep_deadline = sweep_start + sweep_timeout
+    region_workers = max(1,int(max_workers))
+    # Region workers wait on their layer calls, the pool always has layer_workers threads more than there can be regions running.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=region_workers + max(1,int(layer_workers)))
 
-    list_of_OUs_response = ou_client.list_organizational_units_for_parent(ParentId=root_id)
-    
-    for i in list_of_OUs_response['OrganizationalUnits']:
-        list_of_OU_ids.append(i['Id'])
-        list_of_OU_names.append(i['Name'])
-        
-    if(organization_unit_name not in list_of_OU_names):
-        print("The provided Organization Unit Name doesnt exist. Creating an OU named: {}".format(organization_unit_name))
-        try:
-            ou_creation_response = ou_client.create_organizational_unit(ParentId=root_id,Name=organization_unit_name)
-            for k,v in ou_creation_response.items():
-                for k1,v1 in v.items():
-                    if(k1 == 'Name'):
-                        organization_unit_name = v1
-                    if(k1 == 'Id'):
-                        organization_unit_id = v1
-        except botocore.exceptions.ClientError as e:
-            print("Error in creating the OU: {}".format(e))
-            respond_cloudformation(event, "FAILED", { "Message": "Could not list out AWS Organization OUs. Account creation Aborted."})
+    def start_regions():
+        while queued and len(running) < region_workers and time.time() < sweep_deadline:
+            region = queued.pop(0)
+            stops[region] = threading.Event()
+            started[region] = time.time()
+            running[executor.submit(in_log_context(delete_default_vpc),credentials,region,layer_workers,executor,stops[region])] = region
 
-    else:
-        for i in range(len(list_of_OU_names)):
-            ou_name_to_id[list_of_OU_names[i]] = list_of_OU_ids[i]
-        organization_unit_id = ou_name_to_id[organization_unit_name]
-    
-    return(organization_unit_name,organization_unit_id)
+    def stop(region, error):
+        stops[region].set()
+        stopped.add(region)
+        results[region] = {'status': 'timeout', 'elapsed': None, 'error': error}
+
+    try:
+        start_regions()
+        while running and time.time() < sweep_deadline:
+            (done, _) = concurrent.futures.wait(list(running),timeout=min(1.0,sweep_deadline-time.time()),return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                region = running.pop(future)
+                elapsed = round(time.time()-started[region],2)
+                error = future.exception()
+                if error is None:
+                    results[region] = {'status': 'success', 'elapsed': elapsed, 'error': None}
+                elif region in stopped:
+                    results[region]['elapsed'] = elapsed
+                else:
+                    results[region] = {'status': 'failed', 'elapsed': elapsed, 'error': str(error)}
+            now = time.time()
+            for region in running.values():
+                if region not in stopped and now-started[region] > region_timeout:
+                    stop(region, "Region exceeded {}s timeout".format(region_timeout))
+            start_regions()
+        for region in running.values():
+            if region not in stopped:
+                stop(region, "Default VPC sweep exceeded {}s timeout".format(sweep_timeout))
+    finally:
+        for stop_event in stops.values():
+            stop_event.set()
+        executor.shutdown(wait=True)
+    for (future, region) in running.items():
+        results[region]['elapsed'] = round(time.time()-started[region],2)
+        if future.exception() is None:
+            results[region] = {'status': 'success', 'elapsed': results[region]['elapsed'], 'error': None}
+    for region in queued:
+        results[region] = {'status': 'timeout', 'elapsed': 0, 'error': "Not started within the {}s sweep timeout".format(sweep_timeout)}
+
+    log_event('default_vpc_sweep', regions=len(regions), elapsed=round(time.time()-sweep_start,2), results=results)
+    return results
+
+def get_ou_name_id(root_id,organization_unit_name):
+    # Function checks for the existence of an AWS organization OU group name, creating it if non-existent.
+    #   Looked up in (and added to) the organization tree index, see OrganizationTree.
+    # Parameters:
+    #   root_id:                The AWS root organization Identifier of the master account, kept for compatibility as the index knows the root.
+    #   organization_unit_name: The name, or path such as Hubs/Prod/hubname, of the org unit to create or retrieve if already in existence.
+    # Raises botocore ClientError when the OU cannot be listed or created.
+
+    organization_unit_id = organization_tree().ensure_path(organization_unit_name)
+    return(organization_unit_name.strip('/').split('/')[-1],organization_unit_id)
 
 def get_template(sourcebucket,baselinetemplate):
     # Function to retrieve the policy of an existing S3 bucket.
     #   Function is no longer used by project but code left in for potential future usage.
 
-    s3 = boto3.resource('s3')
+    s3_client = get_client('s3')
     try:
-        obj = s3.Object(sourcebucket,baselinetemplate)
-        return obj.get()['Body'].read().decode('utf-8') 
+        return s3_client.get_object(Bucket=sourcebucket,Key=baselinetemplate)['Body'].read().decode('utf-8') 
     except botocore.exceptions.ClientError as e:
-        print("Error accessing the source bucket. Error : {}".format(e))
+        log_event('baseline_template', bucket=sourcebucket, key=baselinetemplate, status='failed', error=str(e))
         return e
 
 def selfinvoke(event,status):
     # Function to handle Service Catalog based lambda initialization.
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_client('lambda')
     function_name = os.environ['AWS_LAMBDA_FUNCTION_NAME']
     event['RequestType'] = status
-    print('invoking itself ' + function_name)
+    log_event('selfinvoke', function=function_name, request_type=status)
     response = lambda_client.invoke(FunctionName=function_name, InvocationType='Event',Payload=json.dumps(event))
 
-def respond_cloudformation(event, status, data=None):
+def response_pool():
+    # Function returning the urllib3 pool manager cloudformation responses are sent with, kept for the life of the Lambda
+    #   container so a warm container reuses its connection.  Each attempt is bounded by the response_connect_timeout and
+    #   response_read_timeout settings and failed attempts are retried response_retries times with backoff, so a slow or
+    #   unreachable ResponseURL cannot hold the Lambda until it times out.
+    global _response_pool
+    if _response_pool is None:
+        import urllib3
+        config = read_config()
+        retries = config.getint('Performance', 'response_retries', fallback=3)
+        retry_options = { 'total': retries, 'backoff_factor': 0.5, 'status_forcelist': (429, 500, 502, 503, 504), 'raise_on_status': False }
+        try:
+            retry = urllib3.Retry(allowed_methods=frozenset(['PUT']), **retry_options)
+        except TypeError:
+            # urllib3 before 1.26 names the retried methods method_whitelist.
+            retry = urllib3.Retry(method_whitelist=frozenset(['PUT']), **retry_options)
+        timeout = urllib3.Timeout(connect=config.getfloat('Performance', 'response_connect_timeout', fallback=5),
+                                  read=config.getfloat('Performance', 'response_read_timeout', fallback=10))
+        _response_pool = urllib3.PoolManager(num_pools=2, maxsize=2, timeout=timeout, retries=retry)
+    return _response_pool
+
+def send_cloudformation_response(event, responseBody):
+    # Function to PUT a custom resource response to the pre-signed cloudformation ResponseURL of the event.
+    #   Failures are logged rather than raised, the Lambda carries on either way.
+    # Returns the HTTP status of the response, None if it could not be sent.
+    import urllib3
+    body = json.dumps(responseBody)
+    start = time.time()
+    try:
+        # The pre-signed URL is signed for an empty content type.
+        response = response_pool().request('PUT', event['ResponseURL'], body=body, headers={ 'Content-Type': '', 'Content-Length': str(len(body)) })
+    except urllib3.exceptions.HTTPError as e:
+        log_event('cloudformation_response', status='failed', elapsed=round(time.time()-start,2), error=str(e))
+        return None
+    if response.status != 200:
+        log_event('cloudformation_response', status='rejected', http_status=response.status, elapsed=round(time.time()-start,2),
+                  error=response.data[:200].decode('utf-8', 'replace'))
+    return response.status
+
+def respond_cloudformation(event, status, data=None, physical_resource_id=None):
     # Function to handle Service Catalog based cloudformation events.
+    #   The resource keeps the physical id of the request it is updating or deleting, a created account is identified by its
+    #   account id (stacks created before that by the Lambda ARN), so an Update knows the account it applies to.
     responseBody = {
         'Status': status,
         'Reason': 'See the details in CloudWatch Log Stream',
-        'PhysicalResourceId': event['ServiceToken'],
+        'PhysicalResourceId': physical_resource_id or event.get('PhysicalResourceId', event['ServiceToken']),
         'StackId': event['StackId'],
         'RequestId': event['RequestId'],
         'LogicalResourceId': event['LogicalResourceId'],
         'Data': data
     }
 
-    print('Response = ' + json.dumps(responseBody))
-    print(event)
-    requests.put(event['ResponseURL'], data=json.dumps(responseBody))
+    log_event('cloudformation_response', response=responseBody, request=event)
+    send_cloudformation_response(event, responseBody)
 
 def delete_respond_cloudformation(event, status, message):
     # Function to handle Service Catalog based cloudformation events.
     responseBody = {
         'Status': status,
         'Reason': message,
-        'PhysicalResourceId': event['ServiceToken'],
+        'PhysicalResourceId': event.get('PhysicalResourceId', event['ServiceToken']),
         'StackId': event['StackId'],
         'RequestId': event['RequestId'],
         'LogicalResourceId': event['LogicalResourceId']
     }
 
-    requests.put(event['ResponseURL'], data=json.dumps(responseBody))
+    send_cloudformation_response(event, responseBody)
     lambda_client = get_client('lambda')
     function_name = os.environ['AWS_LAMBDA_FUNCTION_NAME']
-    print('Deleting resources and rolling back the stack.')
+    log_event('self_delete', function=function_name)
     lambda_client.delete_function(FunctionName=function_name)
-    #requests.put(event['ResponseURL'], data=json.dumps(responseBody))
-    
-def role_inlinepolicy(requestype,credentials,awsrolename,policyname,awsrolepolicy):
-    # Function to create a new, or replace an existing inline IAM role policy.
-    # Parameters:
-    #   requestype:     Type of action being requested, currently only "Add" supported.
-    #   credentials:    AWS credentials object for the account housing the existing role to be modified.
-    #   awsrolename:    The AWS role name to be modified, this is the name and NOT ARN value.
-    #   policyname:     The inline policy name to create or overwrite.
-    #   awsrolepolicy:  A string representation of a complete AWS IAM Role policy to attach inline.
-    iam_client = boto3.client('iam',aws_access_key_id=credentials['AccessKeyId'],
-                                    aws_secret_access_key=credentials['SecretAccessKey'],
-                                    aws_session_token=credentials['SessionToken'])
-    if (requestype == "add"):
-        print("--- Adding to IAM policy ---")
-        attempt_counter = 1   #Try 20 times, every 30 secs for a maximum of 10 min. 
-        while attempt_counter <= 20:
-            try:
-                update_role_response = iam_client.put_role_policy(RoleName=awsrolename,PolicyName=policyname,PolicyDocument=awsrolepolicy)
-            except botocore.exceptions.ClientError as e:
-                print("Error on attempt# {}, attaching policy to the role : {}".format(attempt_counter,e))
-            else:
-                print("Success on attempt# {}, attaching policy to the role".format(attempt_counter))
-                attempt_counter = 999
-            attempt_counter += 1
-        return update_role_response
     
-def create_awsprovider_file(accountrole,region,iac_account_id,rolearn,parenthub,accountname,deploytype):
-    # Function call is used for creating the special Terraform AWS provider file for a particular environment.
+def provider_templates():
+    # Function to return the Terraform AWS provider file templates, read from the templates directory once per Lambda container.
+    #   templates/awsprovider.template holds the backend and default provider, templates/awsprovider_region.template the
+    #   provider alias block repeated for each region, returned without its final newline as the blocks are joined by newlines.
+    global _provider_templates
+    if _provider_templates is None:
+        with open('templates/awsprovider.template', 'r') as template_file:
+            provider = template_file.read()
+        with open('templates/awsprovider_region.template', 'r') as template_file:
+            region = template_file.read().rstrip('\n')
+        _provider_templates = (provider, region)
+    return _provider_templates
+
+def render_provider_files(region,iac_account_id,account_id,accountname,regions):
+    # Function to render the build and release Terraform AWS provider files for an account in one pass.
     # Parameters:
-    #  accountrole      = AWS credentials needed to assume access to IaC Bucket account.
     #  region           = The default AWS provider region, passed from the AWS confgi service user specified parameter.
     #  iac_account_id   = The AWS iac special account id.
-    #  account_id       = The AWS environment account being created.
-    #  rolearn          = The terraform ARN role to pass into the provider file (and grant access).
+    #  account_id       = The AWS environment account being created, whose terraform_reader (build) and terraform_writer (release) roles are used.
+    #  accountname      = The AWS account name, which equates to the environment name being created.
+    #  regions          = Region names to generate a provider alias block for, normally every region enabled for the account.
+    # Returns a dictionary keyed by deploytype ("build", "release") of the provider file contents.
+    (provider, region_provider) = provider_templates()
+    files = {}
+    for (deploytype, rolename) in (("build", "terraform_reader"), ("release", "terraform_writer")):
+        rolearn = "arn:aws:iam::{}:role/{}".format(account_id,rolename)
+        region_providers = "\n".join(region_provider.format(alias_region=alias_region,rolearn=rolearn,deploytype=deploytype)
+                                     for alias_region in sorted(regions))
+        files[deploytype] = provider.format(
+            iac_account_id=iac_account_id,
+            accountname=accountname,
+            region=region,
+            rolearn=rolearn,
+            deploytype=deploytype,
+            region_providers=region_providers
+        )
+    return files
+
+def provider_file_key(accountname,deploytype):
+    # Function returning the hub bucket key of an account's Terraform AWS provider file.
+    return 'providers/'+accountname+'/tf_awsprovider-'+accountname+'_{dtype}.tf'.format(dtype=deploytype)
+
+def upload_provider_files(accountrole,iac_account_id,parenthub,accountname,files):
+    # Function to upload an account's rendered provider files to its hub bucket in the IaC account concurrently.
+    # Parameters:
+    #  accountrole      = AWS credentials needed to assume access to IaC Bucket account.
+    #  iac_account_id   = The AWS iac special account id.
     #  parenthub        = The hub environment name this account is attached to, or the hubname if the account is the hub.
     #  accountname      = The AWS account name, which equates to the environment name being created.
-    #  deploytype       = Are you creating the build role or deploy role aws provider file?
-
-    providercontent = open('templates/awsprovider.template', 'r').read()
-    providercontent = providercontent.format(
-        iac_account_id=iac_account_id,
-        accountname=accountname,
-        region=region,
-        rolearn=rolearn,
-        deploytype=deploytype
-    )
+    #  files            = Dictionary keyed by deploytype of file contents, from render_provider_files().
+    # Returns a dictionary keyed by deploytype of True if the file was uploaded, False otherwise.
+    s3_client = get_client('s3',assume_role(iac_account_id, accountrole))
+
+    def upload(deploytype):
+        try:
+            s3_client.put_object(Bucket='yourcompanynameORcustomprefix-iac-'+parenthub, Key=provider_file_key(accountname,deploytype), Body=files[deploytype])
+        except botocore.exceptions.ClientError as e:
+            log_event('provider_file', key=provider_file_key(accountname,deploytype), status='failed', error=str(e))
+            return False
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,len(files))) as executor:
+        results = dict(zip(files, executor.map(in_log_context(upload), files)))
+    return results
+
+HUB_BUCKET_PREFIX = 'yourcompanynameORcustomprefix-iac-'
 
-    credentials = assume_role(iac_account_id, accountrole)
-    s3_client = boto3.resource('s3',aws_access_key_id=credentials['AccessKeyId'],
-                    aws_secret_access_key=credentials['SecretAccessKey'],
-                    aws_session_token=credentials['SessionToken'])
+def hub_buckets(s3_client,hubs=None):
+    # Function returning the names of the hub buckets of the given hub names, or of every hub bucket in the IaC account.
+    if hubs:
+        return [HUB_BUCKET_PREFIX + hub for hub in hubs]
+    return [bucket['Name'] for bucket in s3_client.list_buckets()['Buckets'] if bucket['Name'].startswith(HUB_BUCKET_PREFIX) and bucket['Name'] != HUB_BUCKET_PREFIX + 'master']
+
+def list_provider_files(s3_client,bucket):
+    # Function returning {accountname: {deploytype: etag}} of the Terraform provider files under providers/ in a hub bucket,
+    #   which lists every account attached to the hub.
+    pattern = re.compile(r'^providers/([^/]+)/tf_awsprovider-\1_(build|release)\.tf$')
+    accounts = {}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix='providers/'):
+        for item in page.get('Contents', []):
+            match = pattern.match(item['Key'])
+            if match is not None:
+                accounts.setdefault(match.group(1), {})[match.group(2)] = item['ETag'].strip('"')
+    return accounts
+
+def reconcile_provider_files(settings,iac_account_id,accountrole,sourcebucket,hubs=None,specs=None,dry_run=False):
+    # Function to bring every account's Terraform AWS provider files in the hub buckets up to date with the current templates
+    #   and enabled regions, for example after templates/awsprovider.template changes or a region is enabled.
+    #   Hub buckets are listed concurrently, the expected files of each account found under providers/ are rendered and
+    #   their MD5 compared with the listed ETag, and only the files that differ (or are missing) are uploaded, concurrently
+    #   on reconcile_workers threads.  Account ids come from the organization's account inventory, see account_inventory().
+    # Parameters:
+    #   settings:       Settings dictionary from load_settings().
+    #   iac_account_id: The AWS iac special account id holding the hub buckets.
+    #   accountrole:    The role assumed in the IaC account.
+    #   sourcebucket:   The master bucket holding the cached region map, see region_az_map().
+    #   hubs:           Optional list of hub names to reconcile, every yourcompanynameORcustomprefix-iac-* bucket otherwise.
+    #   specs:          Optional account request parameters (eg from load_manifest()) giving each account's default region,
+    #                   for accounts not listed the region is read from their existing build provider file.
+    #   dry_run:        Report what would be uploaded without uploading.
+    # Returns a report dictionary with the counts of accounts and files checked and unchanged, and the lists of updated
+    #   (or to be updated) file keys, accounts skipped with the reason, and upload errors.
+    start = time.time()
+    s3_client = get_client('s3',assume_role(iac_account_id, accountrole))
+    buckets = hub_buckets(s3_client,hubs)
+    regions = region_az_map(settings,sourcebucket)
+    inventory = account_inventory(settings)
+    stackregions = dict((spec['accountname'], spec['stackregion']) for spec in specs or [])
+    report = { 'buckets': len(buckets), 'accounts': 0, 'files': 0, 'unchanged': 0, 'updated': [], 'skipped': {}, 'errors': {} }
+
+    def default_region(bucket, accountname):
+        if accountname in stackregions:
+            return stackregions[accountname]
+        content = s3_client.get_object(Bucket=bucket, Key=provider_file_key(accountname,'build'))['Body'].read().decode('utf-8')
+        match = re.search(r'^region\s*=\s*"([^"]+)"', content, re.M)
+        return match.group(1) if match else None
+
+    def check_account(bucket, accountname, etags):
+        # Returns a list of (bucket, key, content) to upload, or the reason the account was skipped.
+        account_id = inventory.find_name(accountname)
+        if account_id is None:
+            return "no account named {} in the organization".format(accountname)
+        region = default_region(bucket, accountname)
+        if region is None:
+            return "default region not found in its build provider file"
+        files = render_provider_files(region,iac_account_id,account_id,accountname,regions)
+        return [(bucket, provider_file_key(accountname,deploytype), content) for (deploytype, content) in sorted(files.items())
+                if etags.get(deploytype) != hashlib.md5(content.encode('utf-8')).hexdigest()]
+
+    def upload(item):
+        (bucket, key, content) = item
+        s3_client.put_object(Bucket=bucket, Key=key, Body=content)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,settings['reconcile_workers']))
     try:
-        response = s3_client.Object('yourcompanynameORcustomprefix-iac-'+parenthub, 'providers/'+accountname+'/tf_awsprovider-'+accountname+'_{dtype}.tf'.format(dtype=deploytype)).put(Body=providercontent)
-    except botocore.exceptions.ClientError as e:
-        print("Error creating AWS Provider file.  Error: {}".format(e))
-        return False
-    return True
+        listings = dict(zip(buckets, executor.map(lambda bucket: list_provider_files(s3_client,bucket), buckets)))
+        checks = {}
+        for (bucket, accounts) in listings.items():
+            for (accountname, etags) in accounts.items():
+                checks[executor.submit(check_account, bucket, accountname, etags)] = (bucket, accountname)
+                report['accounts'] += 1
+                report['files'] += 2
+        changed = []
+        for future in concurrent.futures.as_completed(checks):
+            (bucket, accountname) = checks[future]
+            try:
+                result = future.result()
+            except botocore.exceptions.ClientError as e:
+                result = str(e)
+            if isinstance(result, list):
+                changed.extend(result)
+            else:
+                report['skipped'][bucket + '/' + accountname] = result
+        report['unchanged'] = report['files'] - len(changed) - 2 * len(report['skipped'])
+        changed.sort()
+        if not dry_run:
+            uploads = dict((executor.submit(upload, item), item) for item in changed)
+            for future in concurrent.futures.as_completed(uploads):
+                (bucket, key, content) = uploads[future]
+                try:
+                    future.result()
+                except botocore.exceptions.ClientError as e:
+                    report['errors'][bucket + '/' + key] = str(e)
+        report['updated'] = [bucket + '/' + key for (bucket, key, content) in changed if bucket + '/' + key not in report['errors']]
+    finally:
+        executor.shutdown(wait=True)
+
+    report['elapsed'] = round(time.time() - start,2)
+    log_event('provider_reconcile', dry_run=dry_run, buckets=report['buckets'], accounts=report['accounts'], files=report['files'],
+              unchanged=report['unchanged'], updated=len(report['updated']), skipped=len(report['skipped']), errors=len(report['errors']), elapsed=report['elapsed'])
+    return report
 
 def create_instanceprofilerole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy):
     # Function to create an EC2 instance Profile Launch role.  
@@ -443,436 +1298,2662 @@ def create_instanceprofilerole(newrole,top_level_account,credentials,newrolepoli
     #   credentials:        AWS credentials object for the account to create the EC2 profile instance role.
     #   newrolepolicy:      The IAM policy to assign to the profile role.  This is a string presentation of the JSON policy code!
     #   newtrustpolicy:     The IAM trust policy to assign to the profile role.  This is a string presentation of the JSON policy code!
-    iam_client = boto3.client('iam',aws_access_key_id=credentials['AccessKeyId'],
-                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                  aws_session_token=credentials['SessionToken'])
-    # Create an AWS EC2 Instance Profile Launch Role
-    try:
-        response = iam_client.create_instance_profile(InstanceProfileName=newrole)
-    except botocore.exceptions.ClientError as e:
-        print("Error creating the specified profile launch role. Error : {}".format(e))
-    
-    # Call function to create a matching AWS IAM Role
-    try:
-        newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
-    except botocore.exceptions.ClientError as e:
-        print("Error creating the specified role. Error : {}".format(e))
-        newrole_arn = "arn:aws:iam::"+iac_account_id+":role/"+newrole
+    #   The role, its policies and the instance profile are only created or updated where they differ from what is requested.
+    # Returns the role ARN.
+    iam_client = get_client('iam',credentials)
+    (role_arn, changes) = ensure_role(iam_client,{ 'RoleName': newrole, 'TrustPolicy': newtrustpolicy, 'InlinePolicies': { newrole: newrolepolicy }, 'InstanceProfile': True })
+    return role_arn
+
+def normalize_policy(policy):
+    # Function returning a canonical JSON string for an IAM policy document so equivalent documents compare equal.
+    #   Accepts a dictionary, a JSON string or the URL encoded JSON returned by some IAM calls.  Single statements, actions,
+    #   resources and principals are treated the same as one element lists, and list order is ignored.
+    if policy is None:
+        return None
+    if not isinstance(policy, dict):
+        policy = policy.strip()
+        if not policy.startswith('{'):
+            policy = urllib.parse.unquote(policy)
+        policy = json.loads(policy)
 
-    #Attach role to instance profile role
+    def canonical(value, key=None):
+        if key in ('Statement', 'Action', 'NotAction', 'Resource', 'NotResource', 'AWS', 'Service', 'Federated'):
+            values = value if isinstance(value, list) else [value]
+            return sorted((canonical(v) for v in values), key=lambda v: json.dumps(v, sort_keys=True))
+        if isinstance(value, dict):
+            return dict((k, canonical(v, k)) for (k, v) in value.items())
+        if isinstance(value, list):
+            return [canonical(v) for v in value]
+        return value
+
+    return json.dumps(canonical(policy), sort_keys=True)
+
+def get_role_state(iam_client,rolename):
+    # Function to read the current state of an IAM role so only the differences from the desired state need to be applied.
+    # Parameters:
+    #   iam_client: An IAM boto3 client for the account housing the role.
+    #   rolename:   The role NAME to read.
+    # Returns None if the role does not exist, otherwise a dictionary with keys:
+    #   Arn, TrustPolicy, InlinePolicies (policy name to document), ManagedPolicies (set of ARNs), InstanceProfiles (set of names)
     try:
-        response = iam_client.add_role_to_instance_profile(InstanceProfileName=newrole,RoleName=newrole)
+        role = iam_client.get_role(RoleName=rolename)['Role']
     except botocore.exceptions.ClientError as e:
-        print("Error associating role to instance profile role. Error : {}".format(e))
-        newrole_arn = None
-    return (response)
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return None
+        raise
+    state = { 'Arn': role['Arn'], 'TrustPolicy': role.get('AssumeRolePolicyDocument'),
+              'InlinePolicies': {}, 'ManagedPolicies': set(), 'InstanceProfiles': set() }
+    for page in iam_client.get_paginator('list_role_policies').paginate(RoleName=rolename):
+        for policyname in page['PolicyNames']:
+            state['InlinePolicies'][policyname] = iam_client.get_role_policy(RoleName=rolename,PolicyName=policyname)['PolicyDocument']
+    for page in iam_client.get_paginator('list_attached_role_policies').paginate(RoleName=rolename):
+        for policy in page['AttachedPolicies']:
+            state['ManagedPolicies'].add(policy['PolicyArn'])
+    for page in iam_client.get_paginator('list_instance_profiles_for_role').paginate(RoleName=rolename):
+        for profile in page['InstanceProfiles']:
+            state['InstanceProfiles'].add(profile['InstanceProfileName'])
+    return state
 
-def main(event,context):
-    # Main function branch of Bootstrapper account creation code.
-    # Only the "Create" Service Catalog/Cloudformation event is handled in code at this time.
-    # Parameters are read from two sources, 
-    #   in the first block these variables are read from environment variables set from cloudformation Service Catalog product.
-    #   in the second block the variables are read from a bootstrapper.ini file included as part of the bootstrapper Service Catalog solution.
-    
-    print(event)
-    client = get_client('organizations')
-    accountname = os.environ['accountname']
-    accountemail = os.environ['accountemail']
-    parenthub = os.environ['parenthub']
-    ishub = os.environ['ishub']
-    accountrole = 'OrganizationAccountAccessRole'
-    iac_account_id = os.environ['iac_account_id']
-    stackname = os.environ['stackname']
-    stackregion = os.environ['stackregion']
-    sourcebucket = os.environ['sourcebucket']
-    removedefaultvpc = os.environ['removedefaultvpc']
+def role_changes(current,desired):
+    # Function to work out the IAM calls needed to bring a role from its current state to the desired state.
+    # Parameters:
+    #   current: The role state from get_role_state(), None if the role does not exist.
+    #   desired: Dictionary with the RoleName and any of TrustPolicy, InlinePolicies (policy name to document),
+    #            ManagedPolicies (list of ARNs) and InstanceProfile (True to have a same named instance profile).
+    #            Keys left out are not checked.
+    # Returns a list of (change, target) tuples in the order they must be applied, an empty list when nothing differs.
+    rolename = desired['RoleName']
+    changes = []
+    if current is None:
+        changes.append(('create_role', rolename))
+        current = { 'TrustPolicy': desired.get('TrustPolicy'), 'InlinePolicies': {}, 'ManagedPolicies': set(), 'InstanceProfiles': set() }
+    elif desired.get('TrustPolicy') is not None and normalize_policy(current['TrustPolicy']) != normalize_policy(desired['TrustPolicy']):
+        changes.append(('update_trust', rolename))
+    for (policyname, document) in sorted((desired.get('InlinePolicies') or {}).items()):
+        if normalize_policy(current['InlinePolicies'].get(policyname)) != normalize_policy(document):
+            changes.append(('put_inline', policyname))
+    for policyarn in desired.get('ManagedPolicies') or []:
+        if policyarn not in current['ManagedPolicies']:
+            changes.append(('attach_managed', policyarn))
+    if desired.get('InstanceProfile') and rolename not in current['InstanceProfiles']:
+        changes.append(('add_to_instance_profile', rolename))
+    return changes
 
-    # Read account bootstrapper configuration from required "bootstrapper.ini" file.
-    config = configparser.ConfigParser()
-    config.read('bootstrapper.ini')
-    access_to_billing = config.get('General', 'access_to_billing', fallback='ALLOW')
-    baselinetemplate = config.get('General', 'baselinetemplate', fallback='')
-    testaccountid = config.get('General', 'testaccountid')
-    testmode = config.getboolean('General', 'testmode', fallback='False')
-
-    print("access_to_billing: {}".format(access_to_billing))
-    print("baselinetemplate: {}".format(baselinetemplate))
-    print("testaccountid: {}".format(testaccountid))
-    print("testmode: {}".format(testmode))
+def apply_role_changes(iam_client,desired,changes):
+    # Function to issue the IAM calls for the changes listed by role_changes().
+    #   Retries (for example while a new role or its trusted principals propagate) are made by the shared retry policy.
+    #   An entity IAM reports as already existing is taken as done, as the desired state is already in place.
+    # Returns the role ARN if the role was created, otherwise None.
+    rolename = desired['RoleName']
+    role_arn = None
 
-    scp = None
+    def attempt(description,call,**kwargs):
+        try:
+            response = call(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'EntityAlreadyExists':
+                log_event('role_change', role=rolename, change=description, status='already_done')
+                return None
+            log_event('role_change', role=rolename, change=description, status='failed', error=str(e))
+            raise
+        log_event('role_change', role=rolename, change=description, status='success')
+        return response
 
-    # This should be converted to some AWS call to retrieve dynamically!
-    RegiontoAZMap = {
-        "ap-northeast-1": ["ap-northeast-1a","ap-northeast-1c"],
-        "ap-northeast-2": [ "ap-northeast-2a","ap-northeast-2c"],
-        "ap-northeast-3": [ "ap-northeast-3a" ],
-        "ap-south-1": [ "ap-south-1a","ap-south-1b"],
-        "ap-southeast-1": [ "ap-southeast-1a","ap-southeast-1b","ap-southeast-1c"],
-        "ap-southeast-2": [ "ap-southeast-2a","ap-southeast-2b","ap-southeast-2c"],
-        "ca-central-1": ["ca-central-1a","ca-central-1b"],
-        "eu-central-1": ["eu-central-1a","eu-central-1b","eu-central-1c"],
-        "eu-west-1": [ "eu-west-1a","eu-west-1b","eu-west-1c"],
-        "eu-west-2": [ "eu-west-2a","eu-west-2b","eu-west-2c"],
-        "eu-west-3": [ "eu-west-3a","eu-west-3b","eu-west-3c"],
-        "sa-east-1": [ "sa-east-1a","sa-east-1c"],
-        "us-east-1": [ "us-east-1a","us-east-1b","us-east-1c","us-east-1d","us-east-1e","us-east-1f"],
-        "us-east-2": [ "us-east-2a","us-east-2b","us-east-2c"],
-        "us-west-1": [ "us-west-1b","us-west-1c"],
-        "us-west-2": [ "us-west-2a","us-west-2b","us-west-2c"]
-    }
-    # Standard EC2 AWS trust policy
-    AWSEC2trustpolicy = json.dumps({
-                                    "Version": "2012-10-17",
-                                      "Statement": [{
-                                        "Effect": "Allow",
-                                        "Principal": {
-                                            "Service": "ec2.amazonaws.com"
-                                        },
-                                        "Action": "sts:AssumeRole"
-                                      }]
-                                    } 
-                                )
+    for (change, target) in changes:
+        if change == 'create_role':
+            response = attempt("creating a role",iam_client.create_role,RoleName=rolename,AssumeRolePolicyDocument=desired['TrustPolicy'],Description=rolename,MaxSessionDuration=3600)
+            if response is not None:
+                role_arn = response['Role']['Arn']
+        elif change == 'update_trust':
+            attempt("updating the role trust policy",iam_client.update_assume_role_policy,RoleName=rolename,PolicyDocument=desired['TrustPolicy'])
+        elif change == 'put_inline':
+            attempt("attaching policy {} to the role".format(target),iam_client.put_role_policy,RoleName=rolename,PolicyName=target,PolicyDocument=desired['InlinePolicies'][target])
+        elif change == 'attach_managed':
+            attempt("attaching policy {} to the role".format(target),iam_client.attach_role_policy,RoleName=rolename,PolicyArn=target)
+        elif change == 'add_to_instance_profile':
+            attempt("creating the profile launch role",iam_client.create_instance_profile,InstanceProfileName=rolename)
+            attempt("associating role to instance profile role",iam_client.add_role_to_instance_profile,InstanceProfileName=rolename,RoleName=rolename)
+    return role_arn
 
-    if (event['RequestType'] == 'Create'):
-        selfinvoke(event,'Wait')
-        top_level_account = event['ServiceToken'].split(':')[4]
-        org_client = get_client('organizations')
-        
-        preferred_az_list = RegiontoAZMap[stackregion]
-        
-        try:
-            list_roots_response = org_client.list_roots()
-            #print(list_roots_response)
-            root_id = list_roots_response['Roots'][0]['Id']
-        except:
-            root_id = "Error"
-    
-        if root_id  is not "Error":
-            ### List the available AWS Oranization OU's 
-            #if(organization_unit_name is not None):
-                #(organization_unit_name,organization_unit_id) = get_ou_name_id(root_id,organization_unit_name)
-            
-            # Create AWS account (if not in testmode, be careful not to release a production version of the account builder with testmode left on!)
-            if not testmode:
-                print ("Creating new account: " + accountname + " (" + accountemail + ")")
-                print ("AWS Account creation variables:")
-                print ("event: {}".format(event))
-                print ("accountname: {}".format(accountname))
-                print ("accountemail: {}".format(accountemail))
-                print ("accountrole: {}".format(accountrole))
-                print ("access_to_billing: {}".format(access_to_billing))
-                print ("scp: {}".format(scp))
-                print ("root_id: {}".format(root_id))
-
-                (create_account_response,account_id) = create_account(event,accountname,accountemail,accountrole,access_to_billing,scp,root_id)
-                print("Created acount:{}\n".format(account_id))
-            else:
-                account_id = testaccountid
-            
-            #attach_policy_response = org_client.attach_policy(PolicyId=scp_id,TargetId=account_id)
-            credentials = assume_role(account_id, accountrole)
-
-            #--------------------------------------------------------------------------------------------
-            # Create HUB Account TFS Agent Queue EC2 Roles in Master ORG if account privisioned is a HUB.
-            #--------------------------------------------------------------------------------------------
-            # Roles below need to be created in the special IaC Terraform management account.
-            
-            # Retrieve assume credentials for special IaC AWS Org Account
-            credentials = assume_role(iac_account_id, accountrole)
-            
-            if ishub=='true':
-                print("--- Account has been designated a Transit HUB! ---")
-                # Create new S3 bucket in IaC AWS Org Account
-                print("--- Creating IaC HUB bucket ---")
-                try:
-                    s3_client = boto3.client('s3',aws_access_key_id=credentials['AccessKeyId'],
-                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                  aws_session_token=credentials['SessionToken'])
-                    s3response = s3_client.create_bucket(
-                        Bucket = 'yourcompanynameORcustomprefix-iac-'+accountname,
-                        ACL = 'private',
-                        CreateBucketConfiguration = {
-                            'LocationConstraint': stackregion
-                        }
-                        #ObjectLockEnabledForBucket=True|False
-                    )
-                except botocore.exceptions.ClientError as e:
-                    print("Error creating the special Terraform IaC bucket!!!!. Error : {}".format(e))
-                                
-                # Create new ec2_iacbuild_{hubenv} iac account EC2 role used by code pipeline build agents.
-                print("--- Creating IaC HUB EC2 build role ---")
-                newrole = "ec2_iacbuild_"+parenthub
-                newrolepolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":{{\"Sid\":\"AllowHUBTerraformRoleAssume\",\"Effect\":\"Allow\",\"Action\":\"sts:AssumeRole\",\"Resource\":[\"arn:aws:iam::{}:role/terraform_reader\",\"arn:aws:iam::{}:role/s3_iac_{}\"]}}}}".format(account_id,account_id,accountname)
-                
-                try:
-                    newrole_arn = create_instanceprofilerole(newrole,top_level_account,credentials,newrolepolicy,AWSEC2trustpolicy)
-                except botocore.exceptions.ClientError as e:
-                    print("Error creating the specified role. Error : {}".format(e))
-                    newrole_arn = "arn:aws:iam::"+iac_account_id+":role/"+newrole
-                print(newrole_arn)
-                
-                # Create new EC2 ec2_iacdeploy_{hubenv} iac account role.
-                print("--- Creating IaC HUB EC2 Deploy Role ---")
-                newrole = "ec2_iacdeploy_"+parenthub
-                newrolepolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":{{\"Sid\":\"AllowHUBTerraformRoleAssume\",\"Effect\":\"Allow\",\"Action\":\"sts:AssumeRole\",\"Resource\":[\"arn:aws:iam::{}:role/terraform_writer\",\"arn:aws:iam::{}:role/s3_iac_{}\"]}}}}".format(account_id,account_id,accountname)
-                
-                try:
-                    newrole_arn = create_instanceprofilerole(newrole,top_level_account,credentials,newrolepolicy,AWSEC2trustpolicy)
-                except botocore.exceptions.ClientError as e:
-                    print("Error creating the specified role. Error : {}".format(e))
-                    newrole_arn = "arn:aws:iam::"+iac_account_id+":role/"+newrole
-                print(newrole_arn)
-                
-                # Create new s3_iac_{hubenv} iac account role
-                print("--- Creating IaC S3 Terraform bucket access role ---")
-                newrole = "s3_iac_"+accountname
-                newrolepolicy = json.dumps (
-                    {
-                        "Version": "2012-10-17",
-                        "Statement": [
-                            {
-                                "Sid": "ALLOWIACBUCKETREAD"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:List*"
-                                ],
-                                "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub
-                            },
-                            {
-                                "Sid": "ALLOWIACACCESSREAD"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:Get*",
-                                    "s3:List*"
-                                ],
-                                "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/providers/"+accountname+"/*"
-                            },
-                            {
-                                "Sid": "ALLOWIACACCESSWRITE"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:DeleteObject",
-                                    "s3:Get*",
-                                    "s3:List*",
-                                    "s3:PutObject"
-                                ],
-                                "Resource": [
-                                    "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/release_artifacts/"+accountname+"/*",
-                                    "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/terraformstate/"+accountname+"/*"
-                                ]
-                            }
-                        ]
-                    }
-                )
+def get_account_role_states(iam_client):
+    # Function to read the current state of every IAM role in an account at once, from paged GetAccountAuthorizationDetails
+    #   calls rather than several calls per role.
+    # Returns a dictionary keyed by role NAME of the role state, see get_role_state().
+    states = {}
+    for page in iam_client.get_paginator('get_account_authorization_details').paginate(Filter=['Role']):
+        for role in page['RoleDetailList']:
+            states[role['RoleName']] = { 'Arn': role['Arn'], 'TrustPolicy': role.get('AssumeRolePolicyDocument'),
+                'InlinePolicies': dict((policy['PolicyName'], policy['PolicyDocument']) for policy in role.get('RolePolicyList', [])),
+                'ManagedPolicies': set(policy['PolicyArn'] for policy in role.get('AttachedManagedPolicies', [])),
+                'InstanceProfiles': set(profile['InstanceProfileName'] for profile in role.get('InstanceProfileList', [])) }
+    return states
 
-                newtrustpolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Principal\":{{\"AWS\":[\"arn:aws:iam::{}:role/ec2_iacbuild_{}\",\"arn:aws:iam::{}:role/ec2_iacdeploy_{}\"]}},\"Action\":\"sts:AssumeRole\"}}]}}".format(iac_account_id,accountname,iac_account_id,accountname)
-                
-                try:
-                    newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
-                except botocore.exceptions.ClientError as e:
-                    print("Error creating the specified role. Error : {}".format(e))
-                    newrole_arn = "arn:aws:iam::"+iac_account_id+":role/"+newrole
-                print(newrole_arn)
-                
-            else:
-                # Account being created is a Spoke Account
-                # Create new s3_iac_{hubenv} iac account role
-                print("--- Creating IaC S3 Terraform bucket access role ---")
-                newrole = "s3_iac_"+accountname
-                newrolepolicy = json.dumps (
-                    {
-                        "Version": "2012-10-17",
-                        "Statement": [
-                            {
-                                "Sid": "ALLOWIACBUCKETREAD"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:List*"
-                                ],
-                                "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub
-                            },
-                            {
-                                "Sid": "ALLOWIACACCESSREAD"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:Get*",
-                                    "s3:List*"
-                                ],
-                                "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/providers/"+accountname+"/*"
-                            },
-                            {
-                                "Sid": "ALLOWIACACCESSWRITE"+accountname,
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:DeleteObject",
-                                    "s3:Get*",
-                                    "s3:List*",
-                                    "s3:PutObject"
-                                ],
-                                "Resource": [
-                                    "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/release_artifacts/"+accountname+"/*",
-                                    "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/terraformstate/"+accountname+"/*"
-                                ]
-                            }
-                        ]
-                    }
-                )
+def ensure_role(iam_client,desired):
+    # Function to bring an IAM role to the desired state, reading its current state first and only issuing calls for the differences.
+    # Parameters:
+    #   iam_client: An IAM boto3 client for the account housing the role.
+    #   desired:    The desired role state, see role_changes().
+    # Returns a tuple of (role ARN, list of changes applied).
+    current = get_role_state(iam_client,desired['RoleName'])
+    changes = role_changes(current,desired)
+    log_event('role_state', role=desired['RoleName'], changes=["{} {}".format(change,target) for (change, target) in changes])
+    if changes:
+        created_arn = apply_role_changes(iam_client,desired,changes)
+    else:
+        created_arn = None
+    if current is not None:
+        return (current['Arn'], changes)
+    if created_arn is None:
+        created_arn = iam_client.get_role(RoleName=desired['RoleName'])['Role']['Arn']
+    return (created_arn, changes)
 
-                newtrustpolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Principal\":{{\"AWS\":[\"arn:aws:iam::{}:role/ec2_iacbuild_{}\",\"arn:aws:iam::{}:role/ec2_iacdeploy_{}\"]}},\"Action\":\"sts:AssumeRole\"}}]}}".format(iac_account_id,parenthub,iac_account_id,parenthub)
-                
-                try:
-                    newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
-                except botocore.exceptions.ClientError as e:
-                    print("Error creating the specified role. Error : {}".format(e))
-                    newrole_arn = "arn:aws:iam::"+iac_account_id+":role/"+newrole
-                print(newrole_arn)
-                
-            #######
-            # Perform the following tasks for all account types
-            #######
-            
-            # Add the new account terraform roles yet to be created to the IaC account's special HUB EC2 devops agent roles 
-            # terraform_reader
-            newrolepolicy = json.dumps(
-                {
-                    "Version":"2012-10-17",
-                    "Statement": 
-                    {
-                        "Sid":"ALLOWTERRAFORMREADERASSUME"+accountname,
-                        "Effect":"Allow",
-                        "Action":"sts:AssumeRole",
-                        "Resource":"arn:aws:iam::"+account_id+":role/terraform_reader"
-                    }
-                }
-            )
-            try:
-                newrole_arn = role_inlinepolicy("add",credentials,"ec2_iacbuild_"+parenthub,"ec2_iacbuild_"+accountname,newrolepolicy)
-            except botocore.exceptions.ClientError as e:
-                print("Error adding policy to specified EC2 Iam role. Error : {}".format(e))
-                newrole_arn = "arn:aws:iam::"+iac_account_id+":role/ec2_iacbuild_"+parenthub
-            print(newrole_arn)
+# Standard EC2 AWS trust policy
+AWSEC2trustpolicy = json.dumps({
+                                "Version": "2012-10-17",
+                                  "Statement": [{
+                                    "Effect": "Allow",
+                                    "Principal": {
+                                        "Service": "ec2.amazonaws.com"
+                                    },
+                                    "Action": "sts:AssumeRole"
+                                  }]
+                                } 
+                            )
 
-            # terraform_writer
-            newrolepolicy = json.dumps(
-                {
-                    "Version":"2012-10-17",
-                    "Statement": 
-                    {
-                        "Sid":"ALLOWTERRAFORMWRITERASSUME"+accountname,
-                        "Effect":"Allow",
-                        "Action":"sts:AssumeRole",
-                        "Resource":"arn:aws:iam::"+account_id+":role/terraform_writer"
-                    }
-                }
-            )
-            try:
-                newrole_arn = role_inlinepolicy("add",credentials,"ec2_iacdeploy_"+parenthub,"ec2_iacdeploy_"+accountname,newrolepolicy)
-            except botocore.exceptions.ClientError as e:
-                print("Error adding policy to specified EC2 Iam role. Error : {}".format(e))
-                newrole_arn = "arn:aws:iam::"+iac_account_id+":role/ec2_iacdeploy_"+parenthub
-            print(newrole_arn)
-                
-            # Create special AWS provider files in IaC Environment Terraform Bucket
-            print ("Creating Special Terraform AWS Build Provider file...")
-            response = create_awsprovider_file(accountrole,stackregion,iac_account_id,"arn:aws:iam::{}:role/terraform_reader".format(account_id),parenthub,accountname,"build")
-            print (response)
-            print ("Creating Special Terraform AWS Deploy Provider file...")
-            response = create_awsprovider_file(accountrole,stackregion,iac_account_id,"arn:aws:iam::{}:role/terraform_writer".format(account_id),parenthub,accountname,"release")
-            print (response)
-            
-            # Assume credentials that can be used in new account.
-            credentials = assume_role(account_id, accountrole)
-            
-            # Create new account local Terraform Reader role.
-            time.sleep(20)
-            print("--- Creating New Account Special Terraform Reader Role ---")
-            newrole = "terraform_reader"
-            newrolepolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Action\":[\"s3:GetObject\",\"s3:PutObject\"],\"Resource\":\"arn:aws:s3:::yourcompanynameORcustomprefix-iac-{}/*/{}/*\"}}]}}".format(parenthub,accountname)
-            newtrustpolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Principal\":{{\"AWS\":\"arn:aws:iam::{}:role/ec2_iacbuild_{}\"}},\"Action\":\"sts:AssumeRole\"}}]}}".format(iac_account_id,parenthub)
-
-            newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
-            print(newrole_arn)
-            # Attach readonly built in admin policy to terraform reader role
-            response = attach_policy("terraform_reader","arn:aws:iam::aws:policy/ReadOnlyAccess",credentials)
-
-            # Create new account local Terraform Writer role.
-            print("--- Creating New Account Special Terraform Writer Role ---")
-            newrole = "terraform_writer"
-            newrolepolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Action\":[\"s3:GetObject\",\"s3:PutObject\"],\"Resource\":\"arn:aws:s3:::yourcompanynameORcustomprefix-iac-{}/*/{}/*\"}}]}}".format(parenthub,accountname)
-            newtrustpolicy = "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Principal\":{{\"AWS\":\"arn:aws:iam::{}:role/ec2_iacdeploy_{}\"}},\"Action\":\"sts:AssumeRole\"}}]}}".format(iac_account_id,parenthub)
-            
-            newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
-            print(newrole_arn)
-
-            # Attach readonly built in admin policy to terraform writer role
-            response = attach_policy("terraform_writer","arn:aws:iam::aws:policy/AdministratorAccess",credentials)
-
-
-            # Switch to assume credentials that can be used in the new account.
-            credentials = assume_role(account_id, accountrole)
-            iam_client = boto3.client('iam',aws_access_key_id=credentials['AccessKeyId'],
-                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                  aws_session_token=credentials['SessionToken'])
-            
-            # Delete default account VPCs.
-            ec2_client = get_client('ec2')
-            if(removedefaultvpc!='false'):
-                regions = []
-                regions_response = ec2_client.describe_regions()
-                for i in range(0,len(regions_response['Regions'])):
-                    regions.append(regions_response['Regions'][i]['RegionName']) 
-                for r in regions:
-                    try:
-                        #print('In the VPC deletion block - {}'.format(r))
-                        delete_vpc_response = delete_default_vpc(credentials,r)
-                    except botocore.exceptions.ClientError as e:
-                        print("An error occured while deleting Default VPC in {}. Error: {}".format(r,e))
-                        i+=1
-
-            # Create or move account to appropriate AWS organizations OU.
-            
-            # Get the root account ID.
-            print ("--- Configure account's Org OU membership --")
-            org_client = boto3.client('organizations')
-            root_id = org_client.list_roots().get('Roots')[0].get('Id')
-            print(root_id)
-
-            # Create/Attach an organizational policy
-            if ishub=='true':
-                organization_unit_name = accountname                
-                try:
-                    (organization_unit_name,organization_unit_id) = get_ou_name_id(root_id,organization_unit_name)
-                    move_response = org_client.move_account(AccountId=account_id,SourceParentId=root_id,DestinationParentId=organization_unit_id)
-                    
-                except Exception as ex:
-                    template = "An exception of type {0} occurred. Arguments:\n{1!r} "
-                    message = template.format(type(ex).__name__, ex.args)
-                    print(message)
+# Customer managed policies holding hub agent role grants are kept under this IAM path in the IaC account.
+HUB_POLICY_PATH = '/accountbootstrapper/'
 
+class HubRoleGrants(object):
+    # The sts:AssumeRole grants of a hub agent role (ec2_iacbuild_{hub} or ec2_iacdeploy_{hub}) to its spokes' terraform roles.
+    #   Grants are kept in customer managed policies named {rolename}-spokes-{n}, each one statement listing as many role
+    #   ARNs as fit in hub_policy_max_size characters, instead of one inline policy per spoke which runs into the role's
+    #   inline policy size limit after a few dozen spokes.  New ARNs go into the first policy with room, a new policy is
+    #   attached when all are full, and when the role cannot take another attached policy every ARN is packed again into
+    #   as few policies as possible.  Per spoke inline policies left by earlier versions are folded in and deleted.
+    #   Grants requested while another thread is writing the same role are written together by the next writer, so a
+    #   fleet of spokes of one hub costs one policy version per batch rather than one per spoke.  Safe to share between threads.
+    def __init__(self, account_id, prefix, parenthub, max_size, max_policies):
+        self.account_id = account_id
+        self.prefix = prefix
+        self.rolename = prefix + parenthub
+        self.max_size = max_size
+        self.max_policies = max_policies
+        self.condition = threading.Condition()
+        self.writing = False
+        self.pending = set()
+        self.granted = set()
 
-            if scp is not None:
-                attach_policy_response = client.attach_policy(PolicyId=scp, TargetId=account_id)
-                print("Attach policy response "+str(attach_policy_response))
-                
-            respond_cloudformation(event, "SUCCESS", { "Message": "Account Created!", 
-                                                       "LoginURL" : "https://"+account_id+".signin.aws.amazon.com/console?region="+stackregion+"#", 
-                                                       "AccountID" : account_id, 
-                                                       "Role" : newrole, 
-                                                       "Stackregion": stackregion })
-        else:
-            print("Cannot access the AWS Organization ROOT. Contact the master account Administrator for more details.")
+    @staticmethod
+    def document(resources):
+        return { "Version": "2012-10-17",
+                 "Statement": [{ "Sid": "ALLOWSPOKEROLEASSUME", "Effect": "Allow", "Action": "sts:AssumeRole", "Resource": sorted(resources) }] }
+
+    def size(self, resources):
+        # IAM does not count whitespace towards the policy size limit.
+        return len(json.dumps(self.document(resources), separators=(',', ':')))
+
+    def grant(self, iam_client, resources):
+        # Make sure the role may assume every role ARN in resources.  Returns the list of policy changes written, empty when
+        #   nothing was missing or another thread wrote them.
+        resources = set(resources)
+        with self.condition:
+            self.pending.update(resources)
+            while self.writing:
+                self.condition.wait()
+                if resources <= self.granted:
+                    return []
+            # Anything left from a failed write is written again along with everything queued while waiting.
+            batch = self.pending | resources
+            self.pending = set()
+            self.writing = True
+        try:
+            return self._write(iam_client, batch)
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def revoke(self, iam_client, resources):
+        # Remove the grants to assume the role ARNs in resources, eg when a spoke moves to another hub.  Per spoke inline
+        #   policies left by earlier versions are folded into the managed policies, as grant() does, before being deleted, so
+        #   the remaining spokes keep their grant throughout.  Policies left empty are deleted.  Returns the list of policy changes written.
+        resources = set(resources)
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.writing = True
+        try:
+            (policies, others, legacy) = self._load(iam_client)
+            remaining = dict((index, policy['Resources'] - resources) for (index, policy) in policies.items())
+            kept = set().union(set(), *remaining.values())
+            fold = set().union(set(), *legacy.values()) - resources - kept
+            (writes, repacked) = self._pack(dict((index, { 'Resources': granted }) for (index, granted) in remaining.items()), fold, self.max_policies - others)
+            deletes = []
+            for (index, policy) in sorted(policies.items()):
+                if index in writes:
+                    continue
+                if repacked or not remaining[index]:
+                    deletes.append(index)
+                elif remaining[index] != policy['Resources']:
+                    writes[index] = remaining[index]
+            # Grants are written before anything is deleted, so no remaining spoke is without one in between.
+            changes = [self._write_policy(iam_client, policies, index, granted) for (index, granted) in sorted(writes.items())]
+            for policyname in sorted(legacy):
+                iam_client.delete_role_policy(RoleName=self.rolename, PolicyName=policyname)
+                changes.append(('delete_inline', policyname))
+            changes.extend(self._delete_policy(iam_client, policies[index]['Arn']) for index in deletes)
+            self.granted = kept | fold
+            log_event('hub_role_grants', role=self.rolename, revoked=len(resources), changes=["{} {}".format(change,target) for (change, target) in changes])
+            return changes
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def current(self, iam_client):
+        # Returns the set of role ARNs the role is currently granted, empty if the role does not exist.
+        try:
+            (policies, others, legacy) = self._load(iam_client)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchEntity':
+                return set()
+            raise
+        return set().union(set(), *[policy['Resources'] for policy in policies.values()] + list(legacy.values()))
+
+    def _load(self, iam_client):
+        # Read the grant policies attached to the role, the number of other attached policies and any per spoke inline policies.
+        pattern = re.compile('^' + re.escape(self.rolename) + r'-spokes-(\d+)$')
+        policies = {}
+        others = 0
+        for page in iam_client.get_paginator('list_attached_role_policies').paginate(RoleName=self.rolename):
+            for attached in page['AttachedPolicies']:
+                match = pattern.match(attached['PolicyName'])
+                if match is None:
+                    others += 1
+                    continue
+                version = iam_client.get_policy(PolicyArn=attached['PolicyArn'])['Policy']['DefaultVersionId']
+                document = iam_client.get_policy_version(PolicyArn=attached['PolicyArn'], VersionId=version)['PolicyVersion']['Document']
+                policies[int(match.group(1))] = { 'Arn': attached['PolicyArn'], 'Resources': self._resources(document) or set() }
+        legacy = {}
+        for page in iam_client.get_paginator('list_role_policies').paginate(RoleName=self.rolename):
+            for policyname in page['PolicyNames']:
+                # The role's own policy shares its name, only other policies named like it are per spoke grants.
+                if policyname == self.rolename or not policyname.startswith(self.prefix):
+                    continue
+                document = iam_client.get_role_policy(RoleName=self.rolename, PolicyName=policyname)['PolicyDocument']
+                resources = self._resources(document)
+                if resources is not None:
+                    legacy[policyname] = resources
+        return (policies, others, legacy)
+
+    @staticmethod
+    def _resources(document):
+        # The role ARNs a grant policy document allows assuming, None if it holds anything other than sts:AssumeRole grants.
+        if not isinstance(document, dict):
+            document = json.loads(document if document.strip().startswith('{') else urllib.parse.unquote(document))
+        statements = document.get('Statement', [])
+        resources = set()
+        for statement in statements if isinstance(statements, list) else [statements]:
+            if statement.get('Effect') != 'Allow' or statement.get('Action') not in ('sts:AssumeRole', ['sts:AssumeRole']) or 'Condition' in statement:
+                return None
+            resource = statement.get('Resource', [])
+            resources.update(resource if isinstance(resource, list) else [resource])
+        return resources
+
+    def _pack(self, policies, new, room):
+        # Lay out the new ARNs, first fit into the existing policies then into new ones, or pack everything again if the role
+        #   has no room for the policies needed.  Returns a tuple of the {index: resources} layout of the policies to be
+        #   written and whether everything was packed again.
+        layout = dict((index, set(policy['Resources'])) for (index, policy) in policies.items())
+        changed = set()
+        for resource in sorted(new):
+            for index in sorted(layout):
+                if self.size(layout[index] | set([resource])) <= self.max_size:
+                    layout[index].add(resource)
+                    changed.add(index)
+                    break
+            else:
+                index = max(layout) + 1 if layout else 1
+                layout[index] = set([resource])
+                changed.add(index)
+        if len(layout) <= room:
+            return (dict((index, layout[index]) for index in changed), False)
+        log_event('hub_role_grants_repack', role=self.rolename, policies=len(layout), room=room)
+        packed = [set()]
+        for resource in sorted(set().union(*layout.values())):
+            if packed[-1] and self.size(packed[-1] | set([resource])) > self.max_size:
+                packed.append(set())
+            packed[-1].add(resource)
+        if len(packed) > room:
+            raise ProvisioningError("Role {} cannot hold {} spoke grants in {} policies of {} characters".format(
+                self.rolename,sum(len(resources) for resources in packed),room,self.max_size))
+        return (dict((index + 1, resources) for (index, resources) in enumerate(packed)), True)
+
+    @staticmethod
+    def _new_version(iam_client, policyarn, document):
+        versions = iam_client.list_policy_versions(PolicyArn=policyarn)['Versions']
+        # IAM keeps at most five versions of a policy, make room by deleting the oldest.
+        if len(versions) >= 5:
+            oldest = min((version for version in versions if not version['IsDefaultVersion']), key=lambda version: version['CreateDate'])
+            iam_client.delete_policy_version(PolicyArn=policyarn, VersionId=oldest['VersionId'])
+        iam_client.create_policy_version(PolicyArn=policyarn, PolicyDocument=document, SetAsDefault=True)
+
+    def _write_policy(self, iam_client, policies, index, resources):
+        document = json.dumps(self.document(resources))
+        if index in policies:
+            self._new_version(iam_client, policies[index]['Arn'], document)
+            return ('update_policy', policies[index]['Arn'])
+        policyname = "{}-spokes-{}".format(self.rolename,index)
+        try:
+            policyarn = iam_client.create_policy(PolicyName=policyname, Path=HUB_POLICY_PATH, PolicyDocument=document,
+                                                 Description="Spoke terraform roles {} may assume".format(self.rolename))['Policy']['Arn']
+        except botocore.exceptions.ClientError as e:
+            # Left behind by an earlier run that stopped before attaching it.
+            if e.response['Error']['Code'] != 'EntityAlreadyExists':
+                raise
+            policyarn = "arn:aws:iam::{}:policy{}{}".format(self.account_id,HUB_POLICY_PATH,policyname)
+            self._new_version(iam_client, policyarn, document)
+        iam_client.attach_role_policy(RoleName=self.rolename, PolicyArn=policyarn)
+        return ('attach_policy', policyarn)
+
+    def _delete_policy(self, iam_client, policyarn):
+        iam_client.detach_role_policy(RoleName=self.rolename, PolicyArn=policyarn)
+        for version in iam_client.list_policy_versions(PolicyArn=policyarn)['Versions']:
+            if not version['IsDefaultVersion']:
+                iam_client.delete_policy_version(PolicyArn=policyarn, VersionId=version['VersionId'])
+        iam_client.delete_policy(PolicyArn=policyarn)
+        return ('delete_policy', policyarn)
+
+    def _write(self, iam_client, batch):
+        (policies, others, legacy) = self._load(iam_client)
+        current = set().union(*[policy['Resources'] for policy in policies.values()]) if policies else set()
+        new = (set(batch) | set().union(*legacy.values()) if legacy else set(batch)) - current
+        changes = []
+        if new:
+            (layout, repacked) = self._pack(policies, new, self.max_policies - others)
+            for (index, resources) in sorted(layout.items()):
+                changes.append(self._write_policy(iam_client, policies, index, resources))
+            # Packing again leaves the highest numbered policies empty, their grants are now held by the others.
+            if repacked:
+                for index in sorted(set(policies) - set(layout)):
+                    changes.append(self._delete_policy(iam_client, policies[index]['Arn']))
+        for policyname in sorted(legacy):
+            iam_client.delete_role_policy(RoleName=self.rolename, PolicyName=policyname)
+            changes.append(('delete_inline', policyname))
+        self.granted = current | new
+        log_event('hub_role_grants', role=self.rolename, new=len(new), granted=len(self.granted),
+                  changes=["{} {}".format(change,target) for (change, target) in changes])
+        return changes
+
+def hub_role_grants(iac_account_id, prefix, parenthub, settings):
+    # Function returning the shared HubRoleGrants of the hub agent role prefix+parenthub, kept for the life of the Lambda container.
+    key = (iac_account_id, prefix + parenthub)
+    with _cache_lock:
+        if key not in _hub_role_grants:
+            _hub_role_grants[key] = HubRoleGrants(iac_account_id, prefix, parenthub, settings['hub_policy_max_size'], settings['hub_policy_max_policies'])
+        return _hub_role_grants[key]
+
+class MetadataCache(object):
+    # Cache of organization and account facts that almost never change (the organization root, enabled regions, the OU
+    #   hierarchy and the availability zone map), so warm invocations skip the AWS calls behind them.  Values are kept in
+    #   memory for the life of the Lambda container and, when a directory is given, written to it as JSON files so a new
+    #   interpreter in the same sandbox starts with them.  A value is loaded again once older than its TTL, when a validity
+    #   check refuses it, or after it is invalidated.  Hits, file hits and misses are counted per key.  Safe to share between threads.
+    def __init__(self, directory=None, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.values = {}
+        self.counters = {}
+
+    def get(self, key, loader, ttl=None, valid=None):
+        # Return the cached value of key, calling loader() to load it when there is no fresh, valid value.
+        #   Concurrent callers of a key being loaded wait for that load rather than making the same calls.
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self.values.get(key)
+            if self._usable(entry, ttl, valid):
+                self._count(key, 'hits')
+                return entry['value']
+            entry = self._read(key)
+            if self._usable(entry, ttl, valid):
+                with self.lock:
+                    self.values[key] = entry
+                self._count(key, 'file_hits')
+                return entry['value']
+            self._count(key, 'misses')
+            value = loader()
+            self.put(key, value)
+            return value
+
+    def put(self, key, value):
+        # Store a value, eg after a change made through this container that the cached value should include.
+        entry = { 'stored': time.time(), 'value': value }
+        with self.lock:
+            self.values[key] = entry
+        self._write(key, entry)
+
+    def invalidate(self, key):
+        # Drop a value known to be out of date, the next get() loads it again.
+        with self.lock:
+            self.values.pop(key, None)
+        self._count(key, 'invalidations')
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        # Returns a dictionary keyed by cache key of its hits, file_hits, misses and invalidations counts.
+        with self.lock:
+            return dict((key, dict(counters)) for (key, counters) in self.counters.items())
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters = {}
+
+    def _count(self, key, counter):
+        with self.lock:
+            self.counters.setdefault(key, { 'hits': 0, 'file_hits': 0, 'misses': 0, 'invalidations': 0 })[counter] += 1
+
+    @staticmethod
+    def _usable(entry, ttl, valid):
+        return entry is not None and time.time() - entry['stored'] <= ttl and (valid is None or valid(entry['value']))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, entry):
+        if not self.directory:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Written to a temporary file first so a reader never sees a partly written value.
+            temporary = "{}.{}.{}".format(self._path(key), os.getpid(), threading.current_thread().ident)
+            with open(temporary, 'w') as cache_file:
+                json.dump(entry, cache_file)
+            os.replace(temporary, self._path(key))
+        except (OSError, TypeError, ValueError) as e:
+            log_event('metadata_cache', key=key, status='save_failed', error=str(e))
+
+def metadata_cache():
+    # Function returning the container's MetadataCache, configured from the [Cache] section of bootstrapper.ini.
+    #   Values are only persisted to metadata_cache_dir when running in Lambda, elsewhere (the command line, benchmarks) the
+    #   credentials, and so the organization, may differ from one run to the next.
+    global _metadata_cache
+    with _cache_lock:
+        if _metadata_cache is None:
+            config = read_config()
+            directory = None
+            if os.environ.get('AWS_EXECUTION_ENV', '').startswith('AWS_Lambda_'):
+                directory = config.get('Cache', 'metadata_cache_dir', fallback='/tmp/accountbootstrapper-metadata') or None
+            _metadata_cache = MetadataCache(directory, config.getint('Cache', 'metadata_cache_ttl', fallback=3600))
+        return _metadata_cache
+
+def enabled_regions():
+    # Function returning the sorted names of the regions enabled for the master account, cached, see metadata_cache().
+    return metadata_cache().get('enabled_regions', lambda: sorted(region['RegionName'] for region in get_client('ec2').describe_regions()['Regions']))
+
+class OrganizationTree(object):
+    # Index of the organization's OU hierarchy by path (OU names joined with "/" from the root, eg "Hubs/Prod/hubname").
+    #   The whole hierarchy is paged through once, after which lookups are dictionary reads.  OUs created and accounts moved
+    #   through the index are added to it as they happen, and a parent's children are listed again before an OU missing from
+    #   the index is created, so an OU created by someone else is found rather than duplicated.  Safe to share between threads.
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+        self.root_id = None
+        self.ous = {}
+        self.paths = {}
+        self.account_parents = {}
+
+    def load(self):
+        # Page through every OU in the organization, breadth first from the root.
+        with self.lock:
+            start = time.time()
+            (self.root_id, top_level_account) = organization_root()
+            if self.root_id == "Error":
+                self.root_id = None
+                raise ProvisioningError("Cannot access the AWS Organization ROOT")
+            self.ous = {}
+            self.paths = {'': self.root_id}
+            self.account_parents = {}
+            pending = [self.root_id]
+            while pending:
+                pending.extend(self._list_children(pending.pop(0)))
+            log_event('organization_indexed', ous=len(self.ous), elapsed=round(time.time()-start,2))
+        return self
+
+    def snapshot(self):
+        # The OU hierarchy as a JSON serializable dictionary, see restore().
+        with self.lock:
+            return { 'root_id': self.root_id, 'ous': self.ous }
+
+    def restore(self, snapshot):
+        with self.lock:
+            self.root_id = snapshot['root_id']
+            self.ous = dict(snapshot['ous'])
+            self.paths = dict((ou['Path'], ou_id) for (ou_id, ou) in self.ous.items())
+            self.paths[''] = self.root_id
+        return self
+
+    def _list_children(self, parent_id):
+        children = []
+        paginator = self.client.get_paginator('list_organizational_units_for_parent')
+        for page in paginator.paginate(ParentId=parent_id):
+            for unit in page['OrganizationalUnits']:
+                self._add(unit['Id'], unit['Name'], parent_id)
+                children.append(unit['Id'])
+        return children
+
+    def _add(self, ou_id, name, parent_id):
+        parent_path = self.ous[parent_id]['Path'] if parent_id in self.ous else ''
+        path = parent_path + '/' + name if parent_path else name
+        self.ous[ou_id] = {'Name': name, 'ParentId': parent_id, 'Path': path}
+        self.paths[path] = ou_id
+
+    def find(self, path):
+        # Return the id of the OU at path ("" is the root), or None if the index does not hold it.
+        with self.lock:
+            return self.paths.get(path.strip('/'))
+
+    def path(self, ou_id):
+        with self.lock:
+            return '' if ou_id == self.root_id else self.ous[ou_id]['Path']
+
+    def ensure_path(self, path):
+        # Return the id of the OU at path, creating it and any missing parent OUs.  OUs found or created are added to the cached hierarchy.
+        with self.lock:
+            known = len(self.ous)
+            parent_id = self.root_id
+            current = ''
+            for name in [name for name in path.strip('/').split('/') if name]:
+                current = current + '/' + name if current else name
+                ou_id = self.paths.get(current)
+                if ou_id is None:
+                    self._list_children(parent_id)
+                    ou_id = self.paths.get(current)
+                if ou_id is None:
+                    log_event('ou_create', path=current)
+                    try:
+                        ou_id = self.client.create_organizational_unit(ParentId=parent_id,Name=name)['OrganizationalUnit']['Id']
+                        self._add(ou_id, name, parent_id)
+                    except botocore.exceptions.ClientError as e:
+                        if e.response['Error']['Code'] != 'DuplicateOrganizationalUnitException':
+                            raise
+                        self._list_children(parent_id)
+                        ou_id = self.paths[current]
+                parent_id = ou_id
+            if len(self.ous) != known:
+                metadata_cache().put('organization_tree', self.snapshot())
+            return parent_id
+
+    def account_parent(self, account_id):
+        # Return the id of the OU (or root) holding an account.
+        with self.lock:
+            if account_id not in self.account_parents:
+                self.account_parents[account_id] = self.client.list_parents(ChildId=account_id)['Parents'][0]['Id']
+            return self.account_parents[account_id]
+
+    def move_account(self, account_id, path):
+        # Move an account into the OU at path, creating the OU if needed.  An account already there is left alone.
+        # Returns the id of the destination OU.
+        with self.lock:
+            destination_id = self.ensure_path(path)
+            source_id = self.account_parent(account_id)
+            if source_id == destination_id:
+                log_event('ou_move', account_id=account_id, path=path, status='unchanged')
+                return destination_id
+            try:
+                self.client.move_account(AccountId=account_id,SourceParentId=source_id,DestinationParentId=destination_id)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('DestinationParentNotFoundException', 'ParentNotFoundException'):
+                    raise
+                # The cached hierarchy holds an OU deleted since, index the organization again and retry once.
+                log_event('ou_missing', path=path, note="indexing the organization again")
+                metadata_cache().invalidate('organization_tree')
+                metadata_cache().put('organization_tree', self.load().snapshot())
+                destination_id = self.ensure_path(path)
+                self.client.move_account(AccountId=account_id,SourceParentId=source_id,DestinationParentId=destination_id)
+            self.account_parents[account_id] = destination_id
+            log_event('ou_move', account_id=account_id, source=self.path(source_id) or 'Root', path=path, status='moved')
+            return destination_id
+
+def organization_tree():
+    # Function returning the organization tree index, built on first use and kept for the life of the Lambda container.
+    #   The hierarchy is cached, see metadata_cache(), so a new container in the same sandbox does not page through it again.
+    global _organization_tree
+    client = get_client('organizations')
+    with _cache_lock:
+        if _organization_tree is None:
+            _organization_tree = OrganizationTree(client)
+        tree = _organization_tree
+    with tree.lock:
+        if tree.root_id is None:
+            tree.restore(metadata_cache().get('organization_tree', lambda: tree.load().snapshot()))
+    return tree
+
+# Service Quotas code of the "Default maximum number of accounts" AWS Organizations quota.
+ORGANIZATION_ACCOUNT_QUOTA_CODE = 'L-29A0C5DF'
+
+class AccountInventory(object):
+    # Index of the organization's accounts by lower case email and by name (names are not unique), paged from ListAccounts once and kept for the
+    #   life of the Lambda container.  It is listed again once older than the account_inventory_ttl setting, and accounts
+    #   created by this container are added as they are created.  Safe to share between threads.
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+        self.loaded = None
+        self.emails = {}
+        self.names = {}
+        self.count = 0
+
+    def load(self):
+        with self.lock:
+            start = time.time()
+            self.emails = {}
+            self.names = {}
+            self.count = 0
+            paginator = self.client.get_paginator('list_accounts')
+            for page in paginator.paginate():
+                for account in page['Accounts']:
+                    self.add(account['Id'], account['Name'], account['Email'])
+            self.loaded = time.time()
+            log_event('accounts_indexed', accounts=self.count, elapsed=round(time.time()-start,2))
+        return self
+
+    def add(self, account_id, name, email):
+        with self.lock:
+            if email.lower() not in self.emails:
+                self.count += 1
+            self.emails[email.lower()] = account_id
+            if account_id not in self.names.setdefault(name, []):
+                self.names[name].append(account_id)
+
+    def find_email(self, email):
+        with self.lock:
+            return self.emails.get(email.lower())
+
+    def find_name(self, name):
+        # Returns the id of the first account listed with the name, see find_names() for all of them.
+        with self.lock:
+            return (self.names.get(name) or [None])[0]
+
+    def find_names(self, name):
+        with self.lock:
+            return list(self.names.get(name, []))
+
+def account_inventory(settings):
+    # Function returning the account inventory index, listed on first use and again once older than account_inventory_ttl seconds.
+    global _account_inventory
+    client = get_client('organizations')
+    with _cache_lock:
+        if _account_inventory is None:
+            _account_inventory = AccountInventory(client)
+        inventory = _account_inventory
+    with inventory.lock:
+        if inventory.loaded is None or time.time() - inventory.loaded > settings['account_inventory_ttl']:
+            inventory.load()
+    return inventory
+
+def organization_account_quota(settings):
+    # Function returning the maximum number of accounts the organization may hold, from the account_quota setting when
+    #   set, otherwise from Service Quotas.  Returns None when the quota cannot be read.
+    if settings['account_quota']:
+        return settings['account_quota']
+    client = get_client('service-quotas', region='us-east-1')
+    try:
+        return int(client.get_service_quota(ServiceCode='organizations', QuotaCode=ORGANIZATION_ACCOUNT_QUOTA_CODE)['Quota']['Value'])
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchResourceException':
+            log_event('account_quota', status='unreadable', error=str(e))
+            return None
+    try:
+        return int(client.get_aws_default_service_quota(ServiceCode='organizations', QuotaCode=ORGANIZATION_ACCOUNT_QUOTA_CODE)['Quota']['Value'])
+    except botocore.exceptions.ClientError as e:
+        log_event('account_quota', status='unreadable', error=str(e))
+        return None
+
+def hub_problems(iac_account_id, accountrole, parenthub):
+    # Function to check a hub a spoke is attached to is usable: its IaC bucket and ec2_iacbuild_/ec2_iacdeploy_ roles exist in the IaC account.
+    # Returns the list of problems found.
+    found = []
+    try:
+        credentials = assume_role(iac_account_id, accountrole)
+    except botocore.exceptions.ClientError as e:
+        return ["Cannot access the IaC account {}. Error : {}".format(iac_account_id,e)]
+    hubbucket = 'yourcompanynameORcustomprefix-iac-'+parenthub
+    try:
+        get_client('s3',credentials).head_bucket(Bucket=hubbucket)
+    except botocore.exceptions.ClientError as e:
+        found.append("IaC HUB bucket {} is not accessible in account {} ({})".format(hubbucket,iac_account_id,e.response['Error']['Code']))
+    iam_client = get_client('iam',credentials)
+    for rolename in ("ec2_iacbuild_"+parenthub, "ec2_iacdeploy_"+parenthub):
+        try:
+            iam_client.get_role(RoleName=rolename)
+        except botocore.exceptions.ClientError as e:
+            found.append("IaC HUB role {} is not accessible in account {} ({})".format(rolename,iac_account_id,e.response['Error']['Code']))
+    return found
+
+def preflight_update(spec,tasks):
+    # Function to check an Update request before any change is made.  A spoke attached to a hub by the update, see
+    #   update_tasks(), needs the hub's IaC bucket and agent roles, as preflight() checks for a new spoke.
+    # Returns the list of problems found.
+    if spec['ishub'] == 'true' or 'hub_role_policies' not in [name for (name, step, dependencies) in tasks]:
+        return []
+    # Consistency errors are real answers here, nothing checked has just been created.
+    _retry_local.probing = True
+    try:
+        return hub_problems(spec['iac_account_id'],spec['accountrole'],spec['parenthub'])
+    finally:
+        _retry_local.probing = False
+
+def preflight(specs,settings,store=None):
+    # Function to validate account requests before any change is made, so a request that cannot succeed fails in about
+    #   a second instead of after its account has been created.  The checks run concurrently on preflight_workers threads:
+    #     - account email and name are not used by an existing account (see account_inventory()) or twice in specs,
+    #     - the organization account quota leaves room for the new accounts,
+    #     - for spokes of hubs not in specs, the hub's IaC bucket and ec2_iacbuild_/ec2_iacdeploy_ roles exist in the IaC account.
+    #   Accounts with a checkpoint in the store already exist, being resumed, and are only checked for their hub.  The store is
+    #   only passed when resuming a suspended request, a new request is always checked in full.
+    #   In testmode no account is created and only the hub checks apply.
+    # Parameters:
+    #   specs:    List of account request parameter dictionaries, see account_spec_from_environment().
+    #   settings: Bootstrapper settings, see load_settings().
+    #   store:    Optional checkpoint store, see provision_account().
+    # Returns a dictionary of account name to the list of problems found, accounts that passed are not listed.
+    start = time.time()
+    problems = {}
+
+    def problem(accountname, message):
+        problems.setdefault(accountname, []).append(message)
+
+    def check(function, *args):
+        # Consistency errors are real answers here, nothing checked has just been created.
+        _retry_local.probing = True
+        try:
+            return function(*args)
+        finally:
+            _retry_local.probing = False
+
+    def resumed(spec):
+        state = store.load(spec['accountname']) if store is not None else None
+        return state is not None and state.get('account_id') is not None
+
+    hubnames = set(spec['accountname'] for spec in specs if spec['ishub'] == 'true')
+    hubchecks = {}
+    for spec in specs:
+        if spec['ishub'] != 'true' and spec['parenthub'] not in hubnames:
+            hubchecks.setdefault((spec['iac_account_id'], spec['accountrole'], spec['parenthub']), []).append(spec['accountname'])
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,settings['preflight_workers']))
+    try:
+        hub_futures = dict((executor.submit(check, hub_problems, *key), names) for (key, names) in hubchecks.items())
+        if not settings['testmode']:
+            inventory_future = executor.submit(check, account_inventory, settings)
+            quota_future = executor.submit(check, organization_account_quota, settings)
+            resumed_futures = [executor.submit(check, resumed, spec) for spec in specs]
+            new_specs = [spec for (spec, future) in zip(specs, resumed_futures) if not future.result()]
+            inventory = inventory_future.result()
+            emails = {}
+            for spec in new_specs:
+                email = spec['accountemail'].lower()
+                if email in emails:
+                    problem(spec['accountname'], "Account email {} is also requested for {}".format(spec['accountemail'],emails[email]))
+                emails.setdefault(email, spec['accountname'])
+                if inventory.find_email(email):
+                    problem(spec['accountname'], "Account email {} is already used by account {}".format(spec['accountemail'],inventory.find_email(email)))
+                if inventory.find_name(spec['accountname']):
+                    problem(spec['accountname'], "Account name {} is already used by account {}".format(spec['accountname'],inventory.find_name(spec['accountname'])))
+            quota = quota_future.result()
+            if quota is not None:
+                remaining = max(0, quota - inventory.count)
+                # Hubs take the room left first, a spoke is of no use without its hub.
+                candidates = [spec for spec in new_specs if spec['accountname'] not in problems]
+                candidates.sort(key=lambda spec: spec['ishub'] != 'true')
+                for spec in candidates[remaining:]:
+                    problem(spec['accountname'], "The organization account quota of {} leaves room for {} new accounts".format(quota,remaining))
+        for future in concurrent.futures.as_completed(hub_futures):
+            for message in future.result():
+                for accountname in hub_futures[future]:
+                    problem(accountname, message)
+    finally:
+        executor.shutdown(wait=True)
+
+    log_event('preflight', accounts=len(specs), elapsed=round(time.time()-start,2), problems=problems)
+    return problems
+
+class ProvisioningError(Exception):
+    # Raised by a provisioning step that cannot continue.  The responded attribute records whether the
+    # cloudformation failure response has already been sent by the step.
+    def __init__(self, message, responded=False):
+        Exception.__init__(self, message)
+        self.responded = responded
+
+class LocalFileCheckpointStore(object):
+    # Checkpoint store that keeps provisioning progress as JSON files in a local directory.
+    #   Intended for testing, or for runs outside Lambda, as the Lambda /tmp directory does not survive a re-invocation in a new container.
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self._path(key), 'r') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, key, state):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp_path = self._path(key) + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.rename(temp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+class S3CheckpointStore(object):
+    # Checkpoint store that keeps provisioning progress as JSON objects in an S3 bucket in the master account,
+    #   so a re-invoked Lambda running in a fresh container can pick up where the previous invocation stopped.
+    def __init__(self, bucket, prefix='checkpoints/'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self, key):
+        try:
+            response = get_client('s3').get_object(Bucket=self.bucket, Key=self.prefix + key + '.json')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def save(self, key, state):
+        get_client('s3').put_object(Bucket=self.bucket, Key=self.prefix + key + '.json', Body=json.dumps(state))
+
+    def delete(self, key):
+        get_client('s3').delete_object(Bucket=self.bucket, Key=self.prefix + key + '.json')
+
+def checkpoint_store(settings, spec):
+    # Function to build the checkpoint store selected by the checkpoint_store setting in bootstrapper.ini.
+    #   "s3" keeps checkpoints under checkpoint_location (a key prefix) in the sourcebucket, "local" keeps them in the checkpoint_location directory.
+    if settings['checkpoint_store'] == 'local':
+        return LocalFileCheckpointStore(settings['checkpoint_location'] or '/tmp/accountbootstrapper-checkpoints')
+    return S3CheckpointStore(spec['sourcebucket'], settings['checkpoint_location'] or 'checkpoints/')
+
+class SqliteRunHistoryStore(object):
+    # Run history store keeping one row per account per run, and one per step, in a local SQLite database.
+    #   Intended for runs from the command line, as the Lambda /tmp directory does not outlive its container.
+    def __init__(self, path):
+        # Imported here as the Lambda handlers use the S3 store by default.
+        import sqlite3
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT, recorded REAL, request TEXT, accountname TEXT, account_type TEXT, '
+                                    'region TEXT, status TEXT, elapsed REAL, PRIMARY KEY (run_id, accountname))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS steps (run_id TEXT, accountname TEXT, step TEXT, seconds REAL, api_calls INTEGER, '
+                                    'retries INTEGER, sleep_seconds REAL, PRIMARY KEY (run_id, accountname, step))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_recorded ON runs (recorded)')
+
+    def record(self, run_id, records):
+        with self.lock, self.connection:
+            for record in records:
+                self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        (run_id, record['recorded'], record['request'], record['accountname'], record['account_type'],
+                                         record['region'], record['status'], record['elapsed']))
+                for (step, values) in record['steps'].items():
+                    self.connection.execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            (run_id, record['accountname'], step, values['seconds'], values['api_calls'],
+                                             values['retries'], values['sleep_seconds']))
+
+    def load(self, since=0):
+        records = {}
+        with self.lock:
+            for row in self.connection.execute('SELECT run_id, recorded, request, accountname, account_type, region, status, elapsed FROM runs '
+                                               'WHERE recorded >= ? ORDER BY recorded', (since,)):
+                records[(row[0], row[3])] = dict(zip(('run_id', 'recorded', 'request', 'accountname', 'account_type', 'region', 'status', 'elapsed'), row),
+                                                 steps={})
+            for row in self.connection.execute('SELECT steps.run_id, steps.accountname, step, seconds, api_calls, retries, sleep_seconds FROM steps '
+                                               'JOIN runs ON runs.run_id = steps.run_id AND runs.accountname = steps.accountname WHERE recorded >= ?', (since,)):
+                if (row[0], row[1]) in records:
+                    records[(row[0], row[1])]['steps'][row[2]] = dict(zip(('seconds', 'api_calls', 'retries', 'sleep_seconds'), row[3:]))
+        return sorted(records.values(), key=lambda record: record['recorded'])
+
+class S3RunHistoryStore(object):
+    # Run history store keeping each run as a JSON object in an S3 bucket in the master account, so the history of every
+    #   Lambda invocation is kept.  Keys start with the run's UTC date, loading a time window only reads the objects in it.
+    def __init__(self, bucket, prefix='history/', max_workers=16):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_workers = max_workers
+
+    def record(self, run_id, records):
+        get_client('s3').put_object(Bucket=self.bucket, Key=self.prefix + run_id + '.json', Body=json.dumps(records))
+
+    def load(self, since=0):
+        s3_client = get_client('s3')
+        start_after = self.prefix + datetime.datetime.utcfromtimestamp(since).strftime('%Y%m%d')
+        keys = [item['Key'] for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix, StartAfter=start_after)
+                for item in page.get('Contents', []) if item['Key'].endswith('.json')]
+
+        def read(key):
+            return json.loads(s3_client.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf-8'))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,self.max_workers)) as executor:
+            runs = list(executor.map(read, keys))
+        return sorted([record for records in runs for record in records if record['recorded'] >= since], key=lambda record: record['recorded'])
+
+def run_history_store(settings, sourcebucket=None):
+    # Function to build the run history store selected by the run_history_store setting in bootstrapper.ini.
+    #   "s3" keeps runs under run_history_location (a key prefix) in the sourcebucket, "sqlite" in the run_history_location
+    #   database file, and "none" does not keep a history.
+    # Returns the store, or None when no history is kept.
+    if settings['run_history_store'] == 'sqlite':
+        return SqliteRunHistoryStore(settings['run_history_location'] or '/tmp/accountbootstrapper-history.sqlite')
+    if settings['run_history_store'] == 's3' and sourcebucket:
+        return S3RunHistoryStore(sourcebucket, settings['run_history_location'] or 'history/')
+    return None
+
+def record_run_history(reports, store, request):
+    # Function to add the accounts that finished (completed or failed) in this run to the run history store.  Each record
+    #   holds the account type and region, and each step's seconds, AWS API calls, retries and seconds slept.  Accounts
+    #   suspended for a re-invocation are recorded by the invocation that finishes them.  Failing to record never fails the run.
+    # Parameters:
+    #   reports: List of account reports, see provision_accounts() and update_account().
+    #   store:   Run history store, see run_history_store(), nothing is recorded when None.
+    #   request: What ran, 'create', 'update' or 'batch'.
+    # Returns the run id, or None when nothing was recorded.
+    if store is None:
+        return None
+    recorded = time.time()
+    run_id = "{}-{:08x}".format(datetime.datetime.utcfromtimestamp(recorded).strftime('%Y%m%dT%H%M%S'), random.getrandbits(32))
+    records = []
+    for report in reports:
+        if report['status'] not in ('complete', 'failed'):
+            continue
+        metrics = report.get('step_metrics') or {}
+        steps = {}
+        for (step, seconds) in (report.get('timings') or {}).items():
+            steps[step] = dict({'api_calls': 0, 'retries': 0, 'sleep_seconds': 0.0}, seconds=seconds, **metrics.get(step, {}))
+        records.append({ 'run_id': run_id, 'recorded': recorded, 'request': request, 'accountname': report['accountname'],
+                         'account_type': 'hub' if report.get('ishub') == 'true' else 'spoke', 'region': report.get('region'),
+                         'status': report['status'], 'elapsed': report.get('elapsed'), 'steps': steps })
+    if not records:
+        return None
+    try:
+        store.record(run_id, records)
+    except Exception as e:
+        log_event('run_history', run_id=run_id, status='failed', error=str(e))
+        return None
+    log_event('run_history', run_id=run_id, accounts=len(records))
+    return run_id
+
+def percentile(values, fraction):
+    # Function returning the nearest rank percentile of a list of numbers, eg fraction 0.95 for the p95, or None when empty.
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_history_report(records, settings, now=None):
+    # Function to summarise the run history per provisioning step and account type: the p50 and p95 step seconds of each
+    #   history_period_days period over the baseline and recent windows, and a comparison of the recent window (the last
+    #   history_window_days) with the baseline window (the history_baseline_days before it).  A step is flagged as a
+    #   regression when its recent p50 or p95 is more than regression_threshold (a fraction) and regression_min_seconds
+    #   above the baseline's, given at least regression_min_runs baseline runs.  The p50 API calls, retries and seconds
+    #   slept of both windows are included, they usually show why a step got slower.
+    #   Only completed accounts are summarised, the "total" step is an account's whole provisioning time.
+    # Parameters:
+    #   records:  Run history records, see record_run_history().
+    #   settings: Bootstrapper settings, see load_settings().
+    #   now:      Epoch seconds the windows end at, the current time if omitted.
+    # Returns a dictionary with the window bounds, the per step 'steps' list and the 'regressions' found.
+    if now is None:
+        now = time.time()
+    period = settings['history_period_days'] * 86400.0
+    window_start = now - settings['history_window_days'] * 86400.0
+    baseline_start = window_start - settings['history_baseline_days'] * 86400.0
+    groups = {}
+    failures = {}
+    for record in records:
+        if record['recorded'] < baseline_start or record['recorded'] > now:
+            continue
+        if record['status'] != 'complete':
+            failures[record['account_type']] = failures.get(record['account_type'], 0) + 1
+            continue
+        steps = dict(record['steps'])
+        steps['total'] = {'seconds': record['elapsed'], 'api_calls': sum(values['api_calls'] for values in record['steps'].values()),
+                          'retries': sum(values['retries'] for values in record['steps'].values()),
+                          'sleep_seconds': sum(values['sleep_seconds'] for values in record['steps'].values())}
+        for (step, values) in steps.items():
+            groups.setdefault((step, record['account_type']), []).append((record['recorded'], values))
+
+    def summary(samples):
+        def p50(name):
+            value = percentile([values[name] for (recorded, values) in samples], 0.5)
+            return round(value, 2) if value is not None else None
+        seconds = [values['seconds'] for (recorded, values) in samples]
+        return { 'runs': len(samples), 'p50': p50('seconds'), 'p95': round(percentile(seconds, 0.95), 2) if samples else None,
+                 'api_calls_p50': p50('api_calls'), 'retries_p50': p50('retries'), 'sleep_seconds_p50': p50('sleep_seconds') }
+
+    report = { 'baseline_start': baseline_start, 'window_start': window_start, 'end': now, 'failed': failures, 'steps': [], 'regressions': [] }
+    for ((step, account_type), samples) in sorted(groups.items()):
+        periods = {}
+        for (recorded, values) in samples:
+            periods.setdefault(int((recorded - baseline_start) // period), []).append((recorded, values))
+        entry = { 'step': step, 'account_type': account_type,
+                  'periods': [dict(summary(periods[index]), start=datetime.datetime.utcfromtimestamp(baseline_start + index * period).strftime('%Y-%m-%d'))
+                              for index in sorted(periods)],
+                  'baseline': summary([sample for sample in samples if sample[0] < window_start]),
+                  'window': summary([sample for sample in samples if sample[0] >= window_start]),
+                  'regression': [] }
+        (baseline, window) = (entry['baseline'], entry['window'])
+        if baseline['runs'] >= settings['regression_min_runs'] and window['runs']:
+            for statistic in ('p50', 'p95'):
+                if window[statistic] > baseline[statistic] * (1 + settings['regression_threshold']) and \
+                   window[statistic] - baseline[statistic] >= settings['regression_min_seconds']:
+                    entry['regression'].append(statistic)
+        if entry['regression']:
+            report['regressions'].append("{} ({}): {}".format(step, account_type, ", ".join(
+                "{} {}s -> {}s".format(statistic, baseline[statistic], window[statistic]) for statistic in entry['regression'])))
+        report['steps'].append(entry)
+    return report
+
+def print_run_history_report(report):
+    # Function to print a run_history_report() as text, one block per step and account type.
+    def date(epoch):
+        return datetime.datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d %H:%M')
+    print("Run history: baseline {} to {}, recent window {} to {}".format(date(report['baseline_start']),date(report['window_start']),
+                                                                          date(report['window_start']),date(report['end'])))
+    if report['failed']:
+        print("Failed accounts not summarised: {}".format(", ".join("{} {}".format(count,account_type) for (account_type, count) in sorted(report['failed'].items()))))
+    for entry in report['steps']:
+        print("{} ({}){}".format(entry['step'],entry['account_type'],"  REGRESSION " + ", ".join(entry['regression']) if entry['regression'] else ""))
+        for item in entry['periods']:
+            print("  {:<10} {:>5} runs  p50 {:>8}s  p95 {:>8}s".format(item['start'],item['runs'],item['p50'],item['p95']))
+        for name in ('baseline', 'window'):
+            item = entry[name]
+            if item['runs']:
+                print("  {:<10} {:>5} runs  p50 {:>8}s  p95 {:>8}s  p50 calls {} retries {} sleep {}s".format(
+                    name,item['runs'],item['p50'],item['p95'],item['api_calls_p50'],item['retries_p50'],item['sleep_seconds_p50']))
+    print("{} regressions{}".format(len(report['regressions']),": " + "; ".join(report['regressions']) if report['regressions'] else ""))
+
+def discover_availability_zones(max_workers=8):
+    # Function to list the availability zones of every region enabled for the account, describing all regions concurrently.
+    #   Local and wavelength zones are left out, as are zones that are not available.
+    # Returns a dictionary keyed by region name of the sorted list of availability zone names.
+    regions = enabled_regions()
+
+    def region_zones(region):
+        response = get_client('ec2',region=region).describe_availability_zones(
+            Filters=[{'Name': 'zone-type', 'Values': ['availability-zone']}, {'Name': 'state', 'Values': ['available']}]
+        )
+        return sorted(zone['ZoneName'] for zone in response['AvailabilityZones'])
+
+    zones = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,min(int(max_workers),len(regions) or 1))) as executor:
+        futures = dict((executor.submit(region_zones,region),region) for region in regions)
+        for future in concurrent.futures.as_completed(futures):
+            region = futures[future]
+            try:
+                zones[region] = future.result()
+            except botocore.exceptions.ClientError as e:
+                log_event('availability_zones', region=region, status='failed', error=str(e))
+    return zones
+
+def az_cache_store(settings, sourcebucket):
+    # Function to build the store the region availability zone map is persisted in across Lambda cold starts, selected by
+    #   the az_cache_store setting.  It reuses the checkpoint stores: "s3" keeps it under the az_cache_location key prefix in
+    #   the sourcebucket, "local" in the az_cache_location directory and "none" only caches in memory.
+    if settings['az_cache_store'] == 'local':
+        return LocalFileCheckpointStore(settings['az_cache_location'] or '/tmp/accountbootstrapper-cache')
+    if settings['az_cache_store'] == 's3' and sourcebucket:
+        return S3CheckpointStore(sourcebucket, settings['az_cache_location'] or 'cache/')
+    return None
+
+def region_az_map(settings, sourcebucket=None, region=None):
+    # Function to return the map of every enabled region to its availability zones.
+    #   The map is cached by the metadata cache for warm Lambda containers and in the az_cache_store for cold starts, and is only
+    #   rediscovered once older than az_cache_ttl seconds or when it does not know the region asked for (a newly enabled region).
+    #   A region still unknown after rediscovery is not enabled, it is remembered as missing until the map expires.
+    # Parameters:
+    #   settings:     Settings dictionary from load_settings().
+    #   sourcebucket: Bucket holding the persisted map when az_cache_store is "s3".
+    #   region:       Optional AWS region name the map must include.
+    # Returns a dictionary keyed by region name of the sorted list of availability zone names.
+    def usable(cached):
+        return time.time() - cached['fetched'] <= settings['az_cache_ttl'] and (region is None or region in cached['zones'] or region in cached.get('missing', []))
+
+    def load():
+        cached = None
+        store = az_cache_store(settings, sourcebucket)
+        if store is not None:
+            try:
+                cached = store.load('region-az-map')
+            except botocore.exceptions.ClientError as e:
+                log_event('region_az_map', status='load_failed', error=str(e))
+        if cached is None or not usable(cached):
+            if cached is not None and region is not None and region not in cached['zones']:
+                # A region enabled since the enabled regions were cached.
+                metadata_cache().invalidate('enabled_regions')
+            start = time.time()
+            cached = {'fetched': time.time(), 'zones': discover_availability_zones(settings['az_discovery_workers']), 'missing': []}
+            if region is not None and region not in cached['zones']:
+                cached['missing'].append(region)
+            log_event('region_az_map', status='discovered', regions=len(cached['zones']), missing=cached['missing'], elapsed=round(time.time()-start,2))
+            if store is not None:
+                try:
+                    store.save('region-az-map', cached)
+                except botocore.exceptions.ClientError as e:
+                    log_event('region_az_map', status='save_failed', error=str(e))
+        return cached
+
+    return metadata_cache().get('region_az_map', load, settings['az_cache_ttl'], usable)['zones']
+
+def load_settings():
+    # Function to read the account bootstrapper settings from the required "bootstrapper.ini" file into a dictionary.
+    config = read_config()
+    return {
+        'access_to_billing': config.get('General', 'access_to_billing', fallback='ALLOW'),
+        'baselinetemplate': config.get('General', 'baselinetemplate', fallback=''),
+        'testaccountid': config.get('General', 'testaccountid'),
+        'testmode': config.getboolean('General', 'testmode', fallback='False'),
+        'planmode': config.getboolean('General', 'planmode', fallback='False'),
+        'lambda_timeout': config.getint('Plan', 'lambda_timeout', fallback=900),
+        'plan_call_seconds': config.getfloat('Plan', 'plan_call_seconds', fallback=0.5),
+        'create_account_timeout': config.getint('Performance', 'create_account_timeout', fallback=600),
+        'create_account_max_poll_delay': config.getint('Performance', 'create_account_max_poll_delay', fallback=20),
+        'vpc_delete_workers': config.getint('Performance', 'vpc_delete_workers', fallback=8),
+        'vpc_delete_region_timeout': config.getint('Performance', 'vpc_delete_region_timeout', fallback=120),
+        'vpc_delete_sweep_timeout': config.getint('Performance', 'vpc_delete_sweep_timeout', fallback=300),
+        'checkpoint_store': config.get('Checkpoint', 'checkpoint_store', fallback='s3'),
+        'checkpoint_location': config.get('Checkpoint', 'checkpoint_location', fallback=''),
+        'step_budget': config.getint('Checkpoint', 'step_budget', fallback=120),
+        'reinvoke_margin': config.getint('Checkpoint', 'reinvoke_margin', fallback=30),
+        'max_invocations': config.getint('Checkpoint', 'max_invocations', fallback=5),
+        'fleet_workers': config.getint('Performance', 'fleet_workers', fallback=10),
+        'create_account_concurrency': config.getint('Performance', 'create_account_concurrency', fallback=5),
+        'step_workers': config.getint('Performance', 'step_workers', fallback=4),
+        'hub_ou_path': config.get('Organization', 'hub_ou_path', fallback='{accountname}'),
+        'spoke_ou_path': config.get('Organization', 'spoke_ou_path', fallback=''),
+        'az_cache_ttl': config.getint('Regions', 'az_cache_ttl', fallback=86400),
+        'az_cache_store': config.get('Regions', 'az_cache_store', fallback='s3'),
+        'az_cache_location': config.get('Regions', 'az_cache_location', fallback=''),
+        'az_discovery_workers': config.getint('Regions', 'az_discovery_workers', fallback=8),
+        'reconcile_workers': config.getint('Performance', 'reconcile_workers', fallback=32),
+        'drift_workers': config.getint('Performance', 'drift_workers', fallback=16),
+        'preflight': config.getboolean('Preflight', 'preflight', fallback='True'),
+        'preflight_workers': config.getint('Preflight', 'preflight_workers', fallback=8),
+        'account_inventory_ttl': config.getint('Preflight', 'account_inventory_ttl', fallback=300),
+        'account_quota': int(config.get('Preflight', 'account_quota', fallback='') or 0),
+        'hub_policy_max_size': config.getint('HubRoles', 'hub_policy_max_size', fallback=6144),
+        'hub_policy_max_policies': config.getint('HubRoles', 'hub_policy_max_policies', fallback=10),
+        'run_history_store': config.get('History', 'run_history_store', fallback='s3'),
+        'run_history_location': config.get('History', 'run_history_location', fallback=''),
+        'history_window_days': config.getfloat('History', 'history_window_days', fallback=7),
+        'history_baseline_days': config.getfloat('History', 'history_baseline_days', fallback=28),
+        'history_period_days': config.getfloat('History', 'history_period_days', fallback=1),
+        'regression_threshold': config.getfloat('History', 'regression_threshold', fallback=0.25),
+        'regression_min_seconds': config.getfloat('History', 'regression_min_seconds', fallback=1),
+        'regression_min_runs': config.getint('History', 'regression_min_runs', fallback=5)
+    }
+
+def account_spec_from_environment():
+    # Function to read the account request parameters set as environment variables by the cloudformation Service Catalog product.
+    return {
+        'accountname': os.environ['accountname'],
+        'accountemail': os.environ['accountemail'],
+        'parenthub': os.environ['parenthub'],
+        'ishub': os.environ['ishub'],
+        'accountrole': 'OrganizationAccountAccessRole',
+        'iac_account_id': os.environ['iac_account_id'],
+        'stackname': os.environ['stackname'],
+        'stackregion': os.environ['stackregion'],
+        'sourcebucket': os.environ['sourcebucket'],
+        'removedefaultvpc': os.environ['removedefaultvpc']
+    }
+
+def account_spec_from_properties(properties):
+    # Function to read the account request parameters of an Update request from the custom resource properties, falling back
+    #   to the environment variables for any parameter the properties do not carry (eg stacks created before they were added).
+    spec = account_spec_from_environment()
+    for name in ('accountname', 'accountemail', 'parenthub', 'ishub', 'stackregion', 'removedefaultvpc'):
+        if name in properties:
+            spec[name] = str(properties[name])
+    if spec['ishub'] == 'true' and not spec['parenthub']:
+        spec['parenthub'] = spec['accountname']
+    return spec
+
+def previous_account_spec(spec,properties):
+    # Function to read the account request parameters an Update request changes from, the OldResourceProperties.
+    #   Stacks created before the parameters were added as properties carry no old values for them.  The parent hub, stack
+    #   region and removedefaultvpc are then None, unknown, and update_tasks() applies them again.  The account name, email
+    #   and hub designation cannot be changed by an update and are taken from the new parameters.
+    previous = dict(spec)
+    for name in ('accountname', 'accountemail', 'ishub'):
+        if name in properties:
+            previous[name] = str(properties[name])
+    for name in ('parenthub', 'stackregion', 'removedefaultvpc'):
+        previous[name] = str(properties[name]) if name in properties else None
+    if previous['ishub'] == 'true' and not previous['parenthub']:
+        previous['parenthub'] = previous['accountname']
+    return previous
+
+def update_tasks(previous,spec):
+    # Function to work out the provisioning tasks that need to run again to move an existing account from the previous to the
+    #   new request parameters, only those affected by the parameters that changed.
+    #   A spoke moving hub has its account and s3_iac_ roles re-pointed at the new hub, is granted to the new hub's agent
+    #   roles and gets provider files in the new hub bucket, then is detached from its previous hub, see step_leave_hub().
+    #   A new stack region only re-renders the provider files, and removedefaultvpc turned on sweeps the default VPCs.
+    #   A previous value of None is unknown and treated as changed, except that a spoke is only detached from a known previous hub.
+    #   The account name and email and whether it is a hub cannot be changed without a new account, they are not applied.
+    # Returns a tuple of (task list as for provisioning_tasks(), list of the parameter names changed but not applied).
+    ignored = [name for name in ('accountname', 'accountemail', 'ishub') if previous[name] != spec[name]]
+    rerun = set()
+    if spec['ishub'] != 'true' and previous['ishub'] != 'true' and previous['parenthub'] != spec['parenthub']:
+        rerun.update(['iac_roles', 'hub_role_policies', 'provider_files', 'account_roles'])
+        if previous['parenthub'] is not None:
+            rerun.add('leave_hub')
+    if previous['stackregion'] != spec['stackregion']:
+        rerun.add('provider_files')
+    if previous['removedefaultvpc'] != spec['removedefaultvpc'] and spec['removedefaultvpc'] != 'false':
+        rerun.add('default_vpc')
+    tasks = [(name, step, [dependency for dependency in dependencies if dependency in rerun])
+             for (name, step, dependencies) in provisioning_tasks(spec) if name in rerun]
+    if 'leave_hub' in rerun:
+        # The previous hub keeps its grants until the account is in place in the new hub.
+        tasks.append(('leave_hub', step_leave_hub, ['hub_role_policies', 'provider_files', 'account_roles']))
+    return (tasks, ignored)
+
+def update_account(previous,spec,settings,top_level_account,event=None,context=None,store=None,resume=False,account_id=None):
+    # Function to apply a change of request parameters to an existing account, running only the tasks update_tasks() finds.
+    #   The tasks run as account provisioning does, checkpointed in the store and stopping before the Lambda times out.
+    # Parameters:
+    #   previous:          The account request parameters the account was provisioned (or last updated) with, see previous_account_spec().
+    #   spec:              The new account request parameters.
+    #   settings:          Bootstrapper settings, see load_settings().
+    #   top_level_account: The master account id.
+    #   event:             Optional cloudformation event, passed to the steps.
+    #   context:           Optional Lambda context object used to stop before the Lambda times out.
+    #   store:             Optional checkpoint store, the checkpoint key is the account name followed by '.update'.
+    #   resume:            True to resume from the checkpoint of an update suspended by a previous invocation.
+    #   account_id:        The id of the account to update, the resource's physical id.  When None (stacks created before the
+    #                      account id was the physical id) the account is found by its previous name, which must be unique.
+    # Returns a report dictionary with keys accountname, ishub, region, status ('complete'|'suspended'|'failed'|'rejected'), account_id, role,
+    #   tasks (names run), ignored (parameters not applied), timings, step_metrics, elapsed and error.
+    start = time.time()
+    checkpoint_key = spec['accountname']+'.update'
+    (tasks, ignored) = update_tasks(previous,spec)
+    report = { 'accountname': spec['accountname'], 'ishub': spec['ishub'], 'region': spec['stackregion'], 'status': None, 'account_id': None, 'role': None,
+               'tasks': [name for (name, step, dependencies) in tasks], 'ignored': ignored, 'timings': {}, 'step_metrics': {}, 'elapsed': 0, 'error': None }
+    state = None
+    if store is not None and resume:
+        state = store.load(checkpoint_key)
+        if state is not None:
+            log_event('update_resume', checkpoint=checkpoint_key, completed=state['completed'], invocations=state['invocations'])
+    if state is None:
+        unknown = [name for name in ('parenthub', 'stackregion', 'removedefaultvpc') if previous[name] is None]
+        if unknown:
+            log_event('update_unknown_parameters', parameters=unknown, note="no previous values, applied again")
+        if account_id is not None:
+            report['account_id'] = account_id
+        elif settings['testmode']:
+            report['account_id'] = settings['testaccountid']
+        else:
+            named = account_inventory(settings).find_names(previous['accountname'])
+            if len(named) != 1:
+                report['status'] = 'failed'
+                report['error'] = ("No account named {} in the organization".format(previous['accountname']) if not named else
+                                   "Account name {} is used by accounts {}, the account to update is unknown".format(previous['accountname'],", ".join(named)))
+                return report
+            report['account_id'] = named[0]
+        if settings['preflight']:
+            problems = preflight_update(spec,tasks)
+            if problems:
+                report['status'] = 'rejected'
+                report['error'] = "Preflight check failed: {}".format("; ".join(problems))
+                log_event('account_update', status=report['status'], error=report['error'])
+                return report
+        state = new_checkpoint_state()
+        state.update({ 'account_id': report['account_id'], 'top_level_account': top_level_account, 'previous_parenthub': previous['parenthub'] })
+    report['account_id'] = state['account_id']
+    report['role'] = release_role(spec,state['account_id'])
+    state['invocations'] += 1
+    log_event('account_update_start', tasks=report['tasks'], ignored=ignored, invocation=state['invocations'])
+
+    if state['invocations'] > settings['max_invocations']:
+        report['status'] = 'failed'
+        report['error'] = "Account update did not complete within {} invocations".format(settings['max_invocations'])
+    else:
+        try:
+            report['status'] = run_provisioning_steps(spec,settings,state,event,context,store,checkpoint_key,tasks=tasks) if tasks else 'complete'
+        except Exception as e:
+            log_event('account_update_error', exception=type(e).__name__, arguments=repr(e.args))
+            report['status'] = 'failed'
+            report['error'] = "{}: {}".format(type(e).__name__,e)
+
+    if store is not None:
+        if report['status'] == 'suspended':
+            store.save(checkpoint_key,state)
+        else:
+            # A failed update is not resumed, the stack rollback sends the previous parameters back as a new update.
+            store.delete(checkpoint_key)
+    report['timings'] = state['timings']
+    report['step_metrics'] = state.get('step_metrics', {})
+    report['elapsed'] = round(time.time() - start,2)
+    log_event('account_update', status=report['status'], tasks=report['tasks'], ignored=ignored, elapsed=report['elapsed'], error=report['error'])
+    return report
+
+def s3_iac_rolepolicy(accountname,parenthub):
+    # Function returning the policy for the IaC account s3_iac_{accountname} role granting access to the account's paths in the hub bucket.
+    return json.dumps (
+        {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Sid": "ALLOWIACBUCKETREAD"+accountname,
+                    "Effect": "Allow",
+                    "Action": [
+                        "s3:List*"
+                    ],
+                    "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub
+                },
+                {
+                    "Sid": "ALLOWIACACCESSREAD"+accountname,
+                    "Effect": "Allow",
+                    "Action": [
+                        "s3:Get*",
+                        "s3:List*"
+                    ],
+                    "Resource": "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/providers/"+accountname+"/*"
+                },
+                {
+                    "Sid": "ALLOWIACACCESSWRITE"+accountname,
+                    "Effect": "Allow",
+                    "Action": [
+                        "s3:DeleteObject",
+                        "s3:Get*",
+                        "s3:List*",
+                        "s3:PutObject"
+                    ],
+                    "Resource": [
+                        "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/release_artifacts/"+accountname+"/*",
+                        "arn:aws:s3:::yourcompanynameORcustomprefix-iac-"+parenthub+"/terraformstate/"+accountname+"/*"
+                    ]
+                }
+            ]
+        }
+    )
+
+def terraform_rolepolicy(accountname,parenthub):
+    # Function returning the inline policy of an account's terraform_reader and terraform_writer roles, access to the account's paths in the hub bucket.
+    return "{{\"Version\":\"2012-10-17\",\"Statement\":[{{\"Effect\":\"Allow\",\"Action\":[\"s3:GetObject\",\"s3:PutObject\"],\"Resource\":\"arn:aws:s3:::yourcompanynameORcustomprefix-iac-{}/*/{}/*\"}}]}}".format(parenthub,accountname)
+
+def hub_agent_trustpolicy(iac_account_id,rolenames):
+    # Function returning a trust policy allowing the given IaC account hub agent roles (eg ec2_iacbuild_{hub}) to assume a role.
+    principals = ["arn:aws:iam::{}:role/{}".format(iac_account_id,rolename) for rolename in rolenames]
+    return json.dumps({"Version":"2012-10-17","Statement":[{"Effect":"Allow","Principal":{"AWS":principals[0] if len(principals) == 1 else principals},"Action":"sts:AssumeRole"}]},separators=(',',':'))
+
+def hub_agent_rolepolicy(terraformrole,account_id,accountname):
+    # Function returning the inline policy of a hub's ec2_iacbuild_ (terraformrole terraform_reader) or ec2_iacdeploy_ (terraform_writer)
+    #   agent role, allowing it to assume the hub account's terraform role and the hub's s3_iac_ role.  Spoke grants are kept by HubRoleGrants.
+    return "{{\"Version\":\"2012-10-17\",\"Statement\":{{\"Sid\":\"AllowHUBTerraformRoleAssume\",\"Effect\":\"Allow\",\"Action\":\"sts:AssumeRole\",\"Resource\":[\"arn:aws:iam::{}:role/{}\",\"arn:aws:iam::{}:role/s3_iac_{}\"]}}}}".format(account_id,terraformrole,account_id,accountname)
+
+def expected_roles(accountname,account_id,parenthub,iac_account_id):
+    # Function returning the desired state (see role_changes()) of every role provisioning creates for an account, as a list of
+    #   (location, desired) tuples where location is 'account' for roles in the account itself and 'iac' for roles in the IaC account.
+    #   An account is a hub when it is its own parent hub.
+    roles = [
+        ('account', { 'RoleName': 'terraform_reader', 'TrustPolicy': hub_agent_trustpolicy(iac_account_id,["ec2_iacbuild_"+parenthub]),
+                      'InlinePolicies': { 'terraform_reader': terraform_rolepolicy(accountname,parenthub) },
+                      'ManagedPolicies': ["arn:aws:iam::aws:policy/ReadOnlyAccess"] }),
+        ('account', { 'RoleName': 'terraform_writer', 'TrustPolicy': hub_agent_trustpolicy(iac_account_id,["ec2_iacdeploy_"+parenthub]),
+                      'InlinePolicies': { 'terraform_writer': terraform_rolepolicy(accountname,parenthub) },
+                      'ManagedPolicies': ["arn:aws:iam::aws:policy/AdministratorAccess"] }),
+        ('iac', { 'RoleName': 's3_iac_'+accountname, 'TrustPolicy': hub_agent_trustpolicy(iac_account_id,["ec2_iacbuild_"+parenthub,"ec2_iacdeploy_"+parenthub]),
+                  'InlinePolicies': { 's3_iac_'+accountname: s3_iac_rolepolicy(accountname,parenthub) } })
+    ]
+    if accountname == parenthub:
+        for (prefix, terraformrole) in (("ec2_iacbuild_", "terraform_reader"), ("ec2_iacdeploy_", "terraform_writer")):
+            roles.append(('iac', { 'RoleName': prefix+parenthub, 'TrustPolicy': AWSEC2trustpolicy,
+                                   'InlinePolicies': { prefix+parenthub: hub_agent_rolepolicy(terraformrole,account_id,accountname) },
+                                   'InstanceProfile': True }))
+    return roles
+
+def release_role(spec,account_id):
+    # Function returning the name of the account role the hub's ec2_iacdeploy_ agent assumes to release, the stack's Role output.
+    deployer = "arn:aws:iam::{}:role/ec2_iacdeploy_{}".format(spec['iac_account_id'],spec['parenthub'])
+    for (location, desired) in expected_roles(spec['accountname'],account_id,spec['parenthub'],spec['iac_account_id']):
+        if location == 'account' and deployer in json.loads(desired['TrustPolicy'])['Statement'][0]['Principal']['AWS']:
+            return desired['RoleName']
+
+def scan_drift(settings,iac_account_id,accountrole,hubs=None,specs=None,remediate=False):
+    # Function to check that the roles provisioning created for every hub and spoke account are still as provisioned, and
+    #   optionally to put back what differs: the terraform_reader and terraform_writer roles in each account (trust policy,
+    #   inline policy and ReadOnlyAccess/AdministratorAccess), the account's s3_iac_ role, a hub's ec2_iacbuild_ and
+    #   ec2_iacdeploy_ agent roles in the IaC account and the agent roles' grants to assume the account's terraform roles.
+    #   Accounts are checked concurrently on drift_workers threads, each with its own cached assumed role credentials.
+    #   The IaC account's roles are all read at once with GetAccountAuthorizationDetails rather than role by role.
+    # Parameters:
+    #   settings:       Settings dictionary from load_settings().
+    #   iac_account_id: The AWS iac special account id holding the hub buckets and agent roles.
+    #   accountrole:    The role assumed in the IaC account and in every account checked.
+    #   hubs:           Optional list of hub names, only accounts attached to these hubs are checked.
+    #   specs:          Optional account request parameters (eg from load_manifest()) listing the accounts to check and their
+    #                   hubs, otherwise every account with provider files in a hub bucket is checked, see list_provider_files().
+    #   remediate:      Apply the changes needed to bring drifted roles back to their provisioned state.
+    # Returns a report dictionary with the number of accounts checked and in sync, the changes found per drifted account,
+    #   accounts skipped with the reason and the errors met per account.
+    start = time.time()
+    iac_credentials = assume_role(iac_account_id, accountrole)
+    iac_iam_client = get_client('iam',iac_credentials)
+    s3_client = get_client('s3',iac_credentials)
+    inventory = account_inventory(settings)
+    report = { 'accounts': 0, 'in_sync': 0, 'drifted': {}, 'remediated': remediate, 'skipped': {}, 'errors': {} }
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,settings['drift_workers']))
+    try:
+        # Each account's hub, from the manifest or from the hub bucket its provider files are in.
+        if specs:
+            parenthubs = dict((spec['accountname'], spec['parenthub']) for spec in specs if not hubs or spec['parenthub'] in hubs)
+        else:
+            buckets = hub_buckets(s3_client,hubs)
+            parenthubs = {}
+            for (bucket, accounts) in zip(buckets, executor.map(lambda bucket: list_provider_files(s3_client,bucket), buckets)):
+                for accountname in accounts:
+                    parenthubs[accountname] = bucket[len(HUB_BUCKET_PREFIX):]
+        iac_roles = get_account_role_states(iac_iam_client)
+        grants = {}
+        for parenthub in set(parenthubs.values()):
+            for prefix in ("ec2_iacbuild_", "ec2_iacdeploy_"):
+                grants[prefix+parenthub] = executor.submit(hub_role_grants(iac_account_id,prefix,parenthub,settings).current,iac_iam_client)
+        grants = dict((rolename, future.result()) for (rolename, future) in grants.items())
+
+        def check_account(accountname, parenthub):
+            # Returns the list of changes found for the account, None if it is not in the organization.
+            account_id = inventory.find_name(accountname)
+            if account_id is None:
+                return None
+            iam_client = get_client('iam',assume_role(account_id, accountrole))
+            found = []
+            for (location, desired) in expected_roles(accountname,account_id,parenthub,iac_account_id):
+                if location == 'account':
+                    (client, current) = (iam_client, get_role_state(iam_client,desired['RoleName']))
+                else:
+                    (client, current) = (iac_iam_client, iac_roles.get(desired['RoleName']))
+                changes = role_changes(current,desired)
+                found.extend("{} {} {}".format(location,desired['RoleName'],"{} {}".format(*change)) for change in changes)
+                if changes and remediate:
+                    apply_role_changes(client,desired,changes)
+            for (prefix, terraformrole) in (("ec2_iacbuild_", "terraform_reader"), ("ec2_iacdeploy_", "terraform_writer")):
+                rolearn = "arn:aws:iam::"+account_id+":role/"+terraformrole
+                if rolearn not in grants[prefix+parenthub]:
+                    found.append("iac {}{} grant {}".format(prefix,parenthub,rolearn))
+                    if remediate:
+                        hub_role_grants(iac_account_id,prefix,parenthub,settings).grant(iac_iam_client,[rolearn])
+            return found
+
+        checks = dict((executor.submit(check_account, accountname, parenthub), accountname) for (accountname, parenthub) in parenthubs.items())
+        for future in concurrent.futures.as_completed(checks):
+            accountname = checks[future]
+            try:
+                found = future.result()
+            except (botocore.exceptions.ClientError, ProvisioningError) as e:
+                report['errors'][accountname] = str(e)
+                continue
+            if found is None:
+                report['skipped'][accountname] = "no account named {} in the organization".format(accountname)
+                continue
+            report['accounts'] += 1
+            if found:
+                report['drifted'][accountname] = found
+            else:
+                report['in_sync'] += 1
+    finally:
+        executor.shutdown(wait=True)
+
+    report['elapsed'] = round(time.time() - start,2)
+    log_event('drift_scan', remediate=remediate, accounts=report['accounts'], in_sync=report['in_sync'], drifted=len(report['drifted']),
+              changes=sum(len(found) for found in report['drifted'].values()), skipped=len(report['skipped']), errors=len(report['errors']), elapsed=report['elapsed'])
+    return report
+
+def step_create_account(spec,settings,state,event):
+    # Provisioning steps are run by run_provisioning_steps() on worker threads.  They read from state but must not modify it,
+    # any values to be saved in the checkpoint state are returned as a dictionary instead.
+    # Provisioning step: create the AWS account (if not in testmode, be careful not to release a production version of the account builder with testmode left on!)
+    accountname = spec['accountname']
+    accountemail = spec['accountemail']
+    accountrole = spec['accountrole']
+    scp = None
+    start = time.time()
+    if not settings['testmode']:
+        log_event('account_create', accountname=accountname, accountemail=accountemail, accountrole=accountrole,
+                  access_to_billing=settings['access_to_billing'], scp=scp, root_id=state['root_id'])
+
+        # The request id is checkpointed as soon as it is known, a retry after the wait timed out polls the same request.
+        with create_account_governor(settings):
+            (create_account_response,account_id) = create_account(event,accountname,accountemail,accountrole,settings['access_to_billing'],scp,state['root_id'],settings['create_account_timeout'],settings['create_account_max_poll_delay'],
+                                                                  request_id=state.get('create_account_request_id'),
+                                                                  on_request=lambda request_id: save_step_progress({ 'create_account_request_id': request_id }))
+        if account_id is None:
+            raise ProvisioningError("Account creation failed for {}".format(accountname),responded=event is not None)
+        log_event('account_created', account_id=account_id)
+        # Keep a warm container's account inventory current for the preflight checks of later requests.
+        if _account_inventory is not None:
+            _account_inventory.add(account_id, accountname, accountemail)
+    else:
+        account_id = settings['testaccountid']
+
+    #attach_policy_response = org_client.attach_policy(PolicyId=scp_id,TargetId=account_id)
+    # The account's access role takes a while to become assumable, the successful probe leaves its credentials cached.
+    #   The probe gets what is left of the step's budget, so the step never runs longer than step_budget() allows for it.
+    wait_until_ready("Role {} in account {}".format(accountrole,account_id),lambda: assume_role(account_id, accountrole),
+                     timeout=max(0,start + step_budget('create_account',settings) - time.time()))
+    return { 'account_id': account_id }
+
+def step_iac_roles(spec,settings,state,event):
+    # Provisioning step: create HUB Account TFS Agent Queue EC2 Roles in Master ORG if account privisioned is a HUB, and the
+    # account's S3 Terraform bucket access role.  Roles below need to be created in the special IaC Terraform management account.
+    accountname = spec['accountname']
+    parenthub = spec['parenthub']
+    iac_account_id = spec['iac_account_id']
+    account_id = state['account_id']
+    top_level_account = state['top_level_account']
+
+    # Retrieve assume credentials for special IaC AWS Org Account
+    credentials = assume_role(iac_account_id, spec['accountrole'])
+    
+    if spec['ishub']=='true':
+        # Account has been designated a Transit HUB, create new S3 bucket in IaC AWS Org Account
+        s3_client = get_client('s3',credentials)
+        hubbucket = 'yourcompanynameORcustomprefix-iac-'+accountname
+        try:
+            s3_client.head_bucket(Bucket=hubbucket)
+            log_event('hub_bucket', bucket=hubbucket, status='exists')
+        except botocore.exceptions.ClientError:
+            try:
+                s3response = s3_client.create_bucket(
+                    Bucket = hubbucket,
+                    ACL = 'private',
+                    CreateBucketConfiguration = {
+                        'LocationConstraint': spec['stackregion']
+                    }
+                    #ObjectLockEnabledForBucket=True|False
+                )
+                log_event('hub_bucket', bucket=hubbucket, status='created')
+            except botocore.exceptions.ClientError as e:
+                log_event('hub_bucket', bucket=hubbucket, status='failed', error=str(e))
+                        
+        # Create new ec2_iacbuild_{hubenv} iac account EC2 role used by code pipeline build agents.
+        newrole = "ec2_iacbuild_"+parenthub
+        newrolepolicy = hub_agent_rolepolicy("terraform_reader",account_id,accountname)
+        
+        try:
+            newrole_arn = create_instanceprofilerole(newrole,top_level_account,credentials,newrolepolicy,AWSEC2trustpolicy)
+            log_event('role', role=newrole_arn, status='ready')
+        except botocore.exceptions.ClientError as e:
+            log_event('role', role="arn:aws:iam::"+iac_account_id+":role/"+newrole, status='failed', error=str(e))
+        
+        # Create new EC2 ec2_iacdeploy_{hubenv} iac account role.
+        newrole = "ec2_iacdeploy_"+parenthub
+        newrolepolicy = hub_agent_rolepolicy("terraform_writer",account_id,accountname)
+        
+        try:
+            newrole_arn = create_instanceprofilerole(newrole,top_level_account,credentials,newrolepolicy,AWSEC2trustpolicy)
+            log_event('role', role=newrole_arn, status='ready')
+        except botocore.exceptions.ClientError as e:
+            log_event('role', role="arn:aws:iam::"+iac_account_id+":role/"+newrole, status='failed', error=str(e))
+        
+        # Create new s3_iac_{hubenv} iac account role
+        newtrustpolicy = hub_agent_trustpolicy(iac_account_id,["ec2_iacbuild_"+accountname,"ec2_iacdeploy_"+accountname])
+    else:
+        # Account being created is a Spoke Account
+        # Create new s3_iac_{hubenv} iac account role
+        newtrustpolicy = hub_agent_trustpolicy(iac_account_id,["ec2_iacbuild_"+parenthub,"ec2_iacdeploy_"+parenthub])
+
+    # Create the IaC S3 Terraform bucket access role.
+    newrole = "s3_iac_"+accountname
+    newrolepolicy = s3_iac_rolepolicy(accountname,parenthub)
+    try:
+        newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
+        log_event('role', role=newrole_arn, status='ready')
+    except botocore.exceptions.ClientError as e:
+        log_event('role', role="arn:aws:iam::"+iac_account_id+":role/"+newrole, status='failed', error=str(e))
+
+def step_hub_role_policies(spec,settings,state,event):
+    # Provisioning step: allow the IaC account's special HUB EC2 devops agent roles to assume the new account's terraform roles yet to be created,
+    #   ec2_iacbuild_{parenthub} the terraform_reader role and ec2_iacdeploy_{parenthub} the terraform_writer role, see HubRoleGrants.
+    parenthub = spec['parenthub']
+    iac_account_id = spec['iac_account_id']
+    account_id = state['account_id']
+    credentials = assume_role(iac_account_id, spec['accountrole'])
+    iam_client = get_client('iam',credentials)
+
+    hub_role_grants(iac_account_id,"ec2_iacbuild_",parenthub,settings).grant(iam_client,["arn:aws:iam::"+account_id+":role/terraform_reader"])
+    hub_role_grants(iac_account_id,"ec2_iacdeploy_",parenthub,settings).grant(iam_client,["arn:aws:iam::"+account_id+":role/terraform_writer"])
+
+def step_provider_files(spec,settings,state,event):
+    # Provisioning step: create special AWS provider files in IaC Environment Terraform Bucket, with a provider alias for every enabled region.
+    account_id = state['account_id']
+    regions = region_az_map(settings,spec['sourcebucket'],spec['stackregion'])
+    files = render_provider_files(spec['stackregion'],spec['iac_account_id'],account_id,spec['accountname'],regions)
+    response = upload_provider_files(spec['accountrole'],spec['iac_account_id'],spec['parenthub'],spec['accountname'],files)
+    log_event('provider_files', bucket=HUB_BUCKET_PREFIX+spec['parenthub'], regions=len(regions), uploaded=response)
+
+def step_account_roles(spec,settings,state,event):
+    # Provisioning step: create the terraform_reader and terraform_writer roles in the new account.
+    accountname = spec['accountname']
+    parenthub = spec['parenthub']
+    iac_account_id = spec['iac_account_id']
+    top_level_account = state['top_level_account']
+
+    # Assume credentials that can be used in new account.
+    credentials = assume_role(state['account_id'], spec['accountrole'])
+    
+    # The new roles trust the parent hub's EC2 roles in the IaC account, which must have propagated before IAM accepts them as principals.
+    iac_iam_client = get_client('iam',assume_role(iac_account_id, spec['accountrole']))
+    for hubrole in ("ec2_iacbuild_{}".format(parenthub),"ec2_iacdeploy_{}".format(parenthub)):
+        wait_until_ready("Role {} in IaC account".format(hubrole),lambda: iac_iam_client.get_role(RoleName=hubrole))
+
+    # Create new account local Terraform Reader role.
+    newrole = "terraform_reader"
+    newrolepolicy = terraform_rolepolicy(accountname,parenthub)
+    newtrustpolicy = hub_agent_trustpolicy(iac_account_id,["ec2_iacbuild_"+parenthub])
+
+    newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
+    log_event('role', role=newrole_arn, status='ready')
+    # Attach readonly built in admin policy to terraform reader role
+    response = attach_policy("terraform_reader","arn:aws:iam::aws:policy/ReadOnlyAccess",credentials)
+
+    # Create new account local Terraform Writer role.
+    newrole = "terraform_writer"
+    newrolepolicy = terraform_rolepolicy(accountname,parenthub)
+    newtrustpolicy = hub_agent_trustpolicy(iac_account_id,["ec2_iacdeploy_"+parenthub])
+    
+    newrole_arn = create_newrole(newrole,top_level_account,credentials,newrolepolicy,newtrustpolicy)
+    log_event('role', role=newrole_arn, status='ready')
+
+    # Attach readonly built in admin policy to terraform writer role
+    response = attach_policy("terraform_writer","arn:aws:iam::aws:policy/AdministratorAccess",credentials)
+    return { 'role': newrole }
+
+def step_default_vpc(spec,settings,state,event):
+    # Provisioning step: delete default account VPCs in every region.
+    if(spec['removedefaultvpc']!='false'):
+        # Switch to assume credentials that can be used in the new account.
+        credentials = assume_role(state['account_id'], spec['accountrole'])
+        # Regions a previous attempt of the step did not finish are all that is left to sweep.
+        regions = state.get('default_vpc_unfinished') or enabled_regions()
+        results = delete_default_vpcs(credentials,regions,settings['vpc_delete_workers'],settings['vpc_delete_region_timeout'],settings['vpc_delete_sweep_timeout'])
+        unfinished = sorted(region for (region, result) in results.items() if result['status'] == 'timeout')
+        if unfinished:
+            log_event('default_vpc_unfinished', regions=unfinished)
+        return { 'default_vpc': dict(state.get('default_vpc') or {}, **results), 'default_vpc_unfinished': unfinished }
+
+def step_ou_membership(spec,settings,state,event):
+    # Provisioning step: create or move account to appropriate AWS organizations OU.
+    #   Hubs are placed in the OU at the hub_ou_path setting and spokes in the OU at spoke_ou_path, when set.
+    path = ou_path(spec,settings)
+    if path:
+        try:
+            organization_tree().move_account(state['account_id'],path)
+            log_event('ou_membership', path=path, status='moved')
+        except Exception as ex:
+            log_event('ou_membership', path=path, status='failed', error="{}: {!r}".format(type(ex).__name__,ex.args))
+
+def step_leave_hub(spec,settings,state,event):
+    # Update step: detach a spoke that moved to another hub from its previous hub, state['previous_parenthub'].  The previous
+    #   hub's agent roles lose their grants to the account's terraform roles and its provider files are removed from the
+    #   previous hub bucket.  Terraform state and release artifacts are left in the previous hub bucket.
+    accountname = spec['accountname']
+    previous = state['previous_parenthub']
+    iac_account_id = spec['iac_account_id']
+    account_id = state['account_id']
+    credentials = assume_role(iac_account_id, spec['accountrole'])
+    iam_client = get_client('iam',credentials)
+
+    hub_role_grants(iac_account_id,"ec2_iacbuild_",previous,settings).revoke(iam_client,["arn:aws:iam::"+account_id+":role/terraform_reader"])
+    hub_role_grants(iac_account_id,"ec2_iacdeploy_",previous,settings).revoke(iam_client,["arn:aws:iam::"+account_id+":role/terraform_writer"])
+    s3_client = get_client('s3',credentials)
+    s3_client.delete_objects(Bucket=HUB_BUCKET_PREFIX+previous,
+                             Delete={ 'Objects': [{ 'Key': provider_file_key(accountname,deploytype) } for deploytype in ('build', 'release')], 'Quiet': True })
+    log_event('hub_left', previous_hub=previous)
+
+def ou_path(spec,settings):
+    # Function returning the OU path an account is placed in, empty to leave it where it is.
+    template = settings['hub_ou_path'] if spec['ishub'] == 'true' else settings['spoke_ou_path']
+    return template.format(accountname=spec['accountname'],parenthub=spec['parenthub']).strip('/')
+
+def provisioning_tasks(spec):
+    # Function returning the provisioning task graph for an account as a list of (name, step function, dependencies) tuples,
+    #   listed so every task follows its dependencies.  Tasks whose dependencies have completed run concurrently.
+    #   For a hub, the hub bucket and EC2 agent roles created by iac_roles must exist before the hub role policies, the provider
+    #   files and the new account roles (whose trust policies name the agent roles).  A spoke's hub already has them.
+    if spec['ishub'] == 'true':
+        hub_dependencies = ['create_account', 'iac_roles']
+    else:
+        hub_dependencies = ['create_account']
+    return [
+        ('create_account', step_create_account, []),
+        ('iac_roles', step_iac_roles, ['create_account']),
+        ('hub_role_policies', step_hub_role_policies, hub_dependencies),
+        ('provider_files', step_provider_files, hub_dependencies),
+        ('account_roles', step_account_roles, hub_dependencies),
+        ('default_vpc', step_default_vpc, ['create_account']),
+        ('ou_membership', step_ou_membership, ['create_account'])
+    ]
+
+def run_task_graph(tasks,max_workers,completed=(),can_start=None,on_complete=None,timeline=None):
+    # Function to run a task graph on a thread pool, starting each task as soon as all of its dependencies have completed.
+    #   Once a task fails no further tasks are started, the tasks already running are allowed to finish and the first error is raised.
+    # Parameters:
+    #   tasks:       List of (name, function, dependencies) tuples, each function is called with no arguments.
+    #   max_workers: Number of tasks run concurrently.
+    #   completed:   Names of tasks already completed (in an earlier invocation), they are not run again.
+    #   can_start:   Optional function called with a task name just before it is started, returning False defers the task
+    #                (and so everything depending on it) to a later run.
+    #   on_complete: Optional function called with (task name, task return value) as each task completes.
+    #   timeline:    Optional dictionary to record the timeline in, so it is available even when a task fails.
+    # Returns a tuple of (names of tasks not run, timeline) where timeline maps each task run to {'start', 'end'} seconds
+    # relative to the start of the graph run.
+    done = set(completed)
+    deferred = set()
+    running = {}
+    if timeline is None:
+        timeline = {}
+    error = None
+    graph_start = time.time()
+
+    def run_timed(name, function):
+        start = time.time()
+        try:
+            return function()
+        finally:
+            timeline[name] = { 'start': round(start - graph_start,2), 'end': round(time.time() - graph_start,2) }
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,max_workers))
+    try:
+        while True:
+            if error is None:
+                for (name, function, dependencies) in tasks:
+                    if name in done or name in deferred or name in running.values():
+                        continue
+                    if not all(dependency in done for dependency in dependencies):
+                        continue
+                    if can_start is not None and not can_start(name):
+                        deferred.add(name)
+                        continue
+                    running[executor.submit(run_timed, name, function)] = name
+            if not running:
+                break
+            (finished, _) = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    log_event('task_failed', task=name, error=str(future.exception()))
+                    if error is None:
+                        error = future.exception()
+                else:
+                    done.add(name)
+                    if on_complete is not None:
+                        on_complete(name, future.result())
+    finally:
+        executor.shutdown(wait=True)
+    if error is not None:
+        raise error
+    return ([name for (name, function, dependencies) in tasks if name not in done], timeline)
+
+def critical_path(tasks,durations):
+    # Function returning the chain of dependent tasks with the longest total duration, the lower bound on elapsed time for the graph.
+    # Parameters:
+    #   tasks:     List of (name, function, dependencies) tuples, listed so every task follows its dependencies.
+    #   durations: Dictionary of task name to duration in seconds, tasks without a duration count as zero.
+    # Returns a tuple of (list of task names along the path, total seconds).
+    finish = {}
+    previous = {}
+    for (name, function, dependencies) in tasks:
+        slowest = max(dependencies, key=lambda dependency: finish[dependency]) if dependencies else None
+        finish[name] = (finish[slowest] if slowest else 0) + durations.get(name,0)
+        previous[name] = slowest
+    if not finish:
+        return ([], 0)
+    name = max(finish, key=lambda task: finish[task])
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.insert(0,name)
+        name = previous[name]
+    return (path, round(total,2))
+
+def step_budget(name,settings):
+    # Function returning the seconds of Lambda time a provisioning step should be given before it is started.
+    #   create_account is given the account creation wait plus step_budget, which bounds the CreateAccount call and the
+    #   readiness probe of the new account's access role, see step_create_account().  The plan charges the same number.
+    if name == 'create_account':
+        return (0 if settings['testmode'] else settings['create_account_timeout']) + settings['step_budget']
+    if name == 'default_vpc':
+        return settings['vpc_delete_sweep_timeout']
+    return settings['step_budget']
+
+def role_operations(target,rolename,inline_policies=1,managed_policies=0,instance_profile=False):
+    # Function returning the plan operations of ensure_role() creating a role, see plan_step_operations().
+    operations = [
+        ('iam', 'GetRole', target, 1, False),
+        ('iam', 'ListRolePolicies', target, 1, False),
+        ('iam', 'ListAttachedRolePolicies', target, 1, False),
+        ('iam', 'ListInstanceProfilesForRole', target, 1, False),
+        ('iam', 'CreateRole', "{} {}".format(target,rolename), 1, True),
+        ('iam', 'PutRolePolicy', "{} {}".format(target,rolename), inline_policies, True)
+    ]
+    if managed_policies:
+        operations.append(('iam', 'AttachRolePolicy', "{} {}".format(target,rolename), managed_policies, True))
+    if instance_profile:
+        operations.append(('iam', 'CreateInstanceProfile', "{} {}".format(target,rolename), 1, True))
+        operations.append(('iam', 'AddRoleToInstanceProfile', "{} {}".format(target,rolename), 1, True))
+    return operations
+
+def plan_step_operations(name,spec,settings,regions):
+    # Function returning the AWS operations a provisioning step runs for an account, following the same hub/spoke branches as the step.
+    #   Roles are planned as new, so for an account being re-run the plan is an upper bound.
+    # Parameters:
+    #   name:     Provisioning step name, see provisioning_tasks().
+    #   spec:     Account request parameters, see account_spec_from_environment().
+    #   settings: Bootstrapper settings, see load_settings().
+    #   regions:  Number of regions enabled.
+    # Returns a list of (service, operation, target, count, mutating) tuples in the order they are called.
+    ishub = spec['ishub'] == 'true'
+    hubbucket = 'yourcompanynameORcustomprefix-iac-'+spec['parenthub']
+    if name == 'create_account':
+        operations = []
+        if not settings['testmode']:
+            operations.append(('organizations', 'CreateAccount', spec['accountname'], 1, True))
+            operations.append(('organizations', 'DescribeCreateAccountStatus', 'polled until created', 1, False))
+        operations.append(('sts', 'AssumeRole', "new account {} (readiness probe)".format(spec['accountrole']), 1, False))
+        return operations
+    if name == 'iac_roles':
+        operations = [('sts', 'AssumeRole', "IaC account {}".format(spec['accountrole']), 1, False)]
+        if ishub:
+            operations.append(('s3', 'HeadBucket', hubbucket, 1, False))
+            operations.append(('s3', 'CreateBucket', hubbucket, 1, True))
+            operations.extend(role_operations('IaC account', "ec2_iacbuild_"+spec['parenthub'], instance_profile=True))
+            operations.extend(role_operations('IaC account', "ec2_iacdeploy_"+spec['parenthub'], instance_profile=True))
+        operations.extend(role_operations('IaC account', "s3_iac_"+spec['accountname']))
+        return operations
+    if name == 'hub_role_policies':
+        operations = []
+        for rolename in ("ec2_iacbuild_"+spec['parenthub'], "ec2_iacdeploy_"+spec['parenthub']):
+            operations.extend([
+                ('iam', 'ListAttachedRolePolicies', "IaC account "+rolename, 1, False),
+                ('iam', 'GetPolicy', "IaC account "+rolename+" each spoke grant policy", 1, False),
+                ('iam', 'GetPolicyVersion', "IaC account "+rolename+" each spoke grant policy", 1, False),
+                ('iam', 'ListRolePolicies', "IaC account "+rolename, 1, False),
+                ('iam', 'ListPolicyVersions', "IaC account "+rolename+" spoke grant policy with room", 1, False),
+                ('iam', 'CreatePolicyVersion', "IaC account "+rolename+" spoke grant policy with room", 1, True)
+            ])
+        return operations
+    if name == 'provider_files':
+        return [
+            ('ec2', 'DescribeRegions', 'only when the region cache is stale', 1, False),
+            ('ec2', 'DescribeAvailabilityZones', 'each region, only when the region cache is stale', regions, False),
+            ('s3', 'PutObject', hubbucket+' providers/'+spec['accountname']+'/', 2, True)
+        ]
+    if name == 'account_roles':
+        operations = [('iam', 'GetRole', "IaC account hub roles (readiness probe)", 2, False)]
+        operations.extend(role_operations('new account', 'terraform_reader', managed_policies=1))
+        operations.extend(role_operations('new account', 'terraform_writer', managed_policies=1))
+        return operations
+    if name == 'default_vpc':
+        if spec['removedefaultvpc'] == 'false':
+            return []
+        return [
+            ('ec2', 'DescribeRegions', 'new account', 1, False),
+            ('ec2', 'DescribeVpcs', 'each region', regions, False),
+            ('ec2', 'DescribeNetworkInterfaces', 'each region', regions, False),
+            ('ec2', 'DescribeInternetGateways', 'each region', regions, False),
+            ('ec2', 'DescribeSubnets', 'each region', regions, False),
+            ('ec2', 'DescribeSecurityGroups', 'each region', regions, False),
+            ('ec2', 'DescribeRouteTables', 'each region', regions, False),
+            ('ec2', 'DescribeNetworkAcls', 'each region', regions, False),
+            ('ec2', 'DetachInternetGateway', 'each region', regions, True),
+            ('ec2', 'DeleteInternetGateway', 'each region', regions, True),
+            ('ec2', 'DeleteSubnet', 'each default subnet, one per availability zone', regions, True),
+            ('ec2', 'DeleteVpc', 'each region', regions, True)
+        ]
+    if name == 'ou_membership':
+        path = ou_path(spec,settings)
+        if not path:
+            return []
+        return [
+            ('organizations', 'ListRoots', 'only when the OU index is not yet built', 1, False),
+            ('organizations', 'ListOrganizationalUnitsForParent', 'each OU, only when the OU index is not yet built', 1, False),
+            ('organizations', 'CreateOrganizationalUnit', "{} (when missing)".format(path), len(path.split('/')), True),
+            ('organizations', 'ListParents', spec['accountname'], 1, False),
+            ('organizations', 'MoveAccount', "to OU {}".format(path), 1, True)
+        ]
+    return []
+
+def plan_step_worst_case(name,spec,settings,operations,regions):
+    # Function returning the worst case seconds of a provisioning step from the configured timeouts, retry and sleep constants:
+    #   every call at plan_call_seconds (or the interval of its [RateLimit] rate when longer), plus readiness probe timeouts,
+    #   plus one eventual consistency window for each role whose policies are set straight after it is created, plus the
+    #   default VPC sweep bound.  Account creation, including its readiness probe, is bounded by its step_budget().
+    retry = retry_settings()
+    limits = rate_limit_settings()['limits']
+
+    def call_seconds(service, operation):
+        limit = limits.get((service + '.' + operation).lower(), limits.get(service))
+        return max(settings['plan_call_seconds'], 1.0 / limit) if limit else settings['plan_call_seconds']
+
+    seconds = sum(operation[3] * call_seconds(operation[0], operation[1]) for operation in operations)
+    roles_created = len([operation for operation in operations if operation[1] == 'CreateRole'])
+    if name == 'create_account':
+        seconds = step_budget(name,settings)
+    elif name == 'account_roles':
+        # A hub's agent roles were only just created by iac_roles, a spoke's hub roles are long since usable.
+        if spec['ishub'] == 'true':
+            seconds += retry['readiness_timeout']
+        seconds += roles_created * retry['consistency_window']
+    elif name == 'hub_role_policies' and spec['ishub'] == 'true':
+        seconds += retry['consistency_window']
+    elif name == 'default_vpc' and operations:
+        # Each region makes six rounds of concurrent calls (lookup, describes and three layers of deletes before DeleteVpc),
+        #   deletes may retry on DependencyViolation while the previous layer settles.
+        rounds = -(-regions // max(1,settings['vpc_delete_workers']))
+        per_region = min(settings['vpc_delete_region_timeout'], retry['consistency_window'] + 6 * settings['plan_call_seconds'])
+        seconds = min(settings['vpc_delete_sweep_timeout'], rounds * per_region)
+    else:
+        seconds += roles_created * retry['consistency_window']
+    return round(seconds,1)
+
+def plan_account(spec,settings,regions=None):
+    # Function to plan provisioning an account without making any changes: the ordered AWS operations of each step, the number
+    #   of regions affected and a worst case time, with warnings when the plan cannot complete: a step that does not fit in
+    #   one Lambda invocation, or more invocations than max_invocations.  A plan resuming from checkpoints over several
+    #   invocations is expected and only noted.
+    #   The only AWS call made is DescribeRegions, when regions is not given.
+    # Parameters:
+    #   spec:     Account request parameters, see account_spec_from_environment().
+    #   settings: Bootstrapper settings, see load_settings().
+    #   regions:  Optional number of regions enabled.
+    # Returns a plan dictionary, see print_plan().
+    if regions is None:
+        regions = len(enabled_regions())
+    tasks = provisioning_tasks(spec)
+    steps = []
+    durations = {}
+    for (name, step, dependencies) in tasks:
+        operations = plan_step_operations(name,spec,settings,regions)
+        durations[name] = plan_step_worst_case(name,spec,settings,operations,regions)
+        steps.append({
+            'step': name,
+            'after': dependencies,
+            'worst_case_seconds': durations[name],
+            'operations': [{'service': service, 'operation': operation, 'target': target, 'count': count, 'mutating': mutating}
+                           for (service, operation, target, count, mutating) in operations]
+        })
+    (path, total) = critical_path(tasks,durations)
+
+    warnings = []
+    notes = []
+    timeout = settings['lambda_timeout']
+    usable = timeout - settings['reinvoke_margin']
+    for (name, seconds) in durations.items():
+        if seconds > usable:
+            warnings.append("Step {} may take up to {}s, more than the {}s a single {}s Lambda invocation leaves it".format(name,seconds,usable,timeout))
+    if total > timeout:
+        invocations = int(-(-total // usable))
+        notes.append("Worst case {}s does not fit in the {}s Lambda timeout, up to {} invocations resuming from checkpoints".format(total,timeout,invocations))
+        if invocations > settings['max_invocations']:
+            warnings.append("Worst case needs more than the max_invocations setting of {} invocations".format(settings['max_invocations']))
+    return {
+        'accountname': spec['accountname'],
+        'ishub': spec['ishub'],
+        'parenthub': spec['parenthub'],
+        'regions': regions,
+        'steps': steps,
+        'api_calls': sum(operation['count'] for step in steps for operation in step['operations']),
+        'mutating_calls': sum(operation['count'] for step in steps for operation in step['operations'] if operation['mutating']),
+        'critical_path': path,
+        'worst_case_seconds': total,
+        'serial_worst_case_seconds': round(sum(durations.values()),1),
+        'lambda_timeout': timeout,
+        'warnings': warnings,
+        'notes': notes
+    }
+
+def print_plan(plan):
+    # Function to print a plan from plan_account() as the ordered list of AWS operations each step would run.
+    print("Plan for {} ({}, parent hub {}): {} API calls of which {} make changes, {} regions".format(
+        plan['accountname'],'hub' if plan['ishub'] == 'true' else 'spoke',plan['parenthub'],plan['api_calls'],plan['mutating_calls'],plan['regions']))
+    number = 0
+    for step in plan['steps']:
+        print("  {} (after {}), worst case {}s".format(step['step'],", ".join(step['after']) or "start",step['worst_case_seconds']))
+        for operation in step['operations']:
+            number += 1
+            print("    {:>3}. {}{}:{} x{} {}".format(number,'* ' if operation['mutating'] else '',operation['service'],operation['operation'],operation['count'],operation['target']))
+    print("  Worst case {}s along {} ({}s if run one step at a time), Lambda timeout {}s".format(
+        plan['worst_case_seconds']," -> ".join(plan['critical_path']),plan['serial_worst_case_seconds'],plan['lambda_timeout']))
+    for note in plan['notes']:
+        print("  NOTE: {}".format(note))
+    for warning in plan['warnings']:
+        print("  WARNING: {}".format(warning))
+
+def run_provisioning_steps(spec,settings,state,event=None,context=None,store=None,checkpoint_key=None,tasks=None):
+    # Function to run the provisioning tasks that have not yet completed, see provisioning_tasks(), on step_workers threads.
+    #   Progress is persisted as each task completes.  Before starting a task the remaining Lambda time is compared with
+    #   the task's budget, tasks that would not fit are left for the caller to resume from the checkpoint in a new invocation.
+    # Parameters:
+    #   spec:           Account request parameters, see account_spec_from_environment().
+    #   settings:       Bootstrapper settings, see load_settings().
+    #   state:          Checkpoint state, updated in place with the 'completed' task names, 'timings', 'step_metrics', 'timeline' and task outputs.
+    #   event:          The cloudformation event, used by steps that respond to cloudformation on failure.
+    #   context:        Optional Lambda context object, no time checks are made without it.
+    #   store:          Optional checkpoint store the state is saved to after each task.
+    #   checkpoint_key: The key the state is saved under in the checkpoint store.
+    #   tasks:          Optional task list to run instead of provisioning_tasks(spec), see update_tasks().
+    # Returns 'complete' when all tasks have run, or 'suspended' when stopped to stay within the Lambda timeout.
+    if tasks is None:
+        tasks = provisioning_tasks(spec)
+    state_lock = threading.Lock()
+    for name in state['completed']:
+        log_event('step_skipped', step=name, reason='completed')
+
+    def can_start(name):
+        if context is None:
+            return True
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        if remaining < step_budget(name,settings) + settings['reinvoke_margin']:
+            log_event('step_deferred', step=name, remaining=round(remaining))
+            return False
+        return True
+
+    def on_complete(name, outputs):
+        with state_lock:
+            if outputs:
+                state.update(outputs)
+            state['completed'].append(name)
+            if store is not None:
+                store.save(checkpoint_key,state)
+
+    def on_progress(outputs):
+        with state_lock:
+            state.update(outputs)
+            if store is not None:
+                store.save(checkpoint_key,state)
+
+    def run_step(name, step):
+        # Steps run on worker threads, the account and step are attached to every log line they write.
+        _log_context.account = spec['accountname']
+        _log_context.step = name
+        _step_progress.save = on_progress
+        start = time.time()
+        log_event('step_start')
+        try:
+            outputs = step(spec,settings,state,event)
+            log_event('step_end', status='complete', elapsed=round(time.time()-start,2))
+            return outputs
+        except Exception as e:
+            log_event('step_end', status='failed', elapsed=round(time.time()-start,2), error=str(e))
+            raise
+        finally:
+            # Kept with the timings, so the run history of an account resumed over several invocations covers every step.
+            with state_lock:
+                state.setdefault('step_metrics', {})[name] = step_metrics(spec['accountname'],name)
+            _log_context.account = None
+            _log_context.step = None
+            _step_progress.save = None
+
+    graph_tasks = []
+    for (name, step, dependencies) in tasks:
+        graph_tasks.append((name, functools.partial(run_step,name,step), dependencies))
+    timeline = {}
+    try:
+        (pending, timeline) = run_task_graph(graph_tasks,settings['step_workers'],state['completed'],can_start,on_complete,timeline)
+    finally:
+        # The timeline of this invocation is recorded even when a task failed, it shows what ran concurrently.
+        for (name, times) in timeline.items():
+            state['timings'][name] = round(times['end'] - times['start'],2)
+        state['timeline'] = timeline
+        (path, length) = critical_path(tasks,state['timings'])
+        state['critical_path'] = path
+        log_event('provisioning_timeline', timeline=timeline, critical_path=path, critical_path_seconds=length)
+    if pending:
+        return 'suspended'
+    return 'complete'
+
+def save_step_progress(outputs):
+    # Function for a provisioning step to checkpoint values before it completes, for those a re-run of the step after a failure
+    #   or timeout must not repeat (eg the CreateAccount request).  Does nothing when not called from run_provisioning_steps().
+    # Parameters:
+    #   outputs: Dictionary of values to add to the checkpoint state, as a step returns on completion.
+    save = getattr(_step_progress, 'save', None)
+    if save is not None:
+        save(outputs)
+
+def create_account_governor(settings):
+    # Function returning the process wide semaphore capping concurrent Organizations CreateAccount requests,
+    #   sized by the create_account_concurrency setting so batch runs stay within the Organizations quota.
+    global _create_account_governor
+    with _cache_lock:
+        if _create_account_governor is None:
+            _create_account_governor = threading.BoundedSemaphore(max(1,settings['create_account_concurrency']))
+    return _create_account_governor
+
+def new_checkpoint_state():
+    # Function returning the initial checkpoint state for an account that has not started provisioning.
+    return { 'completed': [], 'timings': {}, 'invocations': 0 }
+
+def carry_over_state(state):
+    # Function returning the checkpoint state a new request for the account starts from after a run that did not complete.
+    #   Only a CreateAccount request that had not produced the account is carried over, so a retry polls it rather than
+    #   creating a second account (see create_account()).  Invocation counts and step progress belong to the failed run.
+    # Returns the new state, or None when there is nothing to carry over.
+    if state.get('create_account_request_id') is None or state.get('account_id') is not None:
+        return None
+    carried = new_checkpoint_state()
+    carried['create_account_request_id'] = state['create_account_request_id']
+    return carried
+
+def provision_account(spec,settings,root_id,top_level_account,event=None,context=None,store=None,resume=False):
+    # Function to provision a single account, resuming from its checkpoint in the store when one exists.
+    # Parameters:
+    #   spec:              Account request parameters, see account_spec_from_environment().
+    #   settings:          Bootstrapper settings, see load_settings().
+    #   root_id:           The AWS root organization Identifier of the master account.
+    #   top_level_account: The master account id.
+    #   event:             Optional cloudformation event, failure responses are only sent to cloudformation when provided.
+    #   context:           Optional Lambda context object used to stop before the Lambda times out.
+    #   store:             Optional checkpoint store, the checkpoint key is the account name.
+    #   resume:            True when re-invoked to resume an account suspended by a previous invocation of the same request.
+    #                      A new request only takes over the CreateAccount request of a failed run, see carry_over_state().
+    # Returns a report dictionary for the account, see provision_accounts().
+    checkpoint_key = spec['accountname']
+    state = None
+    if store is not None:
+        state = store.load(checkpoint_key)
+        if state is not None and resume:
+            log_event('checkpoint_resume', checkpoint=checkpoint_key, completed=state['completed'], invocations=state['invocations'])
+        elif state is not None:
+            state = carry_over_state(state)
+    if state is None:
+        state = new_checkpoint_state()
+    state['invocations'] += 1
+    state['root_id'] = root_id
+    state['top_level_account'] = top_level_account
+
+    report = { 'accountname': spec['accountname'], 'ishub': spec['ishub'], 'parenthub': spec['parenthub'], 'region': spec['stackregion'],
+               'status': None, 'account_id': None, 'role': None, 'timings': state['timings'], 'error': None, 'responded': False }
+    start = time.time()
+    if state['invocations'] > settings['max_invocations']:
+        report['status'] = 'failed'
+        report['error'] = "Account provisioning did not complete within {} invocations".format(settings['max_invocations'])
+    else:
+        try:
+            report['status'] = run_provisioning_steps(spec,settings,state,event,context,store,checkpoint_key)
+        except ProvisioningError as e:
+            log_event('account_error', error=str(e))
+            report['status'] = 'failed'
+            report['error'] = str(e)
+            report['responded'] = e.responded
+        except Exception as e:
+            log_event('account_error', exception=type(e).__name__, arguments=repr(e.args))
+            report['status'] = 'failed'
+            report['error'] = "{}: {}".format(type(e).__name__,e)
+
+    if store is not None:
+        if report['status'] == 'suspended':
+            store.save(checkpoint_key,state)
+        elif report['status'] == 'failed' and carry_over_state(state) is not None:
+            store.save(checkpoint_key,carry_over_state(state))
+        else:
+            store.delete(checkpoint_key)
+    report['account_id'] = state.get('account_id')
+    report['role'] = state.get('role')
+    report['critical_path'] = state.get('critical_path')
+    report['step_metrics'] = state.get('step_metrics', {})
+    report['elapsed'] = round(time.time() - start,2)
+    log_event('account_provisioned', status=report['status'], timings=state['timings'], elapsed=report['elapsed'])
+    return report
+
+def provision_accounts(specs,settings,root_id,top_level_account,event=None,context=None,store=None,resume=False):
+    # Function to provision a fleet of accounts concurrently, the single Service Catalog account is a fleet of one.
+    #   Accounts run on fleet_workers threads while CreateAccount calls are capped by create_account_governor().
+    #   Hub accounts are started before any spoke, and a spoke whose parent hub is part of the same fleet waits for that
+    #   hub to complete (and is skipped if it does not).  Spokes of hubs that already exist start straight away.
+    #   Every account is first checked by preflight(), accounts failing it are rejected without any change being made.
+    # Parameters:
+    #   specs:     List of account request parameter dictionaries, see account_spec_from_environment().
+    #   others:    As for provision_account().
+    # Returns a list of per account report dictionaries, in the order of specs, with keys:
+    #   accountname, ishub, parenthub, region, status ('complete'|'suspended'|'failed'|'skipped'|'rejected'), account_id, role, timings,
+    #   step_metrics (per step AWS API calls, retries and seconds slept), critical_path, elapsed, error, responded
+
+    hubs = [spec for spec in specs if spec['ishub'] == 'true']
+    spokes = [spec for spec in specs if spec['ishub'] != 'true']
+    hub_futures = {}
+    futures = {}
+    problems = preflight(specs,settings,store if resume else None) if settings['preflight'] and specs else {}
+
+    def unstarted_report(spec, status, error):
+        return { 'accountname': spec['accountname'], 'ishub': spec['ishub'], 'parenthub': spec['parenthub'], 'region': spec['stackregion'],
+                 'status': status, 'account_id': None, 'role': None, 'timings': {}, 'step_metrics': {}, 'critical_path': None, 'elapsed': 0,
+                 'responded': False, 'error': error }
+
+    def provision_checked(spec):
+        if spec['accountname'] in problems:
+            error = "Preflight checks failed: {}".format("; ".join(problems[spec['accountname']]))
+            log_event('account_rejected', account=spec['accountname'], error=error)
+            return unstarted_report(spec, 'rejected', error)
+        return provision_account(spec,settings,root_id,top_level_account,event,context,store,resume)
+
+    def provision_spoke(spec):
+        hub_future = hub_futures.get(spec['parenthub'])
+        if hub_future is not None:
+            hub_report = hub_future.result()
+            if hub_report['status'] != 'complete':
+                return unstarted_report(spec, 'skipped', "Parent hub {} is {}".format(spec['parenthub'],hub_report['status']))
+        return provision_checked(spec)
+
+    # Hubs are submitted first so they are always running before any spoke blocks waiting on them.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,settings['fleet_workers']))
+    try:
+        for spec in hubs:
+            future = executor.submit(provision_checked,spec)
+            hub_futures[spec['accountname']] = future
+            futures[spec['accountname']] = future
+        for spec in spokes:
+            futures[spec['accountname']] = executor.submit(provision_spoke,spec)
+        reports = [futures[spec['accountname']].result() for spec in specs]
+    finally:
+        executor.shutdown(wait=True)
+
+    log_event('fleet_provisioned', statuses=dict((report['accountname'], report['status']) for report in reports))
+    return reports
+
+def load_manifest(source):
+    # Function to read a fleet manifest of accounts to provision from a local file or an s3://bucket/key location.
+    #   JSON manifests hold a list of account objects, or an object with an "accounts" list and optional "defaults" applied to every account.
+    #   CSV manifests hold one account per row with a header row naming the columns.
+    #   Columns are the Service Catalog parameters: accountname, accountemail, parenthub, ishub, stackregion, removedefaultvpc,
+    #   plus optionally iac_account_id, sourcebucket and stackname which otherwise default to the Lambda environment variables.
+    # Returns the list of account request parameter dictionaries.
+    if source.startswith('s3://'):
+        (bucket, key) = source[5:].split('/',1)
+        content = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    else:
+        with open(source, 'r') as manifest_file:
+            content = manifest_file.read()
+
+    defaults = {}
+    if source.lower().endswith('.csv'):
+        import csv
+        entries = list(csv.DictReader(io.StringIO(content)))
+    else:
+        entries = json.loads(content)
+        if isinstance(entries, dict):
+            defaults = entries.get('defaults', {})
+            entries = entries['accounts']
+
+    specs = []
+    for entry in entries:
+        values = dict(defaults)
+        values.update(dict((k.strip(), v.strip() if isinstance(v, str) else v) for (k, v) in entry.items() if k))
+        specs.append(account_spec(values))
+    names = [spec['accountname'] for spec in specs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("Manifest lists accounts more than once: {}".format(", ".join(duplicates)))
+    return specs
+
+def account_spec(values):
+    # Function to build account request parameters from a manifest entry, falling back to the Lambda environment variables.
+    ishub = str(values.get('ishub', 'false')).lower()
+    accountname = values['accountname']
+    return {
+        'accountname': accountname,
+        'accountemail': values['accountemail'],
+        'parenthub': accountname if ishub == 'true' and not values.get('parenthub') else values.get('parenthub', ''),
+        'ishub': ishub,
+        'accountrole': values.get('accountrole', 'OrganizationAccountAccessRole'),
+        'iac_account_id': str(values.get('iac_account_id') or os.environ.get('iac_account_id', '')),
+        'stackname': values.get('stackname') or 'yourcompanynameORcustomprefix-accountbootstrapper-' + accountname,
+        'stackregion': values.get('stackregion') or os.environ.get('stackregion', 'us-west-2'),
+        'sourcebucket': values.get('sourcebucket') or os.environ.get('sourcebucket', 'yourcompanynameORcustomprefix-iac-master'),
+        'removedefaultvpc': str(values.get('removedefaultvpc', 'true')).lower()
+    }
+
+def organization_root():
+    # Function returning the (root_id, master account id) of the organization, root_id is "Error" if the root cannot be listed.
+    #   The root is cached, see metadata_cache().
+    def list_root():
+        list_roots_response = get_client('organizations').list_roots()
+        #print(list_roots_response)
+        return [list_roots_response['Roots'][0]['Id'], list_roots_response['Roots'][0]['Arn'].split(':')[4]]
+    try:
+        (root_id, top_level_account) = metadata_cache().get('organization_root', list_root)
+    except:
+        root_id = "Error"
+        top_level_account = None
+    return (root_id, top_level_account)
+
+def batch_main(event,context):
+    # Lambda entry point for fleet provisioning from a manifest, configure the Lambda handler as AccountCreationLambda.batch_main.
+    #   The event supplies either "Manifest" (a local path or s3://bucket/key) or an inline "Accounts" list.
+    #   Accounts not finished before the Lambda runs out of time are checkpointed, and the Lambda re-invokes itself with just those
+    #   accounts and "Resume" set, which is the only time their checkpoints are resumed from.
+    # Returns the per account report list, see provision_accounts().
+    reset_api_metrics()
+    log_event('invocation', handler='batch_main', request=event)
+    set_retry_deadline(context)
+    settings = load_settings()
+    if 'Accounts' in event:
+        specs = [account_spec(entry) for entry in event['Accounts']]
+    else:
+        specs = load_manifest(event['Manifest'])
+    (root_id, top_level_account) = organization_root()
+    if root_id == "Error":
+        log_event('organization_root', status='failed', error="Cannot access the AWS Organization ROOT")
+        return []
+    store = checkpoint_store(settings,specs[0]) if specs else None
+    reports = provision_accounts(specs,settings,root_id,top_level_account,None,context,store,resume=event.get('Resume',False))
+    emit_run_summary(reports)
+    record_run_history(reports,run_history_store(settings,specs[0]['sourcebucket'] if specs else None),'batch')
+
+    suspended = [spec for (spec, report) in zip(specs, reports) if report['status'] == 'suspended']
+    if suspended:
+        log_event('fleet_suspended', accounts=[spec['accountname'] for spec in suspended])
+        resume_event = { 'Accounts': suspended, 'Resume': True }
+        selfinvoke(resume_event,'Batch')
+    return reports
+
+def main(event,context):
+    # Main function branch of Bootstrapper account creation code.
+    # "Create" provisions the account, "Update" applies only the request parameters that changed, see update_account().
+    # Parameters are read from two sources, 
+    #   in the first block these variables are read from environment variables set from cloudformation Service Catalog product.
+    #   in the second block the variables are read from a bootstrapper.ini file included as part of the bootstrapper Service Catalog solution.
+    # Progress is checkpointed after each provisioning step.  When the Lambda is about to run out of time it re-invokes itself
+    # with the checkpoint key in event['Checkpoint'] and the new invocation resumes from the first step not yet completed.
+    
+    reset_api_metrics()
+    log_event('invocation', handler='main', request=event)
+    set_retry_deadline(context)
+    client = get_client('organizations')
+
+    # Read account bootstrapper configuration from required "bootstrapper.ini" file.
+    settings = load_settings()
+
+    log_event('settings', access_to_billing=settings['access_to_billing'], baselinetemplate=settings['baselinetemplate'],
+              testaccountid=settings['testaccountid'], testmode=settings['testmode'], planmode=settings['planmode'],
+              vpc_delete_workers=settings['vpc_delete_workers'], checkpoint_store=settings['checkpoint_store'])
+
+    scp = None
+
+    if (event['RequestType'] == 'Create'):
+        spec = account_spec_from_environment()
+        stackregion = spec['stackregion']
+        store = checkpoint_store(settings,spec)
+        if settings['planmode']:
+            plan = plan_account(spec,settings)
+            log_event('plan', plan=plan)
+            # The stack outputs read AccountID and LoginURL, without them the stack fails and rolls back.
+            respond_cloudformation(event, "SUCCESS", { "Message": "Plan only, no changes were made. Worst case {}s.".format(plan['worst_case_seconds']),
+                                                       "Warnings": " ".join(plan['warnings']),
+                                                       "LoginURL": "none (plan mode)",
+                                                       "AccountID": "none (plan mode)",
+                                                       "Role": "none (plan mode)",
+                                                       "Stackregion": stackregion })
+            return
+        if event.get('Checkpoint') is None:
+            selfinvoke(event,'Wait')
+        top_level_account = event['ServiceToken'].split(':')[4]
+        
+        (root_id, master_account_id) = organization_root()
+    
+        if root_id != "Error":
+            ### List the available AWS Oranization OU's 
+            #if(organization_unit_name is not None):
+                #(organization_unit_name,organization_unit_id) = get_ou_name_id(root_id,organization_unit_name)
+            report = provision_accounts([spec],settings,root_id,top_level_account,event,context,store,resume=event.get('Checkpoint') is not None)[0]
+            emit_run_summary([report])
+            record_run_history([report],run_history_store(settings,spec['sourcebucket']),'create')
+
+            if report['status'] == 'suspended':
+                event['Checkpoint'] = spec['accountname']
+                selfinvoke(event,'Create')
+                return
+            if report['status'] == 'rejected':
+                # Nothing was created, the stack rollback removes the Lambda.
+                respond_cloudformation(event, "FAILED", { "Message": report['error'] })
+                return
+            if report['status'] != 'complete':
+                if not report['responded']:
+                    delete_respond_cloudformation(event, "FAILED", "{}. Deleting Lambda Function.".format(report['error']))
+                return
+
+            account_id = report['account_id']
+            if scp is not None:
+                attach_policy_response = client.attach_policy(PolicyId=scp, TargetId=account_id)
+                log_event('scp_attached', policy=scp, account_id=account_id, response=attach_policy_response)
+                
+            respond_cloudformation(event, "SUCCESS", { "Message": "Account Created!", 
+                                                       "LoginURL" : "https://"+account_id+".signin.aws.amazon.com/console?region="+stackregion+"#", 
+                                                       "AccountID" : account_id, 
+                                                       "Role" : report['role'], 
+                                                       "Stackregion": stackregion },
+                                   physical_resource_id=account_id)
+        else:
+            log_event('organization_root', status='failed', error="Cannot access the AWS Organization ROOT")
             #sys.exit(1)
             delete_respond_cloudformation(event, "FAILED", "Cannot access the AWS Organization ROOT. Contact the master account Administrator for more details.Deleting Lambda Function.")
 
     if(event['RequestType'] == 'Update'):
-        print("Template in Update Status")
-        respond_cloudformation(event, "SUCCESS", { "Message": "Resource update successful!" })
+        # Only the parameters that changed are applied again, see update_tasks().
+        spec = account_spec_from_properties(event.get('ResourceProperties', {}))
+        previous = previous_account_spec(spec,event.get('OldResourceProperties', {}))
+        store = checkpoint_store(settings,spec)
+        physical_id = event.get('PhysicalResourceId', '')
+        report = update_account(previous,spec,settings,event['ServiceToken'].split(':')[4],event,context,store,resume=event.get('Checkpoint') is not None,
+                                account_id=physical_id if re.match(r'^\d{12}$', physical_id) else None)
+        record_run_history([report],run_history_store(settings,spec['sourcebucket']),'update')
+        if report['status'] == 'suspended':
+            event['Checkpoint'] = spec['accountname']+'.update'
+            selfinvoke(event,'Update')
+            return
+        if report['status'] != 'complete':
+            # Nothing is deleted, the stack rollback sends the previous parameters back as another update.
+            respond_cloudformation(event, "FAILED", { "Message": report['error'] })
+            return
+        message = "Resource update successful!" if report['tasks'] else "Resource update successful, no changes needed."
+        if report['ignored']:
+            message += " Changes to {} require a new account and were not applied.".format(", ".join(report['ignored']))
+        account_id = report['account_id']
+        respond_cloudformation(event, "SUCCESS", { "Message": message,
+                                                   "LoginURL" : "https://"+account_id+".signin.aws.amazon.com/console?region="+spec['stackregion']+"#",
+                                                   "AccountID" : account_id,
+                                                   "Role" : report['role'],
+                                                   "Stackregion": spec['stackregion'] })
         #respond_cloudformation(event, "SUCCESS", { "Message": "Account Created!","Login URL : "https://" +account_id+".signin.aws.amazon.com/console", "AccountID" : account_id, "Username" : adminusername, "Role" : newrole })
 
     elif(event['RequestType'] == 'Delete'):
         try:
             delete_respond_cloudformation(event, "SUCCESS", "Delete Request Initiated. Deleting Lambda Function.")
         except:
-            print("Couldnt initiate delete response.")
+            log_event('cloudformation_response', status='failed', error="Couldnt initiate delete response")
+
+def cli(argv=None):
+    # Command line entry point for running the account bootstrapper outside of Service Catalog with master account credentials.
+    #   batch:  provision every account in a JSON/CSV manifest and write the per account report.
+    #   plan:   print the AWS operations and worst case time of provisioning every account in a manifest, without making changes.
+    #   reconcile: re-render the Terraform provider files of every account in the hub buckets and upload those that changed.
+    #   drift:  check the roles provisioned for every hub and spoke account are still as provisioned, and optionally put them back.
+    #   report: show the p50/p95 time of each provisioning step over time from the run history, and flag regressions.
+    # Imported here as the Lambda handlers never need it.
+    import argparse
+    parser = argparse.ArgumentParser(description='AWS Account Factory account bootstrapper')
+    subparsers = parser.add_subparsers(dest='command')
+    batch_parser = subparsers.add_parser('batch', help='Provision the accounts listed in a JSON or CSV manifest')
+    batch_parser.add_argument('manifest', help='Manifest file path or s3://bucket/key')
+    batch_parser.add_argument('--workers', type=int, help='Accounts provisioned concurrently (default fleet_workers setting)')
+    batch_parser.add_argument('--checkpoint-dir', help='Keep checkpoints in this local directory instead of the configured store')
+    batch_parser.add_argument('--report', help='Write the JSON report to this file instead of stdout')
+    batch_parser.add_argument('--history', help='Record the run in this SQLite file instead of the configured run history store')
+    plan_parser = subparsers.add_parser('plan', help='Show what provisioning the accounts in a manifest would do, without making changes')
+    plan_parser.add_argument('manifest', help='Manifest file path or s3://bucket/key')
+    plan_parser.add_argument('--regions', type=int, help='Number of enabled regions (default DescribeRegions)')
+    plan_parser.add_argument('--json', action='store_true', help='Print the plans as JSON')
+    reconcile_parser = subparsers.add_parser('reconcile', help='Refresh the Terraform provider files in the hub buckets from the current templates and regions')
+    reconcile_parser.add_argument('--hub', action='append', help='Hub to reconcile, may be repeated (default every hub bucket)')
+    reconcile_parser.add_argument('--manifest', help='Manifest giving the accounts default regions (default read from their build provider file)')
+    reconcile_parser.add_argument('--iac-account-id', default=os.environ.get('iac_account_id'), help='IaC account id (default iac_account_id environment variable)')
+    reconcile_parser.add_argument('--accountrole', default='OrganizationAccountAccessRole', help='Role assumed in the IaC account')
+    reconcile_parser.add_argument('--sourcebucket', default=os.environ.get('sourcebucket', 'yourcompanynameORcustomprefix-iac-master'), help='Master bucket holding the region map')
+    reconcile_parser.add_argument('--workers', type=int, help='Concurrent listings, renders and uploads (default reconcile_workers setting)')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='Report the files that would be uploaded without uploading them')
+    drift_parser = subparsers.add_parser('drift', help='Check the roles provisioned for every hub and spoke account, and optionally remediate them')
+    drift_parser.add_argument('--hub', action='append', help='Hub whose accounts are checked, may be repeated (default every hub)')
+    drift_parser.add_argument('--manifest', help='Manifest listing the accounts to check (default every account with provider files in a hub bucket)')
+    drift_parser.add_argument('--iac-account-id', default=os.environ.get('iac_account_id'), help='IaC account id (default iac_account_id environment variable)')
+    drift_parser.add_argument('--accountrole', default='OrganizationAccountAccessRole', help='Role assumed in the IaC account and each account checked')
+    drift_parser.add_argument('--workers', type=int, help='Accounts checked concurrently (default drift_workers setting)')
+    drift_parser.add_argument('--remediate', action='store_true', help='Put back the roles and grants that drifted')
+    report_parser = subparsers.add_parser('report', help='Show per step p50/p95 timings from the run history and flag regressions against a baseline window')
+    report_parser.add_argument('--history', help='Read the run history from this SQLite file instead of the configured store')
+    report_parser.add_argument('--sourcebucket', default=os.environ.get('sourcebucket', 'yourcompanynameORcustomprefix-iac-master'), help='Master bucket holding an s3 run history')
+    report_parser.add_argument('--window-days', type=float, help='Days of recent runs compared with the baseline (default history_window_days setting)')
+    report_parser.add_argument('--baseline-days', type=float, help='Days before the recent window the baseline covers (default history_baseline_days setting)')
+    report_parser.add_argument('--period-days', type=float, help='Days summarised by each p50/p95 row (default history_period_days setting)')
+    report_parser.add_argument('--threshold', type=float, help='Slowdown, as a fraction of the baseline, flagged as a regression (default regression_threshold setting)')
+    report_parser.add_argument('--account-type', choices=['hub', 'spoke'], help='Only report hub or spoke accounts')
+    report_parser.add_argument('--region', help='Only report accounts with this stack region')
+    report_parser.add_argument('--request', choices=['create', 'update', 'batch'], help='Only report runs of this kind')
+    report_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan':
+        settings = load_settings()
+        plans = [plan_account(spec,settings,args.regions) for spec in load_manifest(args.manifest)]
+        if args.json:
+            print(json.dumps(plans, indent=2))
+        else:
+            for plan in plans:
+                print_plan(plan)
+        return 1 if any(plan['warnings'] for plan in plans) else 0
+    if args.command == 'reconcile':
+        if not args.iac_account_id:
+            print("The IaC account id is required, pass --iac-account-id or set the iac_account_id environment variable.")
+            return 2
+        settings = load_settings()
+        if args.workers:
+            settings['reconcile_workers'] = args.workers
+        specs = load_manifest(args.manifest) if args.manifest else None
+        report = reconcile_provider_files(settings,args.iac_account_id,args.accountrole,args.sourcebucket,hubs=args.hub,specs=specs,dry_run=args.dry_run)
+        print(json.dumps(report, indent=2))
+        return 1 if report['errors'] or report['skipped'] else 0
+    if args.command == 'drift':
+        if not args.iac_account_id:
+            print("The IaC account id is required, pass --iac-account-id or set the iac_account_id environment variable.")
+            return 2
+        settings = load_settings()
+        if args.workers:
+            settings['drift_workers'] = args.workers
+        specs = load_manifest(args.manifest) if args.manifest else None
+        report = scan_drift(settings,args.iac_account_id,args.accountrole,hubs=args.hub,specs=specs,remediate=args.remediate)
+        print(json.dumps(report, indent=2))
+        return 1 if report['errors'] or (report['drifted'] and not args.remediate) else 0
+    if args.command == 'report':
+        settings = load_settings()
+        for (name, value) in (('history_window_days', args.window_days), ('history_baseline_days', args.baseline_days),
+                              ('history_period_days', args.period_days), ('regression_threshold', args.threshold)):
+            if value is not None:
+                settings[name] = value
+        store = SqliteRunHistoryStore(args.history) if args.history else run_history_store(settings,args.sourcebucket)
+        if store is None:
+            print("No run history is kept, set run_history_store in bootstrapper.ini or pass --history.")
+            return 2
+        now = time.time()
+        records = [record for record in store.load(now - (settings['history_window_days'] + settings['history_baseline_days']) * 86400)
+                   if (args.account_type is None or record['account_type'] == args.account_type) and
+                      (args.region is None or record['region'] == args.region) and (args.request is None or record['request'] == args.request)]
+        report = run_history_report(records,settings,now)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_run_history_report(report)
+        return 1 if report['regressions'] else 0
+    if args.command == 'batch':
+        settings = load_settings()
+        if args.workers:
+            settings['fleet_workers'] = args.workers
+        specs = load_manifest(args.manifest)
+        (root_id, top_level_account) = organization_root()
+        if root_id == "Error":
+            print("Cannot access the AWS Organization ROOT. Contact the master account Administrator for more details.")
+            return 1
+        if args.checkpoint_dir:
+            store = LocalFileCheckpointStore(args.checkpoint_dir)
+        else:
+            store = checkpoint_store(settings,specs[0]) if specs else None
+        reset_api_metrics()
+        reports = provision_accounts(specs,settings,root_id,top_level_account,store=store)
+        emit_run_summary(reports)
+        history = SqliteRunHistoryStore(args.history) if args.history else run_history_store(settings,specs[0]['sourcebucket'] if specs else None)
+        record_run_history(reports,history,'batch')
+        output = json.dumps(reports, indent=2, default=str)
+        if args.report:
+            with open(args.report, 'w') as report_file:
+                report_file.write(output)
+        else:
+            print(output)
+        return 0 if all(report['status'] == 'complete' for report in reports) else 1
+    parser.print_help()
+    return 2
+
+def warm_up():
+    # Function run once when a Lambda container starts, during the Lambda init phase, paying the one off costs of the first
+    #   invocation up front: reading bootstrapper.ini and the templates, building the shared session and the response pool,
+    #   and creating a client for each warm_clients service, which loads the service models every later client of that
+    #   service (including those for assumed roles) shares.
+    start = time.time()
+    config = read_config()
+    provider_templates()
+    response_pool()
+    for service in [service.strip() for service in config.get('Performance', 'warm_clients', fallback='').split(',') if service.strip()]:
+        get_client(service)
+    log_event('warm_up', elapsed=round(time.time()-start,2))
+
+if os.environ.get('AWS_EXECUTION_ENV', '').startswith('AWS_Lambda_'):
+    try:
+        warm_up()
+    except Exception as e:
+        log_event('warm_up', status='failed', error=str(e))
 
+if __name__ == '__main__':
+    sys.exit(cli())
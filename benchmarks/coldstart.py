@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+ ######################################################################################
+ #
+ # Cold start benchmark of the account bootstrapper Lambda.
+ #
+ # Starts a fresh python process for every run, as a new Lambda container would,
+ # and measures the init phase (importing the module, including the warm up it
+ # does when AWS_EXECUTION_ENV says it is running in Lambda) and the latency of
+ # the first and second invocation's work: AWS calls through get_client()
+ # against moto, and sending a cloudformation response to a local endpoint.
+ #
+ #   pip install -r benchmarks/requirements.txt
+ #   python benchmarks/coldstart.py --runs 10
+ #   python benchmarks/coldstart.py --runs 3 --slow-endpoint 30
+ #
+ ######################################################################################
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run in each fresh process.  moto's own import is not timed, it is started before the bootstrapper is
+# imported so clients created by the warm up are served by moto rather than AWS.
+CHILD = r'''
+import json, os, sys, threading, time
+sys.path.insert(0, os.getcwd())
+timings = {}
+start = time.perf_counter()
+import boto3
+timings['import_boto3_ms'] = (time.perf_counter() - start) * 1000
+
+from moto import mock_aws
+mock = mock_aws()
+mock.start()
+boto3.client('organizations').create_organization(FeatureSet='ALL')
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+slow_endpoint = float(sys.argv[1])
+class Endpoint(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(slow_endpoint)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+server = HTTPServer(('127.0.0.1', 0), Endpoint)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+event = {'ServiceToken': 'arn:aws:lambda:us-east-1:123456789012:function:AccountCreationLambda', 'StackId': 'benchmark',
+         'RequestId': 'benchmark', 'LogicalResourceId': 'AccountCreation', 'ResponseURL': 'http://127.0.0.1:{}/response'.format(server.server_port)}
+
+start = time.perf_counter()
+import AccountCreationLambda
+timings['import_module_ms'] = (time.perf_counter() - start) * 1000
+timings['init_ms'] = timings['import_boto3_ms'] + timings['import_module_ms']
+
+for invocation in ('first', 'second'):
+    start = time.perf_counter()
+    AccountCreationLambda.get_client('organizations').list_roots()
+    AccountCreationLambda.get_client('sts').get_caller_identity()
+    AccountCreationLambda.get_client('iam').list_roles(MaxItems=1)
+    timings[invocation + '_calls_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    status = AccountCreationLambda.send_cloudformation_response(event, {'Status': 'SUCCESS', 'Data': {'Invocation': invocation}})
+    timings[invocation + '_response_ms'] = (time.perf_counter() - start) * 1000
+    timings[invocation + '_response_status'] = status
+print(json.dumps(timings))
+'''
+
+
+def run_once(warm_up, slow_endpoint):
+    # Function to run the benchmark code in a fresh process, returning its timings dictionary.
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'simulated')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'simulated')
+    env.pop('AWS_EXECUTION_ENV', None)
+    if warm_up:
+        env['AWS_EXECUTION_ENV'] = 'AWS_Lambda_python{}.{}'.format(*sys.version_info[:2])
+    output = subprocess.check_output([sys.executable, '-c', CHILD, str(slow_endpoint)], cwd=ROOT, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def benchmark(args):
+    # Function to run every mode the requested number of times and return the median of each timing per mode.
+    result = {}
+    for (mode, warm_up) in (('warm up at init', True), ('no warm up', False)):
+        runs = [run_once(warm_up, args.slow_endpoint) for _ in range(args.runs)]
+        result[mode] = dict((key, round(median([run[key] for run in runs if run[key] is not None]), 1) if not key.endswith('_status') else runs[-1][key])
+                            for key in runs[0])
+    return result
+
+
+def print_result(result):
+    keys = ['import_boto3_ms', 'import_module_ms', 'init_ms', 'first_calls_ms', 'first_response_ms', 'second_calls_ms', 'second_response_ms', 'first_response_status']
+    modes = list(result)
+    print("{:<24}".format('Median of runs') + "".join("{:>20}".format(mode) for mode in modes))
+    for key in keys:
+        print("{:<24}".format(key) + "".join("{:>20}".format(str(result[mode][key])) for mode in modes))
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the account bootstrapper Lambda cold start')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes started for each mode')
+    parser.add_argument('--slow-endpoint', type=float, default=0, help='Seconds the cloudformation response endpoint takes to answer')
+    parser.add_argument('--json', help='Write the result as JSON to this file')
+    args = parser.parse_args(argv)
+
+    result = benchmark(args)
+    print_result(result)
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(result, result_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+ ######################################################################################
+ #
+ # Local end to end benchmark of the account bootstrapper.
+ #
+ # Runs the real AccountCreationLambda handlers against moto's in-process stand-ins
+ # for Organizations, STS, IAM, EC2, S3 and Lambda, with simulated per-call latency,
+ # throttling and IAM/STS eventual consistency, and a virtual clock so every
+ # time.sleep() in the bootstrapper costs a fraction of its real duration.
+ #
+ # Reports the simulated wall clock time, and per step durations, API calls and
+ # time spent sleeping, so changes to the retry and wait logic can be compared.
+ #
+ #   pip install -r benchmarks/requirements.txt
+ #   python benchmarks/simulate.py --mode main --consistency-window 10
+ #   python benchmarks/simulate.py --mode batch --accounts 20 --hubs 2 --throttle-rate 0.05 --json result.json
+ #
+ ######################################################################################
+
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# The package is run from the repository root, bootstrapper.ini and templates/ are read relative to it.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'simulated')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'simulated')
+os.environ.setdefault('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+
+from botocore.awsrequest import AWSResponse
+from moto import mock_aws
+
+import AccountCreationLambda
+
+IAC_ACCOUNT_ID = '123456789012'
+SOURCE_BUCKET = 'yourcompanynameORcustomprefix-iac-master'
+
+
+class VirtualClock(object):
+    # Stand-in for the time module inside AccountCreationLambda.  Simulated time runs scale times faster than real time,
+    # so sleeps and injected latency cost 1/scale of their simulated duration while concurrency is still real.
+    # The clock stands still while moto is processing a request, so only the simulated latency counts as API time.
+    # Time slept is recorded against the provisioning step running on the calling thread.
+    def __init__(self, scale):
+        self.scale = float(scale)
+        self.origin = time.time()
+        self.lock = threading.Lock()
+        self.slept = collections.Counter()
+        self.frozen_depth = 0
+        self.frozen_since = 0.0
+        self.frozen_total = 0.0
+
+    def time(self):
+        with self.lock:
+            now = time.time()
+            frozen = self.frozen_total + (now - self.frozen_since if self.frozen_depth else 0)
+        return self.origin + (now - self.origin - frozen) * self.scale
+
+    def freeze(self):
+        with self.lock:
+            if self.frozen_depth == 0:
+                self.frozen_since = time.time()
+            self.frozen_depth += 1
+
+    def thaw(self):
+        with self.lock:
+            self.frozen_depth -= 1
+            if self.frozen_depth == 0:
+                self.frozen_total += time.time() - self.frozen_since
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.slept[current_step()] += seconds
+        self.pause(seconds)
+
+    def pause(self, seconds):
+        # Simulated seconds passing without being counted as a sleep, eg API latency.
+        deadline = self.time() + seconds
+        while True:
+            remaining = deadline - self.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining / self.scale, 0.01))
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class SimulatedContext(object):
+    # Lambda context object whose remaining time follows the virtual clock.
+    def __init__(self, clock, timeout):
+        self.clock = clock
+        self.deadline = clock.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - self.clock.time()) * 1000)
+
+
+def current_step():
+    # Function returning the provisioning step running on this thread, from the bootstrapper's log context.
+    step = getattr(AccountCreationLambda._log_context, 'step', None)
+    return step or '(unattributed)'
+
+
+def error_response(code, message):
+    # Function returning a botocore before-call short circuit response for an AWS error.
+    return (AWSResponse('https://simulated', 400, {}, None),
+            {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}})
+
+
+class Simulator(object):
+    # botocore event handlers added to the bootstrapper's shared session, injecting latency, throttling, a slow
+    # CreateAccount and eventual consistency in front of moto, and counting every call.
+    # Parameters:
+    #   clock:                  VirtualClock used by the bootstrapper.
+    #   latency:                Simulated seconds added to every API call.
+    #   jitter:                 Fraction of latency the added time varies by.
+    #   throttle_rate:          Probability any call is answered with a Throttling error.
+    #   tps_limits:             Dictionary of service name to the calls per simulated second it accepts, calls over it are throttled.
+    #   consistency_window:     Simulated seconds a new role or account is not yet usable for.
+    #   create_account_seconds: Simulated seconds CreateAccount stays IN_PROGRESS.
+    def __init__(self, clock, latency, jitter, throttle_rate, consistency_window, create_account_seconds, tps_limits=None):
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.tps_limits = tps_limits or {}
+        self.recent_calls = collections.defaultdict(collections.deque)
+        self.consistency_window = consistency_window
+        self.create_account_seconds = create_account_seconds
+        self.lock = threading.Lock()
+        self.roles_created = {}
+        self.accounts_ready = {}
+        self.create_requests = {}
+        self.calls = collections.Counter()
+        self.step_calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self.inconsistent = collections.Counter()
+        self.backend_seconds = 0.0
+
+    def register(self, events):
+        events.register('before-parameter-build', self.capture_params)
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call)
+
+    def capture_params(self, params, model, context, **kwargs):
+        context['simulator_params'] = dict(params)
+
+    def recently(self, created):
+        return created is not None and self.clock.time() - created < self.consistency_window
+
+    def before_call(self, model, context, **kwargs):
+        operation = (model.service_model.service_name, model.name)
+        params = context.get('simulator_params', {})
+        with self.lock:
+            self.calls[operation] += 1
+            self.step_calls[current_step()] += 1
+        self.clock.pause(max(0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter))))
+
+        if random.random() < self.throttle_rate or self.over_tps_limit(operation[0]):
+            with self.lock:
+                self.throttled[operation] += 1
+            return error_response('Throttling', 'Rate exceeded')
+        injected = self.consistency_error(operation, params)
+        if injected is not None:
+            with self.lock:
+                self.inconsistent[operation] += 1
+            return injected
+        if operation == ('organizations', 'DescribeCreateAccountStatus'):
+            started = self.create_requests.get(params.get('CreateAccountRequestId'))
+            if started is not None and self.clock.time() - started < self.create_account_seconds:
+                return (AWSResponse('https://simulated', 200, {}, None),
+                        {'CreateAccountStatus': {'Id': params['CreateAccountRequestId'], 'State': 'IN_PROGRESS'},
+                         'ResponseMetadata': {'HTTPStatusCode': 200}})
+        context['simulator_start'] = time.time()
+        self.clock.freeze()
+        return None
+
+    def over_tps_limit(self, service):
+        # Function recording a call against its service's limit, returns True when the last second already had the limit's worth.
+        if service not in self.tps_limits:
+            return False
+        now = self.clock.time()
+        with self.lock:
+            recent = self.recent_calls[service]
+            while recent and recent[0] <= now - 1:
+                recent.popleft()
+            if len(recent) >= self.tps_limits[service]:
+                return True
+            recent.append(now)
+        return False
+
+    def consistency_error(self, operation, params):
+        # Function returning the error IAM or STS gives while a role or account created moments ago propagates, or None.
+        (service, name) = operation
+        if service == 'iam' and name in ('PutRolePolicy', 'AttachRolePolicy', 'AddRoleToInstanceProfile'):
+            if self.recently(self.roles_created.get(params.get('RoleName'))):
+                return error_response('NoSuchEntity', 'The role with name {} cannot be found.'.format(params.get('RoleName')))
+        elif service == 'iam' and name in ('CreateRole', 'UpdateAssumeRolePolicy'):
+            document = params.get('AssumeRolePolicyDocument') or params.get('PolicyDocument') or ''
+            for principal in re.findall(r':role/([\w+=,.@-]+)', document):
+                if self.recently(self.roles_created.get(principal)):
+                    return error_response('MalformedPolicyDocument', 'Invalid principal in policy: "AWS":"{}"'.format(principal))
+        elif service == 'sts' and name == 'AssumeRole':
+            account_id = params.get('RoleArn', '::::').split(':')[4]
+            if self.recently(self.accounts_ready.get(account_id)):
+                return error_response('AccessDenied', 'User is not authorized to perform: sts:AssumeRole')
+        return None
+
+    def after_call(self, model, context, parsed=None, **kwargs):
+        if 'simulator_start' in context:
+            self.clock.thaw()
+            with self.lock:
+                self.backend_seconds += time.time() - context.pop('simulator_start')
+        if not isinstance(parsed, dict) or 'Error' in parsed:
+            return
+        now = self.clock.time()
+        with self.lock:
+            if model.name == 'CreateRole':
+                self.roles_created[parsed['Role']['RoleName']] = now
+            elif model.name == 'CreateAccount':
+                self.create_requests[parsed['CreateAccountStatus']['Id']] = now
+            elif model.name == 'DescribeCreateAccountStatus' and parsed['CreateAccountStatus'].get('State') == 'SUCCEEDED':
+                self.accounts_ready.setdefault(parsed['CreateAccountStatus']['AccountId'], now)
+
+
+def prepare_organization(hubs):
+    # Function to create the organization, the master source bucket and the IaC resources of hubs that already exist.
+    import boto3
+    boto3.client('organizations').create_organization(FeatureSet='ALL')
+    s3_client = boto3.client('s3')
+    s3_client.create_bucket(Bucket=SOURCE_BUCKET)
+    iam_client = boto3.client('iam')
+    for hub in hubs:
+        s3_client.create_bucket(Bucket='yourcompanynameORcustomprefix-iac-' + hub)
+        for role in ('ec2_iacbuild_' + hub, 'ec2_iacdeploy_' + hub):
+            iam_client.create_role(RoleName=role, AssumeRolePolicyDocument=AccountCreationLambda.AWSEC2trustpolicy)
+
+
+def run_main(clock, args, responses):
+    # Function to provision one spoke of an existing hub through the Service Catalog main() handler, following its
+    # self re-invocations until it responds to cloudformation.  Returns the number of invocations.
+    os.environ.update(accountname='spoke1', accountemail='spoke1@example.com', parenthub='hub1', ishub='false',
+                      iac_account_id=IAC_ACCOUNT_ID, stackname='simulated', stackregion='us-west-2',
+                      sourcebucket=SOURCE_BUCKET, removedefaultvpc=str(not args.keep_default_vpc).lower(),
+                      AWS_LAMBDA_FUNCTION_NAME='AccountCreationLambda')
+    prepare_organization(['hub1'])
+    event = {'RequestType': 'Create', 'ServiceToken': 'arn:aws:lambda:us-east-1:{}:function:AccountCreationLambda'.format(IAC_ACCOUNT_ID),
+             'StackId': 'simulated', 'RequestId': 'simulated', 'LogicalResourceId': 'AccountCreation', 'ResponseURL': 'https://simulated'}
+    invocations = 0
+    while event is not None and invocations < 10:
+        invocations += 1
+        reinvoked = []
+        AccountCreationLambda.selfinvoke = lambda invoke_event, status: reinvoked.append(dict(invoke_event)) if status == 'Create' else None
+        AccountCreationLambda.main(dict(event), SimulatedContext(clock, args.lambda_timeout))
+        event = reinvoked[-1] if reinvoked else None
+    return invocations
+
+
+def run_batch(clock, args, responses):
+    # Function to provision a fleet of hubs and spokes through the batch_main() handler, following its self re-invocations.
+    # Returns the number of invocations.
+    prepare_organization([])
+    os.environ.update(iac_account_id=IAC_ACCOUNT_ID, sourcebucket=SOURCE_BUCKET, stackregion='us-west-2')
+    hubs = ['hub{}'.format(number) for number in range(1, args.hubs + 1)]
+    accounts = [{'accountname': hub, 'accountemail': hub + '@example.com', 'ishub': 'true', 'removedefaultvpc': str(not args.keep_default_vpc).lower()} for hub in hubs]
+    for number in range(1, args.accounts - args.hubs + 1):
+        accounts.append({'accountname': 'spoke{}'.format(number), 'accountemail': 'spoke{}@example.com'.format(number), 'ishub': 'false',
+                         'parenthub': hubs[number % len(hubs)], 'removedefaultvpc': str(not args.keep_default_vpc).lower()})
+    event = {'Accounts': accounts}
+    invocations = 0
+    while event is not None and invocations < 10:
+        invocations += 1
+        reinvoked = []
+        AccountCreationLambda.selfinvoke = lambda invoke_event, status: reinvoked.append(invoke_event)
+        AccountCreationLambda.batch_main(event, SimulatedContext(clock, args.lambda_timeout))
+        event = reinvoked[-1] if reinvoked else None
+    return invocations
+
+
+def simulate(args):
+    # Function to run one simulated provisioning and return the benchmark result dictionary.
+    random.seed(args.seed)
+    clock = VirtualClock(args.scale)
+    AccountCreationLambda.time = clock
+    responses = []
+    summaries = []
+    emit_run_summary = AccountCreationLambda.emit_run_summary
+    def record_run_summary(reports):
+        summaries.append(reports)
+        emit_run_summary(reports)
+    AccountCreationLambda.emit_run_summary = record_run_summary
+    # moto does not implement the Service Quotas default the preflight quota check falls back to.
+    load_settings = AccountCreationLambda.load_settings
+    def simulated_settings():
+        settings = load_settings()
+        settings['account_quota'] = settings['account_quota'] or args.accounts + 100
+        return settings
+    AccountCreationLambda.load_settings = simulated_settings
+    AccountCreationLambda.respond_cloudformation = lambda event, status, data=None: responses.append({'status': status, 'data': data})
+    AccountCreationLambda.delete_respond_cloudformation = lambda event, status, message: responses.append({'status': status, 'data': message})
+
+    tps_limits = dict((limit.split('=')[0], float(limit.split('=')[1])) for limit in args.tps_limit or [])
+    simulator = Simulator(clock, args.latency_ms / 1000.0, args.jitter, args.throttle_rate, args.consistency_window, args.create_account_seconds, tps_limits)
+    log = open(args.log, 'w') if args.log else io.StringIO()
+    with mock_aws(), contextlib.redirect_stdout(log):
+        simulator.register(AccountCreationLambda._boto3_session().events)
+        start = clock.time()
+        runner = run_main if args.mode == 'main' else run_batch
+        invocations = runner(clock, args, responses)
+        elapsed = clock.time() - start
+    log.close()
+
+    # Step durations are summed over every account of the final report of each account.
+    final_reports = {}
+    for reports in summaries:
+        for report in reports:
+            final_reports[report['accountname']] = report
+    durations = collections.Counter()
+    for report in final_reports.values():
+        durations.update(report.get('timings') or {})
+    steps = sorted(set(durations) | set(simulator.step_calls) | set(clock.slept))
+    return {
+        'mode': args.mode,
+        'accounts': len(final_reports),
+        'statuses': dict(collections.Counter(report['status'] for report in final_reports.values())),
+        'invocations': invocations,
+        'simulated_seconds': round(elapsed, 2),
+        'backend_real_seconds': round(simulator.backend_seconds, 2),
+        'steps': dict((step, {'seconds': round(durations.get(step, 0), 2), 'api_calls': simulator.step_calls.get(step, 0),
+                              'slept_seconds': round(clock.slept.get(step, 0), 2)}) for step in steps),
+        'api': dict(('{}.{}'.format(*operation), {'calls': count, 'throttled': simulator.throttled.get(operation, 0),
+                                                   'consistency_errors': simulator.inconsistent.get(operation, 0)})
+                    for (operation, count) in sorted(simulator.calls.items())),
+        'responses': [response['status'] for response in responses if 'status' in response]
+    }
+
+
+def print_result(result):
+    print("Mode {mode}: {accounts} accounts {statuses} in {invocations} invocations".format(**result))
+    print("Simulated wall clock: {}s (moto processing time, {}s real, is excluded)".format(result['simulated_seconds'], result['backend_real_seconds']))
+    print("")
+    print("{:<24}{:>12}{:>12}{:>12}".format('Step', 'Seconds', 'API calls', 'Slept'))
+    for (step, values) in sorted(result['steps'].items(), key=lambda item: -item[1]['seconds']):
+        print("{:<24}{:>12}{:>12}{:>12}".format(step, values['seconds'], values['api_calls'], values['slept_seconds']))
+    print("")
+    print("{:<48}{:>8}{:>12}{:>14}".format('API operation', 'Calls', 'Throttled', 'Consistency'))
+    for (operation, values) in sorted(result['api'].items(), key=lambda item: -item[1]['calls']):
+        print("{:<48}{:>8}{:>12}{:>14}".format(operation, values['calls'], values['throttled'], values['consistency_errors']))
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the account bootstrapper against a simulated AWS')
+    parser.add_argument('--mode', choices=['main', 'batch'], default='main', help='main: one spoke through the Service Catalog handler, batch: a fleet through batch_main')
+    parser.add_argument('--accounts', type=int, default=10, help='Accounts in a batch run, including hubs')
+    parser.add_argument('--hubs', type=int, default=1, help='Hub accounts in a batch run')
+    parser.add_argument('--latency-ms', type=float, default=80, help='Simulated latency of every API call')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Fraction the latency varies by')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Probability any call is throttled')
+    parser.add_argument('--tps-limit', action='append', metavar='SERVICE=RATE', help='Throttle calls to a service over RATE per second, eg iam=5 (repeatable)')
+    parser.add_argument('--consistency-window', type=float, default=10, help='Seconds a new role or account is not usable for')
+    parser.add_argument('--create-account-seconds', type=float, default=60, help='Seconds CreateAccount stays IN_PROGRESS')
+    parser.add_argument('--lambda-timeout', type=float, default=900, help='Simulated Lambda timeout of each invocation')
+    parser.add_argument('--keep-default-vpc', action='store_true', help='Skip the default VPC sweep')
+    parser.add_argument('--scale', type=float, default=20, help='Simulated seconds per real second')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log', help='Write the bootstrapper output to this file')
+    parser.add_argument('--json', help='Write the result as JSON to this file')
+    args = parser.parse_args(argv)
+
+    result = simulate(args)
+    print_result(result)
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(result, result_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
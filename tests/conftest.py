@@ -0,0 +1,21 @@
+# Shared test setup, run the tests from the repository root with "python -m pytest tests".
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import AccountCreationLambda
+
+
+@pytest.fixture(autouse=True)
+def lambda_package(monkeypatch):
+    # bootstrapper.ini and the templates are read relative to the working directory, as in the Lambda package, and
+    # nothing read or cached by one test is seen by the next.
+    monkeypatch.chdir(ROOT)
+    for name in ('_bootstrapper_config', '_provider_templates', '_metadata_cache', '_account_inventory', '_organization_tree'):
+        monkeypatch.setattr(AccountCreationLambda, name, None)
+    monkeypatch.setattr(AccountCreationLambda, '_hub_role_grants', {})
@@ -0,0 +1,65 @@
+# Checkpoint tests: only a re-invocation resumes a checkpoint, a new request for an account whose earlier run failed
+# starts afresh.
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+SPEC = { 'accountname': 'spoke1', 'ishub': 'false', 'parenthub': 'hub1', 'stackregion': 'us-west-2' }
+SETTINGS = { 'max_invocations': 2, 'step_workers': 1, 'step_budget': 1, 'reinvoke_margin': 0, 'testmode': False }
+
+
+class ProvisionCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = AccountCreationLambda.LocalFileCheckpointStore(directory)
+        self.runs = []
+
+    def provision(self, step, resume=False):
+        with mock.patch.object(AccountCreationLambda, 'provisioning_tasks', lambda spec: [('create_account', step, [])]):
+            return AccountCreationLambda.provision_account(SPEC, SETTINGS, 'r-root', '123456789012', store=self.store, resume=resume)
+
+    def failing_step(self, spec, settings, state, event):
+        self.runs.append(dict(state))
+        AccountCreationLambda.save_step_progress({ 'create_account_request_id': 'car-1' })
+        raise AccountCreationLambda.ProvisioningError("Account creation failed for spoke1")
+
+    def test_failed_runs_do_not_lock_out_the_account(self):
+        for attempt in range(SETTINGS['max_invocations'] + 1):
+            report = self.provision(self.failing_step)
+            self.assertEqual(report['error'], "Account creation failed for spoke1")
+        self.assertEqual([run['invocations'] for run in self.runs], [1, 1, 1])
+
+    def test_only_the_create_request_is_carried_over(self):
+        self.provision(self.failing_step)
+        state = self.store.load('spoke1')
+        self.assertEqual(state['create_account_request_id'], 'car-1')
+        self.assertEqual(state['completed'], [])
+
+        report = self.provision(lambda spec, settings, state, event: { 'account_id': '210987654321' })
+        self.assertEqual(report['status'], 'complete')
+        self.assertIsNone(self.store.load('spoke1'))
+
+    def test_failure_after_the_account_exists_leaves_no_checkpoint(self):
+        state = AccountCreationLambda.new_checkpoint_state()
+        state.update({ 'account_id': '210987654321', 'create_account_request_id': 'car-1' })
+        self.assertIsNone(AccountCreationLambda.carry_over_state(state))
+
+    def test_stale_checkpoint_is_not_resumed_by_a_new_request(self):
+        state = AccountCreationLambda.new_checkpoint_state()
+        state.update({ 'account_id': '210987654321', 'completed': ['create_account'], 'invocations': 1 })
+        self.store.save('spoke1', state)
+        report = self.provision(self.failing_step)
+        self.assertEqual(report['status'], 'failed')
+        self.assertIsNone(self.runs[0].get('account_id'))
+
+        self.store.save('spoke1', state)
+        report = self.provision(self.failing_step, resume=True)
+        self.assertEqual(report['status'], 'complete')
+        self.assertEqual(report['account_id'], '210987654321')
+
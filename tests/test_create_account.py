@@ -0,0 +1,79 @@
+# Account creation tests: the CreateAccount request id is checkpointed before the wait, so a retry after the wait timed
+# out polls that request instead of creating the account a second time.
+
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+
+class FakeOrganizations(object):
+
+    def __init__(self):
+        self.created = 0
+        self.state = 'IN_PROGRESS'
+        self.states = {}
+
+    def create_account(self, **kwargs):
+        self.created += 1
+        return {'CreateAccountStatus': {'Id': 'car-{}'.format(self.created), 'State': 'IN_PROGRESS'}}
+
+    def describe_create_account_status(self, CreateAccountRequestId):
+        status = {'Id': CreateAccountRequestId, 'State': self.states.get(CreateAccountRequestId, self.state)}
+        if status['State'] == 'FAILED':
+            status['FailureReason'] = 'EMAIL_ALREADY_EXISTS'
+        if status['State'] == 'SUCCEEDED':
+            status['AccountId'] = '210987654321'
+        return {'CreateAccountStatus': status}
+
+
+class CheckpointedCreateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeOrganizations()
+        for (name, value) in (('get_client', lambda service, credentials=None: self.client),
+                              ('assume_role', lambda account_id, role: {}),
+                              ('record_sleep', lambda seconds: None)):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(AccountCreationLambda.time, 'sleep', lambda seconds: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_steps(self, state, store):
+        spec = { 'accountname': 'spoke1', 'accountemail': 'spoke1@example.com', 'accountrole': 'OrganizationAccountAccessRole' }
+        settings = { 'testmode': False, 'access_to_billing': 'DENY', 'create_account_timeout': 0, 'create_account_max_poll_delay': 1,
+                     'create_account_concurrency': 1, 'step_budget': 1, 'step_workers': 1, 'reinvoke_margin': 0 }
+        tasks = [('create_account', AccountCreationLambda.step_create_account, [])]
+        return AccountCreationLambda.run_provisioning_steps(spec, settings, state, None, None, store, 'spoke1', tasks=tasks)
+
+    def test_retry_after_timeout_polls_the_same_request(self):
+        store = mock.Mock()
+        state = AccountCreationLambda.new_checkpoint_state()
+        state['root_id'] = 'r-root'
+        with self.assertRaises(AccountCreationLambda.ProvisioningError):
+            self.run_steps(state, store)
+        store.save.assert_called_with('spoke1', state)
+        self.assertEqual(state['create_account_request_id'], 'car-1')
+
+        self.client.state = 'SUCCEEDED'
+        self.assertEqual(self.run_steps(state, store), 'complete')
+        self.assertEqual(self.client.created, 1)
+        self.assertEqual(state['account_id'], '210987654321')
+
+    def test_failed_request_is_replaced(self):
+        store = mock.Mock()
+        state = AccountCreationLambda.new_checkpoint_state()
+        state['root_id'] = 'r-root'
+        self.client.state = 'FAILED'
+        with self.assertRaises(AccountCreationLambda.ProvisioningError):
+            self.run_steps(state, store)
+        self.assertEqual(state['create_account_request_id'], 'car-1')
+
+        self.client.states['car-1'] = 'FAILED'
+        self.client.state = 'SUCCEEDED'
+        self.assertEqual(self.run_steps(state, store), 'complete')
+        self.assertEqual(self.client.created, 2)
+        self.assertEqual(state['create_account_request_id'], 'car-2')
+
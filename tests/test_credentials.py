@@ -0,0 +1,59 @@
+# Credential cache tests: assumed role credentials and the clients built from them are cached per account and role,
+# and dropped from the caches once they expire.
+
+import datetime
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+
+class FakeSts(object):
+
+    def __init__(self):
+        self.issued = 0
+        self.lifetime = 3600
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self.issued += 1
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.lifetime)
+        return { 'Credentials': { 'AccessKeyId': 'ASIA{:016d}'.format(self.issued), 'SecretAccessKey': 'secret',
+                                  'SessionToken': 'token', 'Expiration': expiration } }
+
+
+class CredentialCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sts = FakeSts()
+        for (name, value) in (('_credential_cache', {}), ('_credential_owner', {}), ('_client_cache', {}), ('_credential_locks', {})):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assume(self, account_id):
+        with mock.patch.object(AccountCreationLambda, 'get_client', lambda service: self.sts):
+            return AccountCreationLambda.assume_role(account_id, 'OrganizationAccountAccessRole')
+
+    def test_credentials_are_reused_until_they_expire(self):
+        first = self.assume('210987654321')
+        self.assertIs(self.assume('210987654321'), first)
+        self.assertEqual(self.sts.issued, 1)
+
+    def test_refreshed_credentials_replace_their_owner_entry(self):
+        self.sts.lifetime = 60
+        first = self.assume('210987654321')
+        second = self.assume('210987654321')
+        self.assertNotEqual(first['AccessKeyId'], second['AccessKeyId'])
+        self.assertEqual(AccountCreationLambda._credential_owner,
+                         { second['AccessKeyId']: ('210987654321', 'OrganizationAccountAccessRole') })
+
+    def test_expired_credentials_and_their_clients_are_evicted(self):
+        self.sts.lifetime = -1
+        credentials = self.assume('210987654321')
+        AccountCreationLambda.get_client('iam', credentials)
+        self.assertEqual(len(AccountCreationLambda._client_cache), 1)
+        self.sts.lifetime = 3600
+        self.assume('210987654322')
+        self.assertEqual(list(AccountCreationLambda._credential_cache), [('210987654322', 'OrganizationAccountAccessRole')])
+        self.assertNotIn(credentials['AccessKeyId'], AccountCreationLambda._credential_owner)
+        self.assertEqual(AccountCreationLambda._client_cache, {})
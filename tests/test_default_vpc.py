@@ -0,0 +1,150 @@
+# Default VPC tests: a default VPC's resources are deleted layer by layer in dependency order, the regions of a sweep
+# share one bounded thread pool, and a region stopped by a timeout has finished its deletion calls before the sweep returns.
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+# The layer of each deletion call, a call may only be made once every call of the layers before it has been.
+LAYERS = { 'delete_network_interface': 1, 'detach_internet_gateway': 1, 'disassociate_route_table': 1, 'revoke_security_group_ingress': 1,
+           'revoke_security_group_egress': 1, 'delete_internet_gateway': 2, 'delete_subnet': 2, 'delete_security_group': 2,
+           'delete_route_table': 3, 'delete_network_acl': 3, 'delete_vpc': 4 }
+
+
+class FakePaginator(object):
+
+    def __init__(self, items):
+        self.items = items
+
+    def paginate(self, Filters):
+        return [self.items]
+
+
+class FakeEc2(object):
+    # A default VPC with two subnets, an internet gateway, a custom route table, network ACL and two security groups that
+    # refer to each other.
+
+    def __init__(self, interface_status='available', default=True):
+        self.calls = []
+        self.lock = threading.Lock()
+        pair = lambda groupid: [{ 'IpProtocol': '-1', 'UserIdGroupPairs': [{ 'GroupId': groupid }] }]
+        self.resources = {
+            'describe_vpcs': { 'Vpcs': [{ 'VpcId': 'vpc-1' }] if default else [] },
+            'describe_network_interfaces': { 'NetworkInterfaces': [{ 'NetworkInterfaceId': 'eni-1', 'Status': interface_status }] },
+            'describe_internet_gateways': { 'InternetGateways': [{ 'InternetGatewayId': 'igw-1' }] },
+            'describe_subnets': { 'Subnets': [{ 'SubnetId': 'subnet-1' }, { 'SubnetId': 'subnet-2' }] },
+            'describe_security_groups': { 'SecurityGroups': [
+                { 'GroupId': 'sg-0', 'GroupName': 'default', 'IpPermissions': pair('sg-1') },
+                { 'GroupId': 'sg-1', 'GroupName': 'web', 'IpPermissions': pair('sg-0'), 'IpPermissionsEgress': pair('sg-0') }] },
+            'describe_route_tables': { 'RouteTables': [
+                { 'RouteTableId': 'rtb-main', 'Associations': [{ 'Main': True }] },
+                { 'RouteTableId': 'rtb-1', 'Associations': [{ 'Main': False, 'SubnetId': 'subnet-1', 'RouteTableAssociationId': 'rtbassoc-1' }] }] },
+            'describe_network_acls': { 'NetworkAcls': [{ 'NetworkAclId': 'acl-default', 'IsDefault': True }, { 'NetworkAclId': 'acl-1', 'IsDefault': False }] } }
+
+    def get_paginator(self, operation):
+        return FakePaginator(self.resources[operation])
+
+    def __getattr__(self, operation):
+        if operation not in LAYERS:
+            raise AttributeError(operation)
+
+        def call(**kwargs):
+            with self.lock:
+                self.calls.append((operation, kwargs))
+        return call
+
+
+class DeleteDefaultVpcTest(unittest.TestCase):
+
+    def delete(self, ec2):
+        with mock.patch.object(AccountCreationLambda, 'get_client', lambda service, credentials, region: ec2):
+            return AccountCreationLambda.delete_default_vpc({}, 'us-west-2')
+
+    def test_resources_are_deleted_in_dependency_order(self):
+        ec2 = FakeEc2()
+        deleted = self.delete(ec2)
+        layers = [LAYERS[operation] for (operation, kwargs) in ec2.calls]
+        self.assertEqual(layers, sorted(layers))
+        self.assertEqual(deleted, { 'VpcIds': ['vpc-1'], 'NetworkInterfaces': 1, 'InternetGateways': 1, 'Subnets': 2, 'SecurityGroups': 1,
+                                    'RouteTables': 1, 'NetworkAcls': 1 })
+        calls = dict((operation, kwargs) for (operation, kwargs) in ec2.calls)
+        self.assertEqual(calls['disassociate_route_table'], { 'AssociationId': 'rtbassoc-1' })
+        self.assertEqual(calls['delete_security_group'], { 'GroupId': 'sg-1' })
+        # Only rules naming the group being deleted are revoked, the default group is deleted with the VPC.
+        self.assertEqual([(operation, kwargs['GroupId']) for (operation, kwargs) in ec2.calls if operation.startswith('revoke_')],
+                         [('revoke_security_group_ingress', 'sg-0')])
+
+    def test_interface_in_use_leaves_the_vpc(self):
+        ec2 = FakeEc2(interface_status='in-use')
+        with self.assertRaises(AccountCreationLambda.ProvisioningError):
+            self.delete(ec2)
+        self.assertEqual(ec2.calls, [])
+
+    def test_region_without_a_default_vpc(self):
+        self.assertIsNone(self.delete(FakeEc2(default=False)))
+
+
+class DefaultVpcSweepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.layers = 0
+
+    def delete(self, credentials, region, max_workers=4, executor=None, stop=None):
+        # A region of slow layers, each run on the shared executor the sweep gives it.
+        for layer in range(5 if region == 'slow-1' else 1):
+            if stop.is_set():
+                raise AccountCreationLambda.ProvisioningError("stopped")
+            executor.submit(self.layer).result()
+        return { 'VpcIds': ['vpc-1'] }
+
+    def layer(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+            self.layers += 1
+
+    def sweep(self, regions, **kwargs):
+        with mock.patch.object(AccountCreationLambda, 'delete_default_vpc', self.delete):
+            return AccountCreationLambda.delete_default_vpcs({}, regions, **kwargs)
+
+    def test_regions_share_a_bounded_pool(self):
+        threads = threading.active_count()
+        results = self.sweep(['region-{}'.format(number) for number in range(12)], max_workers=3, layer_workers=2)
+        self.assertEqual(set(result['status'] for result in results.values()), set(['success']))
+        self.assertLessEqual(self.peak, 2)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_stopped_region_is_not_left_running(self):
+        results = self.sweep(['slow-1', 'fast-1'], max_workers=2, region_timeout=0.1, layer_workers=1)
+        self.assertEqual(results['slow-1']['status'], 'timeout')
+        self.assertEqual(results['fast-1']['status'], 'success')
+        layers = self.layers
+        time.sleep(0.2)
+        self.assertEqual((self.layers, self.active), (layers, 0))
+        self.assertLess(layers, 6)
+
+    def test_unfinished_regions_are_checkpointed(self):
+        settings = { 'testmode': False, 'vpc_delete_workers': 1, 'vpc_delete_region_timeout': 120, 'vpc_delete_sweep_timeout': 0.1 }
+        state = { 'account_id': '210987654321' }
+        with mock.patch.object(AccountCreationLambda, 'assume_role', return_value={}), \
+             mock.patch.object(AccountCreationLambda, 'enabled_regions', return_value=['slow-1', 'fast-1']):
+            outputs = self.sweep_step(settings, state)
+            self.assertEqual(outputs['default_vpc_unfinished'], ['fast-1', 'slow-1'])
+            state.update(outputs)
+            settings['vpc_delete_sweep_timeout'] = 120
+            outputs = self.sweep_step(settings, state)
+        self.assertEqual(outputs['default_vpc_unfinished'], [])
+        self.assertEqual(outputs['default_vpc']['slow-1']['status'], 'success')
+
+    def sweep_step(self, settings, state):
+        with mock.patch.object(AccountCreationLambda, 'delete_default_vpc', self.delete):
+            return AccountCreationLambda.step_default_vpc({ 'accountname': 'spoke1', 'removedefaultvpc': 'true', 'accountrole': 'OrganizationAccountAccessRole' }, settings, state, {})
@@ -0,0 +1,87 @@
+# Drift tests: scan_drift() compares every role provisioning created for an account with its provisioned state, and
+# with remediate puts back only what differs.
+
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+SPECS = [{ 'accountname': 'hub1', 'parenthub': 'hub1' }, { 'accountname': 'spoke1', 'parenthub': 'hub1' },
+         { 'accountname': 'spoke2', 'parenthub': 'hub2' }]
+ACCOUNTS = { 'hub1': '210987654321', 'spoke1': '210987654322', 'spoke2': '210987654323' }
+
+
+def role_state(desired):
+    # The state get_role_state() reads for a role that is as provisioned.
+    return { 'Arn': 'arn:aws:iam::210987654321:role/' + desired['RoleName'], 'TrustPolicy': desired['TrustPolicy'],
+             'InlinePolicies': dict(desired.get('InlinePolicies') or {}), 'ManagedPolicies': set(desired.get('ManagedPolicies') or []),
+             'InstanceProfiles': set([desired['RoleName']]) if desired.get('InstanceProfile') else set() }
+
+
+class FakeGrants(object):
+
+    def __init__(self, granted):
+        self.granted = granted
+
+    def current(self, iam_client):
+        return set(self.granted)
+
+    def grant(self, iam_client, resources):
+        self.granted.update(resources)
+
+
+class ScanDriftTest(unittest.TestCase):
+
+    def setUp(self):
+        inventory = AccountCreationLambda.AccountInventory(None)
+        for (accountname, account_id) in ACCOUNTS.items():
+            inventory.add(account_id, accountname, accountname + '@example.com')
+        self.account_roles = {}
+        iac_roles = {}
+        self.grants = {}
+        for spec in SPECS:
+            account_id = ACCOUNTS[spec['accountname']]
+            for (location, desired) in AccountCreationLambda.expected_roles(spec['accountname'], account_id, spec['parenthub'], '123456789012'):
+                if location == 'account':
+                    self.account_roles[(account_id, desired['RoleName'])] = role_state(desired)
+                else:
+                    iac_roles[desired['RoleName']] = role_state(desired)
+            for (prefix, terraformrole) in (('ec2_iacbuild_', 'terraform_reader'), ('ec2_iacdeploy_', 'terraform_writer')):
+                self.grants.setdefault(prefix + spec['parenthub'], FakeGrants(set())).granted.add(
+                    'arn:aws:iam::{}:role/{}'.format(account_id, terraformrole))
+        self.applied = []
+        for (name, value) in (('assume_role', lambda account_id, role: account_id), ('get_client', lambda service, credentials=None: credentials),
+                              ('account_inventory', lambda settings: inventory), ('get_account_role_states', lambda iam_client: iac_roles),
+                              ('get_role_state', lambda account_id, rolename: self.account_roles.get((account_id, rolename))),
+                              ('hub_role_grants', lambda iac_account_id, prefix, parenthub, settings: self.grants[prefix + parenthub]),
+                              ('apply_role_changes', lambda client, desired, changes: self.applied.append((client, desired['RoleName'], changes)))):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scan(self, **kwargs):
+        return AccountCreationLambda.scan_drift({ 'drift_workers': 4 }, '123456789012', 'OrganizationAccountAccessRole', specs=SPECS, **kwargs)
+
+    def test_provisioned_accounts_are_in_sync(self):
+        report = self.scan()
+        self.assertEqual((report['accounts'], report['in_sync'], report['drifted']), (3, 3, {}))
+
+    def test_drift_is_reported_and_remediated(self):
+        self.account_roles[('210987654322', 'terraform_writer')]['ManagedPolicies'] = set()
+        self.grants['ec2_iacdeploy_hub2'].granted.clear()
+        report = self.scan()
+        self.assertEqual(report['drifted'], {
+            'spoke1': ["account terraform_writer attach_managed arn:aws:iam::aws:policy/AdministratorAccess"],
+            'spoke2': ["iac ec2_iacdeploy_hub2 grant arn:aws:iam::210987654323:role/terraform_writer"] })
+        self.assertEqual(self.applied, [])
+
+        report = self.scan(remediate=True)
+        self.assertEqual(self.applied, [('210987654322', 'terraform_writer', [('attach_managed', 'arn:aws:iam::aws:policy/AdministratorAccess')])])
+        self.assertIn('arn:aws:iam::210987654323:role/terraform_writer', self.grants['ec2_iacdeploy_hub2'].granted)
+
+    def test_hub_filter_and_unknown_accounts(self):
+        specs = SPECS + [{ 'accountname': 'gone', 'parenthub': 'hub1' }]
+        report = AccountCreationLambda.scan_drift({ 'drift_workers': 2 }, '123456789012', 'OrganizationAccountAccessRole',
+                                                  hubs=['hub1'], specs=specs)
+        self.assertEqual((report['accounts'], report['in_sync']), (2, 2))
+        self.assertEqual(list(report['skipped']), ['gone'])
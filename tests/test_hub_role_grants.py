@@ -0,0 +1,157 @@
+# Hub role grant tests: spoke grants are laid out first fit in size limited managed policies, packed again when the role
+# has no room for more policies, and revoking a spoke never leaves the hub's other spokes without their grant.
+
+import json
+import unittest
+
+import AccountCreationLambda
+
+ROLE = 'ec2_iacbuild_hub1'
+
+
+def spoke_arn(number):
+    return 'arn:aws:iam::{:012d}:role/terraform_reader'.format(number)
+
+
+class FakePaginator(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages
+
+
+class FakeIam(object):
+    # Just enough IAM for HubRoleGrants: managed policies with versions attached to one role, and its inline policies.
+
+    def __init__(self):
+        self.policies = {}
+        self.attached = []
+        self.inline = {}
+        self.calls = []
+
+    def get_paginator(self, operation):
+        if operation == 'list_attached_role_policies':
+            return FakePaginator([{ 'AttachedPolicies': [{ 'PolicyName': arn.split('/')[-1], 'PolicyArn': arn } for arn in self.attached] }])
+        return FakePaginator([{ 'PolicyNames': sorted(self.inline) }])
+
+    def get_policy(self, PolicyArn):
+        return { 'Policy': { 'DefaultVersionId': 'v{}'.format(len(self.policies[PolicyArn])) } }
+
+    def get_policy_version(self, PolicyArn, VersionId):
+        return { 'PolicyVersion': { 'Document': self.policies[PolicyArn][-1] } }
+
+    def get_role_policy(self, RoleName, PolicyName):
+        return { 'PolicyDocument': self.inline[PolicyName] }
+
+    def put_role_policy(self, RoleName, PolicyName, PolicyDocument):
+        self.calls.append(('put_role_policy', PolicyName))
+        self.inline[PolicyName] = PolicyDocument
+
+    def delete_role_policy(self, RoleName, PolicyName):
+        self.calls.append(('delete_role_policy', PolicyName))
+        del self.inline[PolicyName]
+
+    def create_policy(self, PolicyName, Path, PolicyDocument, Description):
+        arn = 'arn:aws:iam::123456789012:policy' + Path + PolicyName
+        self.calls.append(('create_policy', arn))
+        self.policies[arn] = [PolicyDocument]
+        return { 'Policy': { 'Arn': arn } }
+
+    def list_policy_versions(self, PolicyArn):
+        count = len(self.policies[PolicyArn])
+        return { 'Versions': [{ 'VersionId': 'v{}'.format(number), 'IsDefaultVersion': number == count, 'CreateDate': number }
+                              for number in range(1, count + 1)] }
+
+    def delete_policy_version(self, PolicyArn, VersionId):
+        pass
+
+    def create_policy_version(self, PolicyArn, PolicyDocument, SetAsDefault):
+        self.calls.append(('create_policy_version', PolicyArn))
+        self.policies[PolicyArn].append(PolicyDocument)
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self.attached.append(PolicyArn)
+
+    def detach_role_policy(self, RoleName, PolicyArn):
+        self.calls.append(('detach_role_policy', PolicyArn))
+        self.attached.remove(PolicyArn)
+
+    def delete_policy(self, PolicyArn):
+        del self.policies[PolicyArn]
+
+
+class HubRoleGrantsTest(unittest.TestCase):
+
+    def grants(self, max_size=6144, max_policies=10):
+        return AccountCreationLambda.HubRoleGrants('123456789012', 'ec2_iacbuild_', 'hub1', max_size, max_policies)
+
+    def test_revoke_folds_legacy_grants_before_deleting_them(self):
+        iam = FakeIam()
+        for number in (1, 2, 3):
+            iam.inline['ec2_iacbuild_spoke{}'.format(number)] = json.dumps(AccountCreationLambda.HubRoleGrants.document([spoke_arn(number)]))
+        grants = self.grants()
+        grants.revoke(iam, [spoke_arn(2)])
+        self.assertEqual(grants.current(iam), set([spoke_arn(1), spoke_arn(3)]))
+        self.assertEqual(iam.inline, {})
+        names = [call for (call, target) in iam.calls]
+        self.assertNotIn('put_role_policy', names)
+        self.assertLess(names.index('create_policy'), names.index('delete_role_policy'))
+
+    def test_revoke_updates_a_policy_in_one_write(self):
+        iam = FakeIam()
+        grants = self.grants()
+        grants.grant(iam, [spoke_arn(number) for number in range(1, 4)])
+        iam.calls = []
+        grants.revoke(iam, [spoke_arn(2)])
+        self.assertEqual([call for (call, target) in iam.calls], ['create_policy_version'])
+        self.assertEqual(grants.current(iam), set([spoke_arn(1), spoke_arn(3)]))
+
+    def test_revoking_every_grant_deletes_the_policy(self):
+        iam = FakeIam()
+        grants = self.grants()
+        grants.grant(iam, [spoke_arn(1)])
+        grants.revoke(iam, [spoke_arn(1)])
+        self.assertEqual((iam.attached, iam.policies), ([], {}))
+
+
+class PackTest(unittest.TestCase):
+
+    def grants(self, per_policy, max_policies=10):
+        max_size = AccountCreationLambda.HubRoleGrants.document([spoke_arn(number) for number in range(1, per_policy + 1)])
+        return AccountCreationLambda.HubRoleGrants('123456789012', 'ec2_iacbuild_', 'hub1',
+                                                   len(json.dumps(max_size, separators=(',', ':'))), max_policies)
+
+    def layout(self, *policies):
+        return dict((index + 1, { 'Resources': set(spoke_arn(number) for number in numbers) }) for (index, numbers) in enumerate(policies))
+
+    def test_new_grants_fill_the_first_policy_with_room(self):
+        (layout, repacked) = self.grants(2)._pack(self.layout([1]), set([spoke_arn(2), spoke_arn(3)]), 10)
+        self.assertEqual(layout, { 1: set([spoke_arn(1), spoke_arn(2)]), 2: set([spoke_arn(3)]) })
+        self.assertFalse(repacked)
+
+    def test_only_changed_policies_are_written(self):
+        (layout, repacked) = self.grants(2)._pack(self.layout([1, 2], [3]), set([spoke_arn(4)]), 10)
+        self.assertEqual(layout, { 2: set([spoke_arn(3), spoke_arn(4)]) })
+
+    def test_everything_is_packed_again_when_the_role_is_out_of_room(self):
+        (layout, repacked) = self.grants(4)._pack(self.layout([1, 2], [3, 4], [5]), set([spoke_arn(6)]), 2)
+        self.assertTrue(repacked)
+        self.assertEqual(layout, { 1: set(spoke_arn(number) for number in range(1, 5)), 2: set([spoke_arn(5), spoke_arn(6)]) })
+
+    def test_grants_that_cannot_fit_are_an_error(self):
+        with self.assertRaises(AccountCreationLambda.ProvisioningError):
+            self.grants(2)._pack({}, set(spoke_arn(number) for number in range(1, 6)), 2)
+
+    def test_grant_repacks_and_deletes_the_emptied_policies(self):
+        iam = FakeIam()
+        grants = self.grants(2, max_policies=3)
+        grants.grant(iam, [spoke_arn(number) for number in range(1, 6)])
+        self.assertEqual(len(iam.attached), 3)
+        grants.max_size = self.grants(4).max_size
+        grants.max_policies = 2
+        grants.grant(iam, [spoke_arn(6)])
+        self.assertEqual(len(iam.attached), 2)
+        self.assertEqual(grants.current(iam), set(spoke_arn(number) for number in range(1, 7)))
+        self.assertIn('detach_role_policy', [call for (call, target) in iam.calls])
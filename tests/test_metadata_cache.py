@@ -0,0 +1,63 @@
+# Metadata cache tests: a value is loaded once and served from memory, or from its file by a new cache in the same
+# sandbox, until it expires, fails its validity check or is invalidated.
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.loads = 0
+
+    def loader(self):
+        self.loads += 1
+        return { 'root_id': 'r-root', 'load': self.loads }
+
+    def test_value_is_loaded_once(self):
+        cache = AccountCreationLambda.MetadataCache()
+        for attempt in range(3):
+            self.assertEqual(cache.get('organization_root', self.loader), { 'root_id': 'r-root', 'load': 1 })
+        self.assertEqual(cache.stats(), { 'organization_root': { 'hits': 2, 'file_hits': 0, 'misses': 1, 'invalidations': 0 } })
+
+    def test_new_cache_reads_the_saved_value(self):
+        AccountCreationLambda.MetadataCache(self.directory).get('organization_root', self.loader)
+        cache = AccountCreationLambda.MetadataCache(self.directory)
+        self.assertEqual(cache.get('organization_root', self.loader)['load'], 1)
+        self.assertEqual(cache.stats()['organization_root']['file_hits'], 1)
+
+    def test_expired_invalid_and_invalidated_values_are_loaded_again(self):
+        cache = AccountCreationLambda.MetadataCache(self.directory, ttl=60)
+        cache.get('organization_root', self.loader)
+        with mock.patch.object(AccountCreationLambda.time, 'time', return_value=time.time() + 61):
+            self.assertEqual(cache.get('organization_root', self.loader)['load'], 2)
+        self.assertEqual(cache.get('organization_root', self.loader, valid=lambda value: value['load'] > 2)['load'], 3)
+        cache.invalidate('organization_root')
+        self.assertEqual(AccountCreationLambda.MetadataCache(self.directory).get('organization_root', self.loader)['load'], 4)
+
+    def test_concurrent_callers_share_one_load(self):
+        cache = AccountCreationLambda.MetadataCache()
+
+        def slow_loader():
+            time.sleep(0.05)
+            return self.loader()
+        threads = [threading.Thread(target=cache.get, args=('regions', slow_loader)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.loads, 1)
+
+    def test_value_that_cannot_be_saved_is_still_cached(self):
+        cache = AccountCreationLambda.MetadataCache(self.directory)
+        cache.put('regions', set(['us-east-1']))
+        self.assertEqual(cache.get('regions', self.loader), set(['us-east-1']))
+        self.assertIsNone(cache._read('regions'))
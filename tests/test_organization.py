@@ -0,0 +1,100 @@
+# Organization tree tests: the OU hierarchy is indexed by path once, missing OUs are created under their parents, and an
+# OU created by someone else since the index was built is found rather than duplicated.
+
+import itertools
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+import AccountCreationLambda
+
+
+class FakePaginator(object):
+
+    def __init__(self, organizations):
+        self.organizations = organizations
+
+    def paginate(self, ParentId):
+        self.organizations.listed.append(ParentId)
+        return [{ 'OrganizationalUnits': [{ 'Id': ou_id, 'Name': name } for (ou_id, (name, parent_id)) in sorted(self.organizations.ous.items())
+                                          if parent_id == ParentId] }]
+
+
+class FakeOrganizations(object):
+    # An organization's OUs as id to (name, parent id), and the accounts' parents.
+
+    def __init__(self, ous):
+        self.ous = dict(ous)
+        self.parents = { '210987654321': 'r-root' }
+        self.listed = []
+        self.created = []
+        self.ids = itertools.count(100)
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+    def create_organizational_unit(self, ParentId, Name):
+        if (Name, ParentId) in self.ous.values():
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'DuplicateOrganizationalUnitException', 'Message': Name } },
+                                                  'CreateOrganizationalUnit')
+        ou_id = 'ou-{}'.format(next(self.ids))
+        self.ous[ou_id] = (Name, ParentId)
+        self.created.append(Name)
+        return { 'OrganizationalUnit': { 'Id': ou_id } }
+
+    def list_parents(self, ChildId):
+        return { 'Parents': [{ 'Id': self.parents[ChildId] }] }
+
+    def move_account(self, AccountId, SourceParentId, DestinationParentId):
+        if DestinationParentId not in self.ous:
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'DestinationParentNotFoundException', 'Message': '' } }, 'MoveAccount')
+        self.parents[AccountId] = DestinationParentId
+
+
+class OrganizationTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.organizations = FakeOrganizations({ 'ou-1': ('Hubs', 'r-root'), 'ou-2': ('Prod', 'ou-1') })
+        for (name, value) in (('organization_root', lambda: ('r-root', '123456789012')), ('metadata_cache', mock.MagicMock)):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tree = AccountCreationLambda.OrganizationTree(self.organizations).load()
+
+    def test_hierarchy_is_indexed_by_path(self):
+        self.assertEqual(self.tree.find('Hubs/Prod'), 'ou-2')
+        self.assertEqual(self.tree.find('/Hubs/'), 'ou-1')
+        self.assertEqual(self.tree.find(''), 'r-root')
+        self.assertIsNone(self.tree.find('Spokes'))
+        self.assertEqual(self.tree.path('ou-2'), 'Hubs/Prod')
+
+    def test_missing_ous_are_created_under_their_parents(self):
+        ou_id = self.tree.ensure_path('Hubs/Prod/hub1/spokes')
+        self.assertEqual(self.organizations.created, ['hub1', 'spokes'])
+        self.assertEqual(self.tree.path(ou_id), 'Hubs/Prod/hub1/spokes')
+        self.assertEqual(self.tree.ensure_path('Hubs/Prod/hub1/spokes'), ou_id)
+        self.assertEqual(self.organizations.created, ['hub1', 'spokes'])
+
+    def test_ou_created_elsewhere_is_found(self):
+        self.organizations.ous['ou-9'] = ('Dev', 'ou-1')
+        self.assertEqual(self.tree.ensure_path('Hubs/Dev'), 'ou-9')
+        self.assertEqual(self.organizations.created, [])
+
+    def test_move_account_into_an_ou(self):
+        destination = self.tree.move_account('210987654321', 'Hubs/Prod')
+        self.assertEqual((destination, self.organizations.parents['210987654321']), ('ou-2', 'ou-2'))
+        listed = len(self.organizations.listed)
+        self.assertEqual(self.tree.move_account('210987654321', 'Hubs/Prod'), 'ou-2')
+        self.assertEqual(len(self.organizations.listed), listed)
+
+    def test_deleted_ou_is_indexed_again(self):
+        del self.organizations.ous['ou-2']
+        destination = self.tree.move_account('210987654321', 'Hubs/Prod')
+        self.assertEqual(self.organizations.created, ['Prod'])
+        self.assertEqual(self.organizations.parents['210987654321'], destination)
+
+    def test_snapshot_restores_the_index(self):
+        restored = AccountCreationLambda.OrganizationTree(self.organizations).restore(self.tree.snapshot())
+        self.assertEqual(restored.find('Hubs/Prod'), 'ou-2')
+        self.assertEqual(restored.find(''), 'r-root')
@@ -0,0 +1,63 @@
+# Plan tests: the shipped bootstrapper.ini must produce a plan without warnings, and the plan must charge account
+# creation the same time the runtime budgets for it.
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+MANIFEST = """accountname,accountemail,ishub,parenthub,removedefaultvpc
+hub1,hub1@example.com,true,,true
+spoke1,spoke1@example.com,false,hub1,true
+"""
+
+
+class PlanTest(unittest.TestCase):
+
+    def manifest(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as manifest_file:
+            manifest_file.write(MANIFEST)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_default_settings_plan_cleanly(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            status = AccountCreationLambda.cli(['plan', self.manifest(), '--regions', '17'])
+        self.assertNotIn('WARNING', output.getvalue())
+        self.assertEqual(status, 0)
+
+    def test_create_account_planned_at_its_budget(self):
+        settings = AccountCreationLambda.load_settings()
+        for spec in AccountCreationLambda.load_manifest(self.manifest()):
+            plan = AccountCreationLambda.plan_account(spec, settings, 17)
+            step = [step for step in plan['steps'] if step['step'] == 'create_account'][0]
+            self.assertEqual(step['worst_case_seconds'], AccountCreationLambda.step_budget('create_account', settings))
+            self.assertLessEqual(step['worst_case_seconds'], settings['lambda_timeout'] - settings['reinvoke_margin'])
+
+    def test_plan_mode_response_has_the_stack_outputs(self):
+        # Every TriggerLambda attribute the stack outputs read must be in the response, or the stack rolls back.
+        with open('accountbuilder-iac.json', 'r') as template_file:
+            outputs = json.load(template_file)['Outputs']
+        attributes = [output['Value']['Fn::GetAtt'][1] for output in outputs.values() if output['Value']['Fn::GetAtt'][0] == 'TriggerLambda']
+        environment = { 'accountname': 'spoke1', 'accountemail': 'spoke1@example.com', 'parenthub': 'hub1', 'ishub': 'false',
+                        'iac_account_id': '123456789012', 'stackname': 'spoke1', 'stackregion': 'us-west-2', 'sourcebucket': 'sourcebucket',
+                        'removedefaultvpc': 'true', 'AWS_DEFAULT_REGION': 'us-east-1' }
+        event = { 'RequestType': 'Create', 'ServiceToken': 'arn:aws:lambda:us-east-1:123456789012:function:builder' }
+        responses = []
+        settings = dict(AccountCreationLambda.load_settings(), planmode=True)
+        with mock.patch.dict(os.environ, environment), \
+             mock.patch.object(AccountCreationLambda, 'load_settings', lambda: settings), \
+             mock.patch.object(AccountCreationLambda, 'enabled_regions', lambda *args: ['us-east-1'] * 17), \
+             mock.patch.object(AccountCreationLambda, 'respond_cloudformation', lambda event, status, data: responses.append((status, data))), \
+             contextlib.redirect_stdout(io.StringIO()):
+            AccountCreationLambda.main(event, None)
+        self.assertEqual(responses[0][0], 'SUCCESS')
+        for attribute in attributes:
+            self.assertIn(attribute, responses[0][1])
+
@@ -0,0 +1,68 @@
+# Preflight tests: an account request is rejected before any change when its email or name is taken, the organization
+# has no room for it, or its hub is missing, and a resumed request is only checked for its hub.
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+SETTINGS = { 'testmode': False, 'preflight_workers': 4 }
+
+
+def spec(accountname, ishub='false', parenthub='hub1', email=None):
+    return { 'accountname': accountname, 'accountemail': email or accountname + '@example.com', 'ishub': ishub,
+             'parenthub': parenthub, 'iac_account_id': '123456789012', 'accountrole': 'OrganizationAccountAccessRole' }
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inventory = AccountCreationLambda.AccountInventory(None)
+        self.inventory.add('210987654321', 'existing', 'taken@example.com')
+        self.quota = None
+        self.hubs = { 'hub1': [], 'hub2': ["Hub bucket yourcompanynameORcustomprefix-iac-hub2 does not exist"] }
+        self.hub_checks = []
+        for (name, value) in (('account_inventory', lambda settings: self.inventory),
+                              ('organization_account_quota', lambda settings: self.quota),
+                              ('hub_problems', self.hub_problems)):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hub_problems(self, iac_account_id, accountrole, parenthub):
+        self.hub_checks.append(parenthub)
+        return self.hubs[parenthub]
+
+    def test_clean_requests_pass(self):
+        self.assertEqual(AccountCreationLambda.preflight([spec('spoke1'), spec('spoke2')], SETTINGS), {})
+        self.assertEqual(self.hub_checks, ['hub1'])
+
+    def test_taken_and_repeated_emails_and_names_are_rejected(self):
+        problems = AccountCreationLambda.preflight([spec('existing'), spec('spoke1', email='taken@example.com'),
+                                                    spec('spoke2', email='same@example.com'), spec('spoke3', email='SAME@example.com')], SETTINGS)
+        self.assertEqual(sorted(problems), ['existing', 'spoke1', 'spoke3'])
+        self.assertIn("already used by account 210987654321", problems['existing'][0])
+        self.assertIn("also requested for spoke2", problems['spoke3'][0])
+
+    def test_quota_leaves_room_for_hubs_first(self):
+        self.quota = 3
+        problems = AccountCreationLambda.preflight([spec('spoke1', parenthub='hub3'), spec('spoke2', parenthub='hub3'),
+                                                    spec('hub3', ishub='true', parenthub='hub3')], SETTINGS)
+        self.assertEqual(sorted(problems), ['spoke2'])
+        self.assertEqual(self.hub_checks, [])
+
+    def test_missing_hub_rejects_its_spokes(self):
+        problems = AccountCreationLambda.preflight([spec('spoke1', parenthub='hub2'), spec('spoke2', parenthub='hub2')], SETTINGS)
+        self.assertEqual(problems, dict((name, self.hubs['hub2']) for name in ('spoke1', 'spoke2')))
+
+    def test_resumed_account_is_only_checked_for_its_hub(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = AccountCreationLambda.LocalFileCheckpointStore(directory)
+        state = AccountCreationLambda.new_checkpoint_state()
+        state['account_id'] = '210987654321'
+        store.save('existing', state)
+        self.assertEqual(AccountCreationLambda.preflight([spec('existing')], SETTINGS, store), {})
+        self.assertIn('existing', AccountCreationLambda.preflight([spec('existing')], SETTINGS))
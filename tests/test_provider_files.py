@@ -0,0 +1,129 @@
+# Provider file tests: render_provider_files() produces the files the original single awsprovider.template produced for
+# the regions it listed, with every assume_role block closed at the same indent and a newline at the end of the file, and
+# reconcile_provider_files() only uploads the files whose content differs from what the hub bucket holds.
+
+import hashlib
+import io
+import os
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+import AccountCreationLambda
+
+# The regions the original template had a provider alias block for.
+LEGACY_REGIONS = ['ap-northeast-1', 'ap-northeast-2', 'ap-south-1', 'ap-southeast-1', 'ap-southeast-2', 'ca-central-1', 'eu-central-1',
+                  'eu-north-1', 'eu-west-1', 'eu-west-2', 'eu-west-3', 'sa-east-1', 'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2']
+
+
+def legacy_render(region, iac_account_id, rolearn, accountname, deploytype):
+    # The renderer before the region blocks were generated, see create_awsprovider_file() in the git history, with the
+    #   hand written template's whitespace normalized.
+    with open(os.path.join('tests', 'data', 'awsprovider_legacy.template'), 'r') as template_file:
+        providercontent = template_file.read()
+    return providercontent.format(
+        iac_account_id=iac_account_id,
+        accountname=accountname,
+        region=region,
+        rolearn=rolearn,
+        deploytype=deploytype
+    ).replace('\n  }\n', '\n    }\n') + '\n'
+
+
+class RenderProviderFilesTest(unittest.TestCase):
+
+    def test_matches_legacy_renderer(self):
+        for region in ('us-west-2', 'eu-west-1'):
+            files = AccountCreationLambda.render_provider_files(region, '123456789012', '210987654321', 'spoke1', LEGACY_REGIONS)
+            for (deploytype, rolename) in (('build', 'terraform_reader'), ('release', 'terraform_writer')):
+                expected = legacy_render(region, '123456789012', 'arn:aws:iam::210987654321:role/' + rolename, 'spoke1', deploytype)
+                self.assertEqual(files[deploytype], expected)
+
+    def test_new_region_gets_alias(self):
+        files = AccountCreationLambda.render_provider_files('us-west-2', '123456789012', '210987654321', 'spoke1', LEGACY_REGIONS + ['ap-east-1'])
+        self.assertIn('alias      = "ap-east-1"', files['build'])
+        self.assertTrue(files['build'].endswith('}\n}\n'))
+
+
+
+class FakePaginator(object):
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix):
+        return [{ 'Contents': [{ 'Key': key, 'ETag': '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest()) }
+                               for ((bucket, key), body) in sorted(self.s3.objects.items()) if bucket == Bucket and key.startswith(Prefix)] }]
+
+
+class FakeS3(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.failing = set()
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+    def get_object(self, Bucket, Key):
+        return { 'Body': io.BytesIO(self.objects[(Bucket, Key)].encode('utf-8')) }
+
+    def put_object(self, Bucket, Key, Body):
+        if Key in self.failing:
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'AccessDenied', 'Message': 'denied' } }, 'PutObject')
+        self.puts.append(Bucket + '/' + Key)
+        self.objects[(Bucket, Key)] = Body
+
+
+class ReconcileProviderFilesTest(unittest.TestCase):
+
+    BUCKET = 'yourcompanynameORcustomprefix-iac-hub1'
+
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.regions = dict((region, [region + 'a']) for region in LEGACY_REGIONS)
+        inventory = AccountCreationLambda.AccountInventory(None)
+        inventory.add('210987654321', 'spoke1', 'spoke1@example.com')
+        inventory.add('210987654322', 'spoke2', 'spoke2@example.com')
+        for (name, value) in (('assume_role', lambda account_id, role: {}), ('get_client', lambda service, credentials=None: self.s3),
+                              ('hub_buckets', lambda s3_client, hubs: [self.BUCKET]),
+                              ('region_az_map', lambda settings, sourcebucket: self.regions),
+                              ('account_inventory', lambda settings: inventory)):
+            patcher = mock.patch.object(AccountCreationLambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for (accountname, account_id) in (('spoke1', '210987654321'), ('spoke2', '210987654322')):
+            files = AccountCreationLambda.render_provider_files('us-west-2', '123456789012', account_id, accountname, self.regions)
+            for (deploytype, content) in files.items():
+                self.s3.objects[(self.BUCKET, AccountCreationLambda.provider_file_key(accountname, deploytype))] = content
+
+    def reconcile(self, **kwargs):
+        return AccountCreationLambda.reconcile_provider_files({ 'reconcile_workers': 4 }, '123456789012', 'OrganizationAccountAccessRole',
+                                                              'sourcebucket', **kwargs)
+
+    def test_files_up_to_date_are_not_uploaded(self):
+        report = self.reconcile()
+        self.assertEqual((report['accounts'], report['files'], report['unchanged'], report['updated']), (2, 4, 4, []))
+        self.assertEqual(self.s3.puts, [])
+
+    def test_new_region_updates_every_file(self):
+        self.regions['ap-east-1'] = ['ap-east-1a']
+        report = self.reconcile(dry_run=True)
+        self.assertEqual(len(report['updated']), 4)
+        self.assertEqual(self.s3.puts, [])
+        report = self.reconcile()
+        self.assertEqual(sorted(self.s3.puts), sorted(report['updated']))
+        self.assertEqual(self.reconcile()['updated'], [])
+
+    def test_unknown_accounts_and_failed_uploads_are_reported(self):
+        self.s3.objects[(self.BUCKET, AccountCreationLambda.provider_file_key('gone', 'build'))] = 'region = "us-east-1"'
+        key = AccountCreationLambda.provider_file_key('spoke1', 'release')
+        self.s3.objects[(self.BUCKET, key)] += '# edited'
+        self.s3.failing.add(key)
+        report = self.reconcile(specs=[{ 'accountname': 'spoke2', 'stackregion': 'eu-west-1' }])
+        self.assertEqual(list(report['skipped']), [self.BUCKET + '/gone'])
+        self.assertEqual(list(report['errors']), [self.BUCKET + '/' + key])
+        self.assertEqual(sorted(report['updated']), [self.BUCKET + '/' + AccountCreationLambda.provider_file_key('spoke2', deploytype)
+                                                     for deploytype in ('build', 'release')])
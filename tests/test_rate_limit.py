@@ -0,0 +1,59 @@
+# Rate limit tests: a TokenBucket halves its rate on each throttle down to the floor, and recovers a twentieth of the
+# configured rate with each request that is not throttled.
+
+import threading
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_throttle_backs_off_to_the_floor(self):
+        bucket = AccountCreationLambda.TokenBucket(8, 1)
+        rates = []
+        for attempt in range(4):
+            bucket.throttled()
+            rates.append(bucket.rate)
+        self.assertEqual(rates, [4.0, 2.0, 1.0, 1.0])
+
+    def test_success_recovers_to_the_configured_rate(self):
+        bucket = AccountCreationLambda.TokenBucket(10, 0.5)
+        bucket.throttled()
+        for attempt in range(9):
+            bucket.succeeded()
+        self.assertAlmostEqual(bucket.rate, 9.5)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 10.0)
+
+    def test_throttle_empties_the_bucket(self):
+        bucket = AccountCreationLambda.TokenBucket(2, 1)
+        with mock.patch.object(AccountCreationLambda.time, 'sleep') as sleep:
+            self.assertEqual(bucket.acquire(), 0.0)
+            bucket.throttled()
+            bucket.acquire()
+        self.assertTrue(sleep.called)
+
+    def test_concurrent_updates_keep_the_rate_bounded(self):
+        bucket = AccountCreationLambda.TokenBucket(20, 1)
+
+        def update(throttled):
+            for attempt in range(500):
+                bucket.throttled() if throttled and attempt % 10 == 0 else bucket.succeeded()
+        threads = [threading.Thread(target=update, args=(number % 2 == 0,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(1.0 <= bucket.rate <= 20.0)
+
+    def test_limits_are_per_listed_operation_or_service(self):
+        settings = { 'floor': 0.5, 'limits': { 'organizations': 1.0, 'iam.createrole': 4.0 } }
+        with mock.patch.object(AccountCreationLambda, '_rate_limit_settings', settings), \
+             mock.patch.object(AccountCreationLambda, '_rate_limiters', {}):
+            scope = ('123456789012', 'us-east-1')
+            self.assertIsNone(AccountCreationLambda.rate_limiter(scope, 'iam', 'GetRole'))
+            self.assertEqual(AccountCreationLambda.rate_limiter(scope, 'iam', 'CreateRole').max_rate, 4.0)
+            self.assertIs(AccountCreationLambda.rate_limiter(scope, 'organizations', 'ListRoots'),
+                          AccountCreationLambda.rate_limiter(scope, 'organizations', 'DescribeAccount'))
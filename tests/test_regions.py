@@ -0,0 +1,35 @@
+# Region map tests: the region availability zone map is only rediscovered for a region it does not know once, a region
+# that is not enabled is remembered as missing until the map expires.
+
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+SETTINGS = { 'az_cache_store': 'none', 'az_cache_location': '', 'az_cache_ttl': 3600, 'az_discovery_workers': 1 }
+
+
+class RegionAzMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.discoveries = 0
+        patcher = mock.patch.object(AccountCreationLambda, 'discover_availability_zones', self.discover)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def discover(self, max_workers=8):
+        self.discoveries += 1
+        return { 'us-east-1': ['us-east-1a', 'us-east-1b'], 'us-west-2': ['us-west-2a'] }
+
+    def test_known_region_is_served_from_the_cache(self):
+        for attempt in range(3):
+            zones = AccountCreationLambda.region_az_map(SETTINGS, region='us-west-2')
+        self.assertEqual(zones['us-west-2'], ['us-west-2a'])
+        self.assertEqual(self.discoveries, 1)
+
+    def test_region_not_enabled_is_rediscovered_once(self):
+        AccountCreationLambda.region_az_map(SETTINGS)
+        for attempt in range(3):
+            zones = AccountCreationLambda.region_az_map(SETTINGS, region='ap-east-1')
+        self.assertNotIn('ap-east-1', zones)
+        self.assertEqual(self.discoveries, 2)
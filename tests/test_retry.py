@@ -0,0 +1,21 @@
+# Retry policy tests: which AWS errors are retried, and for how long.
+
+import unittest
+
+import AccountCreationLambda
+
+
+class ClassifyErrorTest(unittest.TestCase):
+
+    def test_assume_role_access_denied_is_permanent(self):
+        # A real permission error, drift scans and reconcile must not spend the consistency window retrying it.
+        self.assertEqual(AccountCreationLambda.classify_error('sts', 'AssumeRole', 'AccessDenied'), 'permanent')
+
+    def test_propagation_errors_are_consistency(self):
+        self.assertEqual(AccountCreationLambda.classify_error('iam', 'PutRolePolicy', 'NoSuchEntity'), 'consistency')
+        self.assertEqual(AccountCreationLambda.classify_error('iam', 'CreateRole', 'MalformedPolicyDocument', 'Invalid principal in policy'), 'consistency')
+        self.assertEqual(AccountCreationLambda.classify_error('iam', 'CreateRole', 'MalformedPolicyDocument', 'Syntax errors in policy'), 'permanent')
+
+    def test_throttling(self):
+        self.assertEqual(AccountCreationLambda.classify_error('sts', 'AssumeRole', 'Throttling'), 'throttle')
+
@@ -0,0 +1,107 @@
+# Role tests: policy documents are compared by content rather than layout, and ensure_role only issues calls for what
+# differs from the role's current state.
+
+import json
+import unittest
+import urllib.parse
+
+import botocore.exceptions
+
+import AccountCreationLambda
+
+TRUST = AccountCreationLambda.hub_agent_trustpolicy('123456789012', ['ec2_iacbuild_hub1'])
+POLICY = json.dumps({ 'Version': '2012-10-17', 'Statement': [{ 'Effect': 'Allow', 'Action': ['s3:GetObject', 's3:ListBucket'],
+                                                                'Resource': 'arn:aws:s3:::bucket' }] })
+DESIRED = { 'RoleName': 'terraform_reader', 'TrustPolicy': TRUST, 'InlinePolicies': { 'terraform_reader': POLICY },
+            'ManagedPolicies': ['arn:aws:iam::aws:policy/ReadOnlyAccess'] }
+
+
+class FakePaginator(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages
+
+
+class FakeIam(object):
+    # One role's state, as returned by the IAM read calls, and the write calls made.
+
+    def __init__(self, role=None):
+        self.role = role
+        self.calls = []
+
+    def get_role(self, RoleName):
+        if self.role is None:
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'NoSuchEntity', 'Message': 'not found' } }, 'GetRole')
+        return { 'Role': { 'Arn': 'arn:aws:iam::210987654321:role/' + RoleName, 'AssumeRolePolicyDocument': self.role['TrustPolicy'] } }
+
+    def get_paginator(self, operation):
+        if operation == 'list_role_policies':
+            return FakePaginator([{ 'PolicyNames': sorted(self.role['InlinePolicies']) }])
+        if operation == 'list_attached_role_policies':
+            return FakePaginator([{ 'AttachedPolicies': [{ 'PolicyArn': arn } for arn in self.role['ManagedPolicies']] }])
+        return FakePaginator([{ 'InstanceProfiles': [] }])
+
+    def get_role_policy(self, RoleName, PolicyName):
+        return { 'PolicyDocument': self.role['InlinePolicies'][PolicyName] }
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            self.calls.append(operation)
+            return { 'Role': { 'Arn': 'arn:aws:iam::210987654321:role/' + kwargs.get('RoleName', '') } }
+        return call
+
+
+class NormalizePolicyTest(unittest.TestCase):
+
+    def test_equivalent_documents_compare_equal(self):
+        reordered = { 'Statement': { 'Resource': ['arn:aws:s3:::bucket'], 'Action': ['s3:ListBucket', 's3:GetObject'], 'Effect': 'Allow' },
+                      'Version': '2012-10-17' }
+        self.assertEqual(AccountCreationLambda.normalize_policy(reordered), AccountCreationLambda.normalize_policy(POLICY))
+        self.assertEqual(AccountCreationLambda.normalize_policy(urllib.parse.quote(POLICY)), AccountCreationLambda.normalize_policy(POLICY))
+
+    def test_different_documents_differ(self):
+        other = POLICY.replace('s3:ListBucket', 's3:PutObject')
+        self.assertNotEqual(AccountCreationLambda.normalize_policy(other), AccountCreationLambda.normalize_policy(POLICY))
+        self.assertIsNone(AccountCreationLambda.normalize_policy(None))
+
+
+class RoleChangesTest(unittest.TestCase):
+
+    def current(self, **changes):
+        state = { 'TrustPolicy': json.loads(TRUST), 'InlinePolicies': { 'terraform_reader': urllib.parse.quote(POLICY) },
+                  'ManagedPolicies': set(['arn:aws:iam::aws:policy/ReadOnlyAccess']), 'InstanceProfiles': set() }
+        state.update(changes)
+        return state
+
+    def test_new_role_is_created_with_everything(self):
+        self.assertEqual(AccountCreationLambda.role_changes(None, DESIRED),
+                         [('create_role', 'terraform_reader'), ('put_inline', 'terraform_reader'),
+                          ('attach_managed', 'arn:aws:iam::aws:policy/ReadOnlyAccess')])
+
+    def test_role_in_the_desired_state_needs_nothing(self):
+        self.assertEqual(AccountCreationLambda.role_changes(self.current(), DESIRED), [])
+
+    def test_only_what_differs_is_changed(self):
+        current = self.current(TrustPolicy=AccountCreationLambda.hub_agent_trustpolicy('123456789012', ['ec2_iacbuild_hub0']),
+                               ManagedPolicies=set())
+        self.assertEqual(AccountCreationLambda.role_changes(current, dict(DESIRED, InstanceProfile=True)),
+                         [('update_trust', 'terraform_reader'), ('attach_managed', 'arn:aws:iam::aws:policy/ReadOnlyAccess'),
+                          ('add_to_instance_profile', 'terraform_reader')])
+
+
+class EnsureRoleTest(unittest.TestCase):
+
+    def test_missing_role_is_created(self):
+        iam = FakeIam()
+        (arn, changes) = AccountCreationLambda.ensure_role(iam, DESIRED)
+        self.assertEqual(arn, 'arn:aws:iam::210987654321:role/terraform_reader')
+        self.assertEqual(iam.calls, ['create_role', 'put_role_policy', 'attach_role_policy'])
+
+    def test_role_in_place_makes_no_writes(self):
+        iam = FakeIam({ 'TrustPolicy': json.loads(TRUST), 'InlinePolicies': { 'terraform_reader': POLICY },
+                        'ManagedPolicies': ['arn:aws:iam::aws:policy/ReadOnlyAccess'] })
+        self.assertEqual(AccountCreationLambda.ensure_role(iam, DESIRED), ('arn:aws:iam::210987654321:role/terraform_reader', []))
+        self.assertEqual(iam.calls, [])
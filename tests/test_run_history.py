@@ -0,0 +1,76 @@
+# Run history tests: finished accounts are recorded with their step metrics, and the report flags a step whose recent
+# p50 or p95 is well above its baseline.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import AccountCreationLambda
+
+DAY = 86400.0
+NOW = 1760000000.0
+SETTINGS = { 'history_period_days': 7, 'history_window_days': 7, 'history_baseline_days': 28, 'regression_threshold': 0.2,
+             'regression_min_seconds': 5, 'regression_min_runs': 5 }
+
+
+def record(days_ago, seconds, status='complete', account_type='spoke'):
+    steps = { 'default_vpc': { 'seconds': seconds, 'api_calls': 40, 'retries': 0, 'sleep_seconds': 0.0 },
+              'account_roles': { 'seconds': 10, 'api_calls': 12, 'retries': 1, 'sleep_seconds': 0.5 } }
+    return { 'run_id': 'run-{}'.format(days_ago), 'recorded': NOW - days_ago * DAY, 'request': 'create', 'accountname': 'spoke1',
+             'account_type': account_type, 'region': 'us-west-2', 'status': status, 'elapsed': seconds + 70, 'steps': steps }
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = list(range(1, 21))
+        self.assertEqual(AccountCreationLambda.percentile(values, 0.5), 11)
+        self.assertEqual(AccountCreationLambda.percentile(values, 0.95), 20)
+        self.assertEqual(AccountCreationLambda.percentile([3.5], 0.95), 3.5)
+        self.assertIsNone(AccountCreationLambda.percentile([], 0.5))
+
+
+class RunHistoryReportTest(unittest.TestCase):
+
+    def entry(self, report, step):
+        return [entry for entry in report['steps'] if entry['step'] == step and entry['account_type'] == 'spoke'][0]
+
+    def test_slower_recent_tail_is_a_regression(self):
+        # The same median, but one recent run in five took three times as long.
+        records = [record(days_ago, 30) for days_ago in range(8, 30, 2)] + [record(days_ago, 30) for days_ago in range(1, 5)] + [record(0.5, 90)]
+        report = AccountCreationLambda.run_history_report(records, SETTINGS, now=NOW)
+        entry = self.entry(report, 'default_vpc')
+        self.assertEqual((entry['baseline']['p95'], entry['window']['p50'], entry['window']['p95']), (30, 30, 90))
+        self.assertEqual(entry['regression'], ['p95'])
+        self.assertIn("default_vpc (spoke): p95 30s -> 90s", report['regressions'])
+        self.assertEqual(self.entry(report, 'account_roles')['regression'], [])
+
+    def test_small_or_thin_differences_are_not_flagged(self):
+        records = [record(days_ago, 30) for days_ago in range(8, 30, 2)] + [record(1, 34)]
+        self.assertEqual(AccountCreationLambda.run_history_report(records, SETTINGS, now=NOW)['regressions'], [])
+        records = [record(days_ago, 30) for days_ago in range(8, 12, 2)] + [record(1, 90)]
+        self.assertEqual(AccountCreationLambda.run_history_report(records, SETTINGS, now=NOW)['regressions'], [])
+
+    def test_failed_and_old_runs_are_not_summarised(self):
+        records = [record(1, 30), record(2, 300, status='failed'), record(60, 300)]
+        report = AccountCreationLambda.run_history_report(records, SETTINGS, now=NOW)
+        self.assertEqual(report['failed'], { 'spoke': 1 })
+        self.assertEqual(self.entry(report, 'total')['window'], { 'runs': 1, 'p50': 100, 'p95': 100, 'api_calls_p50': 52,
+                                                                   'retries_p50': 1, 'sleep_seconds_p50': 0.5 })
+
+
+class RecordRunHistoryTest(unittest.TestCase):
+
+    def test_finished_accounts_are_recorded_and_loaded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = AccountCreationLambda.SqliteRunHistoryStore(os.path.join(directory, 'history.sqlite'))
+        reports = [{ 'accountname': 'spoke1', 'ishub': 'false', 'region': 'us-west-2', 'status': 'complete', 'elapsed': 95.5,
+                     'timings': { 'default_vpc': 20.5 }, 'step_metrics': { 'default_vpc': { 'api_calls': 40, 'retries': 2, 'sleep_seconds': 1.5 } } },
+                   { 'accountname': 'spoke2', 'ishub': 'false', 'region': 'us-west-2', 'status': 'suspended', 'elapsed': 600, 'timings': {} }]
+        run_id = AccountCreationLambda.record_run_history(reports, store, 'batch')
+        (loaded,) = store.load()
+        self.assertEqual((loaded['run_id'], loaded['accountname'], loaded['account_type'], loaded['request']), (run_id, 'spoke1', 'spoke', 'batch'))
+        self.assertEqual(loaded['steps'], { 'default_vpc': { 'seconds': 20.5, 'api_calls': 40, 'retries': 2, 'sleep_seconds': 1.5 } })
+        self.assertIsNone(AccountCreationLambda.record_run_history(reports[1:], store, 'batch'))
@@ -0,0 +1,70 @@
+# Task graph tests: a task starts once its dependencies have completed, a failure stops further tasks, and the critical
+# path is the slowest chain of dependent tasks.
+
+import threading
+import time
+import unittest
+
+import AccountCreationLambda
+
+
+class RunTaskGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.order = []
+
+    def task(self, name, seconds=0.0, error=None):
+        def run():
+            time.sleep(seconds)
+            with self.lock:
+                self.order.append(name)
+            if error is not None:
+                raise error
+            return name.upper()
+        return run
+
+    def test_tasks_follow_their_dependencies(self):
+        tasks = [('a', self.task('a', 0.05), []), ('b', self.task('b'), ['a']), ('c', self.task('c'), []),
+                 ('d', self.task('d'), ['b', 'c'])]
+        results = {}
+        (left, timeline) = AccountCreationLambda.run_task_graph(tasks, 4, on_complete=results.__setitem__)
+        self.assertEqual(left, [])
+        self.assertEqual(self.order[0], 'c')
+        self.assertLess(self.order.index('b'), self.order.index('d'))
+        self.assertEqual(results, { 'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D' })
+        self.assertGreaterEqual(timeline['b']['start'], timeline['a']['end'])
+
+    def test_independent_tasks_run_concurrently(self):
+        tasks = [(name, self.task(name, 0.1), []) for name in 'abcd']
+        start = time.time()
+        AccountCreationLambda.run_task_graph(tasks, 4)
+        self.assertLess(time.time() - start, 0.3)
+
+    def test_completed_and_deferred_tasks_are_not_run(self):
+        tasks = [('a', self.task('a'), []), ('b', self.task('b'), ['a']), ('c', self.task('c'), ['b']), ('d', self.task('d'), [])]
+        (left, timeline) = AccountCreationLambda.run_task_graph(tasks, 2, completed=['a'], can_start=lambda name: name != 'b')
+        self.assertEqual(self.order, ['d'])
+        self.assertEqual(left, ['b', 'c'])
+
+    def test_failure_stops_dependent_tasks(self):
+        tasks = [('a', self.task('a', error=ValueError('boom')), []), ('b', self.task('b'), ['a']), ('c', self.task('c', 0.05), [])]
+        timeline = {}
+        with self.assertRaises(ValueError):
+            AccountCreationLambda.run_task_graph(tasks, 2, timeline=timeline)
+        self.assertNotIn('b', self.order)
+        self.assertEqual(sorted(timeline), ['a', 'c'])
+
+
+class CriticalPathTest(unittest.TestCase):
+
+    def test_slowest_chain_is_the_critical_path(self):
+        tasks = [('create_account', None, []), ('iac_roles', None, ['create_account']), ('default_vpc', None, ['create_account']),
+                 ('account_roles', None, ['iac_roles'])]
+        durations = { 'create_account': 60, 'iac_roles': 5, 'account_roles': 4, 'default_vpc': 8 }
+        self.assertEqual(AccountCreationLambda.critical_path(tasks, durations), (['create_account', 'iac_roles', 'account_roles'], 69))
+
+    def test_tasks_without_a_duration_count_as_zero(self):
+        tasks = [('a', None, []), ('b', None, ['a']), ('c', None, [])]
+        self.assertEqual(AccountCreationLambda.critical_path(tasks, { 'a': 1.5, 'c': 1 }), (['a'], 1.5))
+        self.assertEqual(AccountCreationLambda.critical_path([], {}), ([], 0))
@@ -0,0 +1,93 @@
+# Update tests: an Update request from a stack created before a parameter was added as a property has no old value for
+# it, and must apply it rather than skip it.
+
+import os
+import unittest
+from unittest import mock
+
+import AccountCreationLambda
+
+PROPERTIES = { 'accountname': 'spoke1', 'accountemail': 'spoke1@example.com', 'ishub': 'false', 'parenthub': 'hub1',
+               'stackregion': 'us-west-2', 'removedefaultvpc': 'true' }
+
+ENVIRONMENT = dict(PROPERTIES, iac_account_id='123456789012', stackname='spoke1', sourcebucket='sourcebucket')
+
+
+class UpdateTasksTest(unittest.TestCase):
+
+    def setUp(self):
+        # The parameters not carried as properties are read from the Lambda environment.
+        patcher = mock.patch.dict(os.environ, ENVIRONMENT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tasks(self, old_properties, properties=PROPERTIES):
+        spec = AccountCreationLambda.account_spec_from_properties(properties)
+        previous = AccountCreationLambda.previous_account_spec(spec, old_properties)
+        (tasks, ignored) = AccountCreationLambda.update_tasks(previous, spec)
+        return (sorted(name for (name, step, dependencies) in tasks), ignored)
+
+    def test_unchanged_properties_run_nothing(self):
+        self.assertEqual(self.tasks(PROPERTIES), ([], []))
+
+    def test_missing_old_properties_are_applied(self):
+        old_properties = { 'accountname': 'spoke1', 'accountemail': 'spoke1@example.com', 'ishub': 'false' }
+        self.assertEqual(self.tasks(old_properties),
+                         (['account_roles', 'default_vpc', 'hub_role_policies', 'iac_roles', 'provider_files'], []))
+
+    def test_known_previous_hub_is_left(self):
+        (names, ignored) = self.tasks(dict(PROPERTIES, parenthub='hub0'))
+        self.assertIn('leave_hub', names)
+
+    def test_hub_without_old_parenthub_is_its_own_hub(self):
+        properties = dict(PROPERTIES, accountname='hub1', ishub='true', parenthub='')
+        spec = AccountCreationLambda.account_spec_from_properties(properties)
+        previous = AccountCreationLambda.previous_account_spec(spec, { 'accountname': 'hub1', 'ishub': 'true' })
+        self.assertEqual(previous['parenthub'], 'hub1')
+
+
+class UpdateAccountTest(unittest.TestCase):
+
+    SETTINGS = { 'testmode': False, 'preflight': False, 'max_invocations': 2, 'step_workers': 1, 'step_budget': 1,
+                 'reinvoke_margin': 0 }
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, ENVIRONMENT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.inventory = AccountCreationLambda.AccountInventory(None)
+        self.inventory.add('210987654321', 'spoke1', 'spoke1@example.com')
+        self.inventory.add('210987654322', 'spoke1', 'other@example.com')
+        patcher = mock.patch.object(AccountCreationLambda, 'account_inventory', lambda settings: self.inventory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def update(self, account_id=None):
+        spec = AccountCreationLambda.account_spec_from_properties(dict(PROPERTIES, removedefaultvpc='false'))
+        previous = AccountCreationLambda.previous_account_spec(spec, PROPERTIES)
+        with mock.patch.object(AccountCreationLambda, 'run_provisioning_steps', return_value='complete'):
+            return AccountCreationLambda.update_account(previous, spec, self.SETTINGS, '123456789012', account_id=account_id)
+
+    def test_physical_id_names_the_account(self):
+        report = self.update('210987654322')
+        self.assertEqual((report['status'], report['account_id']), ('complete', '210987654322'))
+        self.assertEqual(report['role'], 'terraform_writer')
+
+    def test_shared_name_is_not_guessed(self):
+        report = self.update()
+        self.assertEqual(report['status'], 'failed')
+        self.assertIn('210987654321, 210987654322', report['error'])
+
+    def test_update_response_keeps_the_physical_id(self):
+        event = { 'RequestType': 'Update', 'ServiceToken': 'arn:aws:lambda:us-west-2:123456789012:function:bootstrapper',
+                  'StackId': 'stack', 'RequestId': 'request', 'LogicalResourceId': 'TriggerLambda', 'ResponseURL': 'https://example.com',
+                  'PhysicalResourceId': '210987654322', 'ResourceProperties': dict(PROPERTIES, removedefaultvpc='false'),
+                  'OldResourceProperties': PROPERTIES }
+        with mock.patch.object(AccountCreationLambda, 'run_provisioning_steps', return_value='complete'), \
+             mock.patch.object(AccountCreationLambda, 'record_run_history'), \
+             mock.patch.object(AccountCreationLambda, 'get_client'), \
+             mock.patch.object(AccountCreationLambda, 'send_cloudformation_response') as send:
+            AccountCreationLambda.main(event, None)
+        body = send.call_args[0][1]
+        self.assertEqual(body['PhysicalResourceId'], '210987654322')
+        self.assertEqual((body['Data']['AccountID'], body['Data']['Role']), ('210987654322', 'terraform_writer'))